@@ -0,0 +1,120 @@
+'''
+Shared helpers of the unit tests. vm.py refuses to be imported, so its
+source is loaded without the command line entry point at the end, and
+Vmpy instances are set up without running an action.
+'''
+import imp
+import new
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_vm():
+    '''
+    Return vm.py as a module, without its `if __name__ == '__main__'` block.
+    It is registered as "vm", so the bzip2 decompression processes find the
+    functions they are sent.
+    '''
+    path = os.path.join(root, 'vm.py')
+    source = open(path).read()
+    source = source[:source.index("if __name__ == '__main__':")]
+    module = imp.new_module('vm')
+    module.__file__ = path
+    sys.modules['vm'] = module
+    exec compile(source, path, 'exec') in module.__dict__
+    return module
+
+vm = load_vm()
+
+def make_app(argv, **args):
+    '''
+    Return a Vmpy instance with the command line argv parsed, the parsed
+    values in args replaced, and the state Vmpy.__init__() sets up. No
+    action is run and no hypervisor connection is opened.
+    '''
+    app = new.instance(vm.Vmpy)
+    app.status = {'command': ' '.join(argv), 'command_history': []}
+    app.data = {}
+    app._reset_info()
+    app.info_transactions = 0
+    app.now = 'test'
+    vm.catch_sigpipe()
+
+    saved = sys.argv
+    sys.argv = ['vm.py'] + list(argv)
+    try:
+        app.args = app._load_arg_info()
+    finally:
+        sys.argv = saved
+    app.args.output_level = '0'
+    for key, value in args.items():
+        setattr(app.args, key, value)
+
+    app.hypervisor = None
+    app.cache = None
+    app.block_sizes = {}
+    app.block_sizes_lock = threading.Lock()
+    app.rate_limiters = {}
+    app.rate_limiters_lock = threading.Lock()
+    app.created_lvs = set()
+    app.checkpoint = None
+    app.checkpoint_lock = threading.Lock()
+    app.remote_control = None
+    app.remote_lock = threading.Lock()
+    app.remote_manifests = {}
+    app.progress = []
+    app.progress_lock = threading.Lock()
+    app.progress_stop = threading.Event()
+    app.progress_thread = None
+    return app
+
+def stop_app(app):
+    '''
+    Stop what a Vmpy instance started, like the @sys_exit decorator does on
+    exit: the hypervisor connection, the bzip2 decompression processes and
+    the progress reports.
+    '''
+    if app.hypervisor:
+        app.hypervisor.close()
+    if getattr(app, 'pool', None):
+        app.pool.terminate()
+    if app.progress_thread:
+        app.progress_stop.set()
+        app.progress_thread.join()
+
+class AppTestCase(unittest.TestCase):
+    '''
+    Test case creating Vmpy instances, stopped after each test.
+    '''
+    def make_app(self, argv, **args):
+        app = make_app(argv, **args)
+        self.addCleanup(stop_app, app)
+        return app
+
+class TempDirTestCase(AppTestCase):
+    '''
+    Test case with a temporary directory, removed after each test.
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vmpy-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        path = self.path(name)
+        with open(path, 'wb') as handle:
+            handle.write(data)
+        return path
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as handle:
+            return handle.read()
@@ -0,0 +1,127 @@
+'''
+Round trips of disk images through the copy engine, see Vmpy._transfer().
+'''
+import hashlib
+import os
+import subprocess
+import unittest
+
+from support import TempDirTestCase, vm
+
+MiB = 1024 * 1024
+
+def image(*regions):
+    '''
+    Return disk image data built from (kind, length) regions, kind being
+    "data" for random bytes or "zero".
+    '''
+    parts = []
+    for kind, length in regions:
+        parts.append(os.urandom(length) if kind == 'data' else '\0' * length)
+    return ''.join(parts)
+
+class CopyEngineTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.app = self.make_app(['import', self.directory], block_size='64K')
+        self.data = image(('data', 3 * MiB + 1000), ('zero', 2 * MiB), ('data', 65536), ('zero', MiB - 1000))
+        self.source = self.write('source.img', self.data)
+
+    def test_plain_copy(self):
+        checksums = {}
+        copied = self.app._transfer(self.source, self.path('target.img'), checksums=checksums)
+        self.assertEqual(copied, len(self.data))
+        self.assertEqual(self.read('target.img'), self.data)
+        self.assertEqual(checksums['raw'], hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(checksums['image'], checksums['raw'])
+
+    def test_gzip_round_trip(self):
+        compress = self.app._compression_command('gzip')
+        checksums = {}
+        self.app._transfer(self.source, self.path('image.gz'), [compress], checksums=checksums, compressed='target')
+        self.assertEqual(checksums['image'], hashlib.sha256(self.read('image.gz')).hexdigest())
+
+        self.app._transfer(self.path('image.gz'), self.path('target.img'), [self.app._decompression_filter('gzip')])
+        self.assertEqual(self.read('target.img'), self.data)
+
+    def bzip2_image(self):
+        '''
+        Save the source as a single-stream bzip2 image, which is decompressed
+        across the process pool.
+        '''
+        if not self.app._find_program('bzip2'):
+            self.skipTest('bzip2 is not installed')
+        if self.app._find_program('lbzip2'):
+            self.skipTest('lbzip2 is installed, bzip2 images are not split')
+        self.app.args.compression_threads = 4
+        subprocess.check_call('bzip2 -c -q -1 < {0} > {1}'.format(self.source, self.path('image.bz2')), shell=True)
+
+    def test_parallel_bzip2_round_trip(self):
+        self.bzip2_image()
+
+        decompress = self.app._decompression_filter('bzip2')
+        self.assertEqual(decompress, self.app._bzip2_decompress)
+        self.app._transfer(self.path('image.bz2'), self.path('target.img'), [decompress])
+        self.assertEqual(self.read('target.img'), self.data)
+
+    def test_truncated_bzip2_stream_fails(self):
+        self.bzip2_image()
+        compressed = self.read('image.bz2')
+        self.write('image.bz2', compressed[:len(compressed) // 2])
+
+        with self.assertRaises(vm.ApplicationError):
+            self.app._transfer(self.path('image.bz2'), self.path('target.img'), [self.app._decompression_filter('bzip2')])
+
+    def test_failing_filter_fails(self):
+        with self.assertRaises(vm.ApplicationError):
+            self.app._transfer(self.source, self.path('target.img'), [['false']])
+
+    def test_sparse_round_trip(self):
+        extent_map = {}
+        self.app._transfer(self.source, self.path('image.sparse'), read_extents=extent_map)
+        self.assertEqual(extent_map['size'], len(self.data))
+        self.assertEqual(os.path.getsize(self.path('image.sparse')), sum(length for offset, length in extent_map['extents']))
+        self.assertTrue(os.path.getsize(self.path('image.sparse')) < len(self.data))
+
+        self.write('target.img', os.urandom(len(self.data)))
+        self.app._transfer(self.path('image.sparse'), self.path('target.img'), write_extents=extent_map)
+        self.assertEqual(self.read('target.img'), self.data)
+
+    def test_incremental_chain_round_trip(self):
+        chunk_size = 256 * 1024
+        base_manifest = {'chunk_size': chunk_size}
+        base_extents = {}
+        self.app._transfer(self.source, self.path('base.img'), read_extents=base_extents, manifest=base_manifest)
+
+        changed = bytearray(self.data)
+        changed[chunk_size + 10:chunk_size + 20] = os.urandom(10)
+        changed[4 * MiB:4 * MiB + 100] = os.urandom(100)
+        changed = str(changed)
+        self.write('source.img', changed)
+        manifest = {'chunk_size': chunk_size}
+        extents = {}
+        self.app._transfer(self.source, self.path('delta.img'), read_extents=extents, manifest=manifest, base_manifest=base_manifest)
+        self.assertEqual(os.path.getsize(self.path('delta.img')), 2 * chunk_size)
+
+        self.app._transfer(self.path('base.img'), self.path('target.img'), write_extents=base_extents)
+        self.assertEqual(self.read('target.img'), self.data)
+        self.app._transfer(self.path('delta.img'), self.path('target.img'), write_extents=extents)
+        self.assertEqual(self.read('target.img'), changed)
+
+    def test_discard_skips_zero_blocks(self):
+        written = self.app._transfer(self.source, self.path('target.img'), discard=True)
+        block = vm.CopyEngine.sparse_block_size
+        blocks = [self.data[i:i + block] for i in xrange(0, len(self.data), block)]
+        self.assertEqual(written, sum(len(data) for data in blocks if data.strip('\0')))
+        self.assertEqual(self.read('target.img'), self.data)
+
+    def test_range_copy(self):
+        split = 2 * MiB
+        ranges = [(split, len(self.data) - split), (0, split)]
+        for offset, length in ranges:
+            self.app._transfer(self.source, self.path('target.img'), source_range=(offset, length), offset=offset)
+        self.assertEqual(self.read('target.img'), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
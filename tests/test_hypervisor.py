@@ -0,0 +1,59 @@
+'''
+The libvirt hypervisor backend against libvirt's built-in test driver, which
+starts with one running domain named "test".
+'''
+import unittest
+
+from support import AppTestCase, vm
+
+@unittest.skipUnless(vm.libvirt, 'the libvirt Python bindings are not installed')
+class LibvirtBackendTest(AppTestCase):
+
+    def setUp(self):
+        self.app = self.make_app(['--hypervisor', 'auto', '--connect', 'test:///default', 'import', '/tmp/backup'])
+        self.app.hypervisor = self.app._load_hypervisor()
+        self.backend = self.app.hypervisor
+
+    def history(self):
+        return [(result, entry) for timestamp, result, entry in self.app.status['command_history']]
+
+    def test_auto_selects_libvirt(self):
+        self.assertTrue(isinstance(self.backend, vm.LibvirtBackend))
+        self.assertEqual(self.app.status['hypervisor'], 'libvirt')
+
+    def test_list_domains(self):
+        self.assertEqual(self.backend.list_domains(), [{'name': 'test', 'status': 'running'}])
+        self.assertEqual(self.backend.get_domain('test'), {'name': 'test', 'status': 'running'})
+        self.assertEqual(self.backend.get_domain('missing'), None)
+
+    def test_dumpxml(self):
+        self.assertTrue('<name>test</name>' in self.backend.dumpxml('test'))
+        self.assertEqual(self.backend.dumpxml_all(['test']), [self.backend.dumpxml('test')])
+        with self.assertRaises(vm.ApplicationError):
+            self.backend.dumpxml('missing')
+
+    def test_actions(self):
+        self.assertTrue(self.backend.suspend('test'))
+        self.assertEqual(self.backend.get_domain('test')['status'], 'paused')
+        self.assertTrue(self.backend.resume('test'))
+        self.assertTrue(self.backend.destroy('test'))
+        self.assertEqual(self.backend.get_domain('test')['status'], 'shut off')
+        self.assertTrue(self.backend.start('test'))
+        self.assertEqual(self.backend.get_domain('test')['status'], 'running')
+        self.assertEqual(self.history()[0], ('success', 'libvirt: suspend test'))
+
+    def test_actions_on_missing_domain(self):
+        for action in (self.backend.autostart, self.backend.start, self.backend.suspend, self.backend.resume, self.backend.shutdown, self.backend.destroy, self.backend.undefine):
+            self.assertFalse(action('missing'))
+        self.assertEqual([result for result, entry in self.history()], ['error'] * 7)
+
+    def test_failing_action(self):
+        self.assertFalse(self.backend.resume('test'))
+        self.assertEqual(self.history()[-1][0], 'error')
+
+    def test_canonical_uri(self):
+        self.assertEqual(self.backend.canonical_uri(), 'test:///default')
+        self.assertEqual(self.backend.generation('test'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''
+Concurrency of disk streams: the --streams-per-pv scheduler and the byte
+ranges of --ssh-streams.
+'''
+import threading
+import time
+import unittest
+
+from support import AppTestCase
+
+class Tracker(object):
+    '''
+    Count the calls running at the same time, keeping each one running for
+    delay seconds.
+    '''
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+
+class ParallelPerPvTest(AppTestCase):
+
+    def run_items(self, pvs, streams_per_pv):
+        app = self.make_app(['import', '/tmp/backup'], streams_per_pv=streams_per_pv)
+        tracker = Tracker()
+        app._parallel_per_pv(tracker, range(len(pvs)), pvs)
+        return tracker.peak
+
+    def test_items_on_one_pv_take_turns(self):
+        self.assertEqual(self.run_items([['/dev/sda2']] * 4, 1), 1)
+
+    def test_streams_per_pv_bound(self):
+        self.assertEqual(self.run_items([['/dev/sda2']] * 4, 2), 2)
+
+    def test_items_on_separate_pvs_run_together(self):
+        self.assertEqual(self.run_items([['/dev/sda2'], ['/dev/sdb1'], ['/dev/sdc1']], 1), 3)
+
+    def test_item_on_two_pvs_holds_both(self):
+        self.assertEqual(self.run_items([['/dev/sda2', '/dev/sdb1'], ['/dev/sdb1']], 1), 1)
+
+class SshStreamsTest(AppTestCase):
+
+    def test_ranges_of_one_disk_run_together(self):
+        '''
+        With the default --streams-per-pv of 1, every --ssh-streams range
+        of a disk runs at the same time.
+        '''
+        size = 4 * 1024 * 1024
+        app = self.make_app(['--ssh-streams', '4', '--block-size', '64K', 'backup', '--remote', 'backup-host', 'web-1', '/backup'])
+        self.assertEqual(app.args.streams_per_pv, 1)
+        app._lv_pvs = lambda lv_tuple: ['/dev/sda2']
+        app._remote_ssh_command = lambda command, multiplex=True: ['ssh', 'backup-host'] + command
+        app._execute = lambda command, **kwargs: str(size) if 'stat' in command else ''
+
+        tracker = Tracker()
+        def transfer(source, target, filters=(), size=None, checksums=None, **kwargs):
+            tracker()
+            checksums.update({'raw': 'raw', 'image': 'image', 'raw_length': size, 'image_length': size})
+        app._transfer = transfer
+
+        disk = {'image': 'web-1.img', 'image_size': '{0}b'.format(size), 'volume_group': 'vg0', 'logical_volume': 'web-1'}
+        start = time.time()
+        app._backup_disks({'disks': [disk]}, ['/dev/vg0/web-1-snapshot'], app._backup_remote_lv)
+
+        self.assertEqual(tracker.peak, 4)
+        self.assertTrue(time.time() - start < 4 * tracker.delay)
+        self.assertEqual([chunk['offset'] for chunk in disk['checkpoints']], [0, size // 4, size // 2, 3 * size // 4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+'''
+Remote backups and imports, with the commands meant for the remote host run
+by a local shell the way ssh passes them on.
+'''
+import os
+import unittest
+
+from support import TempDirTestCase
+
+MiB = 1024 * 1024
+
+class RemoteTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.remote_dir = self.path("backup dir;touch injected") + '/'
+        os.mkdir(self.remote_dir)
+        self.data = os.urandom(3 * MiB + 1000)
+        self.source = self.write('source.img', self.data)
+        self.disk = {'target': 'vda', 'image': 'web-1.img', 'image_size': '{0}b'.format(len(self.data)), 'volume_group': 'vg0', 'logical_volume': 'web-1'}
+
+    def remote_app(self, compression, ssh_streams):
+        app = self.make_app(['--ssh-streams', str(ssh_streams), '--block-size', '64K', 'backup', '--remote', 'backup-host', '--compression', compression, 'web-1', self.remote_dir])
+        # ssh joins the remote command, including arguments appended to it
+        # later, to one string run by the remote shell
+        app._remote_ssh_command = lambda command, multiplex=True: ['sh', '-c', 'eval "$*"', 'sh'] + command
+        return app
+
+    def round_trip(self, compression, ssh_streams):
+        app = self.remote_app(compression, ssh_streams)
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            app._backup_remote_lv(self.disk, self.source)
+            target = self.write('target.img', '')
+            app._import_remote_lv(self.remote_dir, {'compression': compression}, self.disk, {'disk': target})
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(self.read('target.img'), self.data)
+        self.assertFalse(os.path.exists(self.path('injected')))
+        self.assertEqual(os.listdir(self.remote_dir), [self.disk['image']])
+
+    def test_round_trip(self):
+        self.round_trip('none', 1)
+
+    def test_round_trip_gzip(self):
+        self.round_trip('gzip', 1)
+
+    def test_round_trip_ssh_streams(self):
+        self.round_trip('none', 3)
+        self.assertEqual(len(self.disk['checkpoints']), 3)
+
+    def test_round_trip_ssh_streams_gzip(self):
+        self.round_trip('gzip', 3)
+        self.assertEqual(len(self.disk['checkpoints']), 3)
+
+if __name__ == '__main__':
+    unittest.main()
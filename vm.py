@@ -21,18 +21,68 @@ For license information see LICENSE.txt file.
 # Imports
 # ==============================================================================
 import argparse
+import binascii
+import bz2
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import functools
+import hashlib
+import io
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import pdb
+import pipes
 import pwd
+import Queue
 import random
+import signal
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import traceback
 import textwrap
+import uuid
 import xml.etree.ElementTree as ElementTree
-
-from datetime import datetime
+import zlib
+
+from datetime import datetime, timedelta
+
+# Optional: the libvirt Python bindings allow a persistent hypervisor
+# connection. Without them `virsh` is used instead.
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+# Optional: the C library provides the kernel copy functions used by the
+# copy engine. Without them data is copied with read() and write().
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+except OSError:
+    libc = None
+
+# Linux ioctl() requests used by sparse copies
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+
+# Linux posix_fadvise() advice and sync_file_range() flags used by the
+# --io-policy options that keep copies out of the page cache
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
 
 # ==============================================================================
 # Decorators
@@ -44,6 +94,8 @@ def sys_exit(func):
             self.pid_file = './vmpy.pid'
             self.error_file = './vmpy-error-<datetime>.json'
             self.log_file = './vmpy-log.json'
+            self.cache_file = './vmpy-cache.json'
+            self.checkpoint_file = './vmpy-checkpoint.json'
 
             # Add status variables
             self.status = {}
@@ -92,6 +144,27 @@ def sys_exit(func):
             self.status['time_end'] = str(datetime.now())
             self.status['exit'] = 'Success'
         finally:
+            # Close hypervisor connection
+            if getattr(self, 'hypervisor', None):
+                self.hypervisor.close()
+
+            # Stop decompression processes
+            if getattr(self, 'pool', None):
+                self.pool.terminate()
+
+            # Stop progress reports
+            if getattr(self, 'progress_thread', None):
+                self.progress_stop.set()
+                self.progress_thread.join()
+
+            # Close the persistent ssh connection
+            if getattr(self, 'remote_control', None):
+                self._remote_disconnect()
+
+            # Save environment cache for the next run
+            if success and getattr(self, 'cache', None) is not None:
+                self._save_cache()
+
             # Remove pseudo-PID file
             self._remove_pid_file()
 
@@ -125,12 +198,15 @@ def execute_safely(func):
             self._raise(e, message)
     return wrapper
 
-def reload_environmental_info(func):
+def refresh_environmental_info(func):
     def wrapper(self, *args, **named_args):
         try:
             return func(self, *args, **named_args)
         finally:
-            self.load_info()
+            # Refresh the records invalidated by the mutation. Inside an
+            # info_transaction() the refresh happens once at the end.
+            if not self.info_transactions:
+                self._refresh_info()
     return wrapper
 
 # ==============================================================================
@@ -152,11 +228,1737 @@ class ApplicationWarning(Exception):
     def __str__(self):
         return repr(self.value)
 
+# ==============================================================================
+# Data Records
+# ==============================================================================
+class InfoRecord(object):
+    '''
+    Compact record for environmental information. Fields are stored in
+    __slots__ instead of a per-record dictionary, while the dictionary style
+    access used throughout the application (record['name'], record.get(),
+    dict(record)) keeps working. Unknown fields raise a KeyError.
+    '''
+    __slots__ = ()
+
+    def __init__(self, values=None):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        if values:
+            self.update(values)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.__slots__]
+
+    def update(self, values):
+        for key, value in dict(values).items():
+            self[key] = value
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+class VgRecord(InfoRecord):
+    __slots__ = ('VG', 'VSize', 'VFree', 'Ext', 'Seq')
+
+class LvRecord(InfoRecord):
+    __slots__ = ('LV', 'VG', 'Path', 'LSize', 'KMaj', 'KMin', 'Attr', 'Origin', 'Devices')
+
+class VmRecord(InfoRecord):
+    '''
+    VM record. The domain XML is not kept, see Vmpy.vm_xml(). The disk
+    fields describe the primary disk, "disks" is a list of dictionaries with
+    the same fields, plus the guest "target" device, for every disk. "macs"
+    lists the MAC address of every network interface.
+    '''
+    __slots__ = ('name', 'status', 'uuid', 'disk', 'disk_file', 'mac', 'macs', 'bridge', 'disk_size', 'logical_volume', 'volume_group', 'disks')
+
+# ==============================================================================
+# Hypervisor Backends
+# ==============================================================================
+class HypervisorBackend:
+    '''
+    Common interface for hypervisor backends. Each backend is created once per
+    run and receives the application instance, which it uses for output,
+    command execution and history logging.
+
+    Domain state strings match the "State" column of `virsh list`, e.g.
+    "running", "paused" and "shut off". Action methods return a boolean
+    success value, matching `self._execute(command, boolean=True)`.
+    '''
+    name = None
+
+    def __init__(self, app, uri=None):
+        self.app = app
+        self.uri = uri
+        self.resolved_uri = None
+
+    def list_domains(self):
+        '''
+        Return a list of dictionaries, one per defined domain, with the keys
+        "name" and "status".
+        '''
+        raise NotImplementedError
+
+    def get_domain(self, name):
+        '''
+        Return the dictionary of a single domain, as in list_domains(), or
+        None if no domain with this name is defined.
+        '''
+        raise NotImplementedError
+
+    def dumpxml(self, name):
+        raise NotImplementedError
+
+    def dumpxml_all(self, names):
+        '''
+        Return the XML of each named domain, in the same order as names.
+        '''
+        return [self.dumpxml(name) for name in names]
+
+    def generation(self, name):
+        '''
+        Return a token that changes whenever the domain configuration changes,
+        or None if it can not be determined. Built from the stat information of
+        the local QEMU driver's persistent config and live status XML files,
+        so it only applies to a qemu:///system connection.
+        '''
+        if self.resolved_uri is None:
+            self.resolved_uri = self.canonical_uri()
+        if self.resolved_uri != 'qemu:///system':
+            return None
+
+        token = []
+        for path in ('/etc/libvirt/qemu/{0}.xml', '/var/run/libvirt/qemu/{0}.xml'):
+            try:
+                info = os.stat(path.format(name))
+                token.append([info.st_ino, info.st_size, info.st_mtime])
+            except OSError:
+                token.append(None)
+
+        if token[0] is None:
+            return None
+        return token
+
+    def canonical_uri(self):
+        '''
+        Return the URI of the connection the backend actually uses, which
+        libvirt resolves when no --connect URI is given.
+        '''
+        raise NotImplementedError
+
+    def autostart(self, name):
+        raise NotImplementedError
+
+    def start(self, name):
+        raise NotImplementedError
+
+    def suspend(self, name):
+        raise NotImplementedError
+
+    def resume(self, name):
+        raise NotImplementedError
+
+    def shutdown(self, name):
+        raise NotImplementedError
+
+    def destroy(self, name):
+        raise NotImplementedError
+
+    def define(self, xml_file_path):
+        raise NotImplementedError
+
+    def undefine(self, name):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class VirshBackend(HypervisorBackend):
+    '''
+    Hypervisor backend using the `virsh` command line tool. Every call forks a
+    `virsh` process. Domain XML is retrieved concurrently, bounded by --jobs.
+    '''
+    name = 'virsh'
+
+    def _command(self, *args):
+        command = ['virsh']
+        if self.uri:
+            command += ['-c', self.uri]
+        return command + list(args)
+
+    def list_domains(self):
+        command = self._command('list', '--all')
+        self.app._output('Parsing defined virtual-machine information: `{0}`'.format(' '.join(command)), 3)
+        output = self.app._execute(command, output_level=3)
+
+        # Extract virtual machine rows from output. Columns are located by
+        # their header position instead of by splitting on whitespace.
+        rows = output.split('\n')
+        header = rows[0]
+        name_column = header.find('Name')
+        state_column = header.find('State')
+        if name_column == -1 or state_column == -1:
+            self.app._raise('Could not parse `{0}` output headers: "{1}"'.format(' '.join(command), header))
+
+        domains = []
+        for row in filter(None, [row.rstrip() for row in rows[2:]]):
+            domain = {}
+            domain['name'] = row[name_column:state_column].strip()
+            domain['status'] = row[state_column:].strip()
+            domains.append(domain)
+
+        return domains
+
+    def get_domain(self, name):
+        for domain in self.list_domains():
+            if domain['name'] == name:
+                return domain
+        return None
+
+    def dumpxml(self, name):
+        command = self._command('dumpxml', name)
+        self.app._output('Retrieving XML for virtual machine: `{0}`'.format(' '.join(command)), 4)
+        return self.app._execute(command, output_level=3)
+
+    def dumpxml_all(self, names):
+        # Load VM XML concurrently. Results are returned in the order of
+        # names so the loaded data does not depend on thread timing.
+        return self.app._parallel_map(self.dumpxml, names, self.app.args.jobs)
+
+    def canonical_uri(self):
+        return self.app._execute(self._command('uri'), output_level=3).strip()
+
+    def autostart(self, name):
+        return self.app._execute(self._command('autostart', name), boolean=True)
+
+    def start(self, name):
+        return self.app._execute(self._command('start', name), boolean=True)
+
+    def suspend(self, name):
+        return self.app._execute(self._command('suspend', name), boolean=True)
+
+    def resume(self, name):
+        return self.app._execute(self._command('resume', name), boolean=True)
+
+    def shutdown(self, name):
+        return self.app._execute(self._command('shutdown', name), boolean=True)
+
+    def destroy(self, name):
+        return self.app._execute(self._command('destroy', name), boolean=True)
+
+    def define(self, xml_file_path):
+        return self.app._execute(self._command('define', xml_file_path), boolean=True)
+
+    def undefine(self, name):
+        return self.app._execute(self._command('undefine', name), boolean=True)
+
+class LibvirtBackend(HypervisorBackend):
+    '''
+    Hypervisor backend using the libvirt Python bindings. A single connection
+    is opened for the whole run and domains and their XML are retrieved
+    in-process. Can be tried without a hypervisor using libvirt's
+    built-in test driver: `--connect test:///default`.
+    '''
+    name = 'libvirt'
+
+    def __init__(self, app, uri=None):
+        HypervisorBackend.__init__(self, app, uri)
+        self.app._output('Opening libvirt connection: "{0}"'.format(uri or 'default'), 3)
+        try:
+            self.connection = libvirt.open(uri)
+        except libvirt.libvirtError, e:
+            self.app._raise(e, 'Could not open libvirt connection: "{0}"'.format(uri or 'default'))
+
+    def _state(self, domain):
+        states = {
+            libvirt.VIR_DOMAIN_NOSTATE: 'no state',
+            libvirt.VIR_DOMAIN_RUNNING: 'running',
+            libvirt.VIR_DOMAIN_BLOCKED: 'idle',
+            libvirt.VIR_DOMAIN_PAUSED: 'paused',
+            libvirt.VIR_DOMAIN_SHUTDOWN: 'in shutdown',
+            libvirt.VIR_DOMAIN_SHUTOFF: 'shut off',
+            libvirt.VIR_DOMAIN_CRASHED: 'crashed'
+        }
+        if hasattr(libvirt, 'VIR_DOMAIN_PMSUSPENDED'):
+            states[libvirt.VIR_DOMAIN_PMSUSPENDED] = 'pmsuspended'
+        return states.get(domain.state(0)[0], 'unknown')
+
+    def _call(self, description, func, *args):
+        '''
+        Call a libvirt method and return a boolean, logging the result in
+        the command history like a `virsh` call.
+        '''
+        try:
+            func(*args)
+        except libvirt.libvirtError, e:
+            self.app._history('error', 'libvirt: {0} | {1}'.format(description, str(e)))
+            return False
+        self.app._history('success', 'libvirt: {0}'.format(description))
+        return True
+
+    def _lookup(self, name):
+        '''
+        Return the handle of the named domain, or False if it can not be
+        found, logging the lookup in the command history like `virsh`.
+        '''
+        try:
+            return self.connection.lookupByName(name)
+        except libvirt.libvirtError, e:
+            self.app._history('error', 'libvirt: lookup {0} | {1}'.format(name, str(e)))
+            return False
+
+    def _call_domain(self, description, name, method, *args):
+        '''
+        Call a method of the named domain and return a boolean, see _call().
+        Returns False if the domain can not be found.
+        '''
+        domain = self._lookup(name)
+        if not domain:
+            return False
+        return self._call(description, getattr(domain, method), *args)
+
+    def list_domains(self):
+        self.app._output('Listing defined virtual-machines using libvirt.', 3)
+        if hasattr(self.connection, 'listAllDomains'):
+            handles = self.connection.listAllDomains(0)
+        else:
+            handles = [self.connection.lookupByID(id) for id in self.connection.listDomainsID()]
+            handles += [self.connection.lookupByName(name) for name in self.connection.listDefinedDomains()]
+
+        handles = sorted(handles, key=lambda handle: handle.name())
+        return [self._domain(handle) for handle in handles]
+
+    def _domain(self, handle):
+        domain = {}
+        domain['name'] = handle.name()
+        domain['status'] = self._state(handle)
+        return domain
+
+    def get_domain(self, name):
+        try:
+            handle = self.connection.lookupByName(name)
+        except libvirt.libvirtError:
+            return None
+        return self._domain(handle)
+
+    def dumpxml(self, name):
+        domain = self._lookup(name)
+        if not domain:
+            self.app._raise('Could not find libvirt domain: "{0}"'.format(name))
+        try:
+            return domain.XMLDesc(0)
+        except libvirt.libvirtError, e:
+            self.app._raise(e, 'Could not retrieve XML of libvirt domain: "{0}"'.format(name))
+
+    def canonical_uri(self):
+        return self.connection.getURI()
+
+    def autostart(self, name):
+        return self._call_domain('autostart {0}'.format(name), name, 'setAutostart', 1)
+
+    def start(self, name):
+        return self._call_domain('start {0}'.format(name), name, 'create')
+
+    def suspend(self, name):
+        return self._call_domain('suspend {0}'.format(name), name, 'suspend')
+
+    def resume(self, name):
+        return self._call_domain('resume {0}'.format(name), name, 'resume')
+
+    def shutdown(self, name):
+        return self._call_domain('shutdown {0}'.format(name), name, 'shutdown')
+
+    def destroy(self, name):
+        return self._call_domain('destroy {0}'.format(name), name, 'destroy')
+
+    def define(self, xml_file_path):
+        xml = self.app._read_file(xml_file_path)
+        return self._call('define {0}'.format(xml_file_path), self.connection.defineXML, xml)
+
+    def undefine(self, name):
+        return self._call_domain('undefine {0}'.format(name), name, 'undefine')
+
+    def close(self):
+        try:
+            self.connection.close()
+        except libvirt.libvirtError:
+            pass
+
+# ==============================================================================
+# Copy Engine
+# ==============================================================================
+def libc_function(name, argtypes):
+    '''
+    Return a C library function with the given argument types, or None if
+    the C library or the function is not available.
+    '''
+    function = getattr(libc, name, None) if libc else None
+    if function:
+        function.argtypes = argtypes
+        function.restype = ctypes.c_ssize_t
+    return function
+
+def catch_sigpipe():
+    '''
+    Python ignores SIGPIPE and child processes inherit an ignored signal.
+    Install a no-op handler in the main thread instead: exec() resets a
+    caught signal to its default, so a pipeline stage exits as soon as its
+    reader goes away, while writes in this process still fail with EPIPE.
+    '''
+    signal.signal(signal.SIGPIPE, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGPIPE, False)
+
+class RateLimiter:
+    '''
+    Token bucket of a --read-limit, --write-limit or --network-limit. Every
+    stream the limit applies to takes the bytes it moved and sleeps while
+    the bucket is in debt, so together the streams average rate bytes per
+    second, with bursts of up to a second.
+    '''
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.time = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= count
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+class TransferStats:
+    '''
+    Byte counters of one transfer per stage: "read" from the source disk or
+    file, "compressed" image bytes, "sent" to and "received" from an ssh
+    remote and "written" to the target disk or file. The record is saved in
+    the JSON run log, with the samples taken by progress reports.
+    '''
+    stages = ['read', 'compressed', 'sent', 'received', 'written']
+
+    def __init__(self, description, size=None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.record = {
+            'description': description,
+            'size': size,
+            'bytes': dict.fromkeys(self.stages, 0),
+            'seconds': None,
+            'throughput': {},
+            'samples': [],
+        }
+
+    def add(self, stage, count):
+        with self.lock:
+            self.record['bytes'][stage] += count
+
+    def sample(self):
+        '''
+        Return the seconds since the start and a copy of the counters, and
+        keep them as a sample.
+        '''
+        with self.lock:
+            seconds = time.time() - self.started
+            counters = dict(self.record['bytes'])
+            self.record['samples'].append([round(seconds, 1), counters])
+        return seconds, counters
+
+    def finish(self):
+        '''
+        Record the duration and the average throughput of every stage in
+        bytes per second.
+        '''
+        with self.lock:
+            seconds = max(time.time() - self.started, 0.001)
+            self.record['seconds'] = round(seconds, 3)
+            self.record['throughput'] = dict((stage, int(count / seconds)) for stage, count in self.record['bytes'].items() if count)
+
+class CopyEngine:
+    '''
+    In-process replacement for `dd | compressor | dd` pipelines.
+
+    Data is moved between file descriptors by the kernel wherever possible:
+    copy_file_range() between files and block devices, splice() to and from
+    pipes and sendfile() as a fallback, falling back to read() and write()
+    with a --block-size buffer. Compression and ssh stages run as commands
+    connected by bounded pipes, so a slow stage holds back the stages before
+    it. The result of every stage is checked, not just the last one.
+
+    The io_policy decides how copies use the page cache. "cache" leaves it
+    to the kernel. "fadvise" asks for sequential readahead on sources and
+    drops the pages of files and devices behind the copy, writing them back
+    first. "direct" bypasses the cache with O_DIRECT for whole image copies,
+    through an aligned buffer, and falls back to "fadvise" elsewhere.
+
+    The RateLimiters of read_limits and write_limits throttle the files and
+    devices opened for reading and for writing, a meter() filter stage
+    throttles a stream. Bytes moved are counted in a TransferStats as read
+    or written, and also as compressed on the side named by compressed,
+    "source" or "target". A meter() stage counts the stages it is given.
+    '''
+    # Bytes requested per system call when the kernel copies the data
+    kernel_chunk_size = 64 * 1024 ** 2
+
+    # Size of the pipes between stages, Linux F_SETPIPE_SZ
+    pipe_size = 1024 ** 2
+
+    # Bytes copied between page cache releases of the fadvise policy, and
+    # the buffer alignment and size granularity of O_DIRECT
+    release_size = 32 * 1024 ** 2
+    direct_alignment = 4096
+
+    # Size of the blocks checked for zeroes by sparse copies
+    sparse_block_size = 64 * 1024
+    zero_block = '\0' * sparse_block_size
+
+    # Errors meaning a copy method does not support a pair of descriptors
+    unsupported_errors = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF, errno.ESPIPE, errno.EOPNOTSUPP)
+
+    copy_file_range = libc_function('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+    splice = libc_function('splice', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+    sendfile = libc_function('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    posix_fadvise = libc_function('posix_fadvise', [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+    sync_file_range = libc_function('sync_file_range', [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint])
+
+    def __init__(self, app, block_size, io_policy='cache', read_limits=(), write_limits=(), stats=None, compressed=None):
+        self.app = app
+        self.block_size = block_size
+        self.io_policy = io_policy
+        self.read_limits = list(read_limits)
+        self.write_limits = list(write_limits)
+        self.stats = stats
+        self.compressed = compressed
+
+        # RateLimiters of the descriptors being throttled, and the stages
+        # of the descriptors being counted
+        self.limited = {}
+        self.counted = {}
+
+        # Descriptors opened with O_DIRECT, and the [writing, released,
+        # flushed] offsets of descriptors whose cache is dropped behind
+        # the copy
+        self.direct = set()
+        self.released = {}
+
+    def transfer(self, source, target, filters=()):
+        '''
+        Stream source through filters into target and return the number of
+        bytes written to target, or None if target is a command. source and
+        target are either a path or a command (a list), in which case its
+        stdout or stdin is used. Each filter is either a command or a
+        callable func(in_fd, out_fd), run in a thread, which must not close
+        its descriptors. Callables may also be used as source, called as
+        func(out_fd) in a thread, and as target, called as func(in_fd) and
+        returning the number of bytes written. Raises an ApplicationError
+        naming every stage that failed.
+        '''
+        filters = list(filters)
+        stages = [self._describe(stage) for stage in [source] + filters + [target]]
+        description = ' | '.join(stages)
+        self.app._output('Transferring: `{0}`'.format(description), 2)
+
+        processes = []
+        threads = []
+        reader = None
+        copied = None
+        errors = []
+        stage = stages[0]
+        try:
+            # Open source. A source file is pumped into a pipe when it is
+            # read by another stage.
+            if isinstance(source, list):
+                reader = self._spawn(source, None, processes)
+            elif callable(source):
+                reader = self._start(source, None, threads, stage)
+            else:
+                reader = self._open(source, os.O_RDONLY, direct=True)
+                if filters or not isinstance(target, basestring):
+                    fd, reader = reader, None
+                    reader = self._start(self.copy, fd, threads, stage)
+
+            # Chain filters
+            for i, func in enumerate(filters):
+                stage = stages[i + 1]
+                fd, reader = reader, None
+                if isinstance(func, list):
+                    reader = self._spawn(func, fd, processes)
+                else:
+                    reader = self._start(func, fd, threads, stage)
+
+            # Write target
+            stage = stages[-1]
+            if isinstance(target, list):
+                fd, reader = reader, None
+                self._spawn(target, fd, processes, output=False)
+            elif callable(target):
+                copied = target(reader)
+            else:
+                writer = self._open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, direct=True)
+                try:
+                    copied = self.copy(reader, writer)
+                finally:
+                    self._close(writer)
+        except BaseException, e:
+            errors.append('{0}: {1}'.format(stage, str(e)))
+        finally:
+            # Closing the last reader ends the stages before it on failure
+            if reader is not None:
+                self._close(reader)
+            stage_errors, broken = self._wait(processes, threads)
+
+        # A broken pipe is usually the symptom of a later stage failing. On
+        # its own it means a stage stopped reading before the end of input.
+        errors = (errors + stage_errors) or broken
+
+        if errors:
+            message = 'Transfer failed: `{0}` | {1}'.format(description, ' | '.join(errors))
+            self.app._history('error', message)
+            self.app._raise(message)
+
+        self.app._history('success', 'Transfer: `{0}` | Bytes: {1}'.format(description, copied))
+        return copied
+
+    def copy(self, in_fd, out_fd, count=None):
+        '''
+        Copy everything from in_fd to out_fd, or at most count bytes, and
+        return the number of bytes copied, using the fastest method the pair
+        of descriptors supports. O_DIRECT descriptors are always copied with
+        read() and write().
+        '''
+        if in_fd in self.direct or out_fd in self.direct:
+            return self._read_write(in_fd, out_fd, count)
+
+        in_pipe = self._is_pipe(in_fd)
+        out_pipe = self._is_pipe(out_fd)
+
+        # Throttled copies move a fraction of a second's worth per call
+        limiters = self.limited.get(in_fd, []) + self.limited.get(out_fd, [])
+        chunk_size = min([self.kernel_chunk_size] + [max(int(limiter.rate) // 4, 1) for limiter in limiters])
+        size = lambda copied: chunk_size if count is None else min(chunk_size, count - copied)
+        calls = []
+        if (in_pipe or out_pipe) and self.splice:
+            calls.append(lambda copied: self._syscall(self.splice, in_fd, None, out_fd, None, size(copied), 1))
+        if not (in_pipe or out_pipe) and self.copy_file_range:
+            calls.append(lambda copied: self._syscall(self.copy_file_range, in_fd, None, out_fd, None, size(copied), 0))
+        if not in_pipe and self.sendfile:
+            calls.append(lambda copied: self._syscall(self.sendfile, out_fd, in_fd, None, size(copied)))
+
+        # Unsupported methods fail on the first call, before any data moved
+        copied = 0
+        for call in calls:
+            try:
+                while count is None or copied < count:
+                    result = call(copied)
+                    if not result:
+                        break
+                    copied += result
+                    self._moved(in_fd, result)
+                    self._moved(out_fd, result)
+                return copied
+            except OSError, e:
+                if copied or e.errno not in self.unsupported_errors:
+                    raise
+
+        return self._read_write(in_fd, out_fd, count)
+
+    def _read_write(self, in_fd, out_fd, count=None):
+        '''
+        Copy in_fd to out_fd, or at most count bytes, through a single
+        reused buffer. When either descriptor uses O_DIRECT the buffer is
+        aligned and filled completely before it is written, and the
+        unaligned end of the input is written without O_DIRECT.
+        '''
+        direct = in_fd in self.direct or out_fd in self.direct
+        view = self._buffer(self.block_size, aligned=direct)
+        source = io.FileIO(in_fd, 'r', closefd=False)
+        copied = 0
+        while count is None or copied < count:
+            limit = len(view) if count is None else min(len(view), count - copied)
+            result = source.readinto(view[:limit])
+            while direct and result and result < limit:
+                more = source.readinto(view[result:limit])
+                if not more:
+                    break
+                result += more
+            if not result:
+                break
+            if out_fd in self.direct and result % self.direct_alignment:
+                self._set_direct(out_fd, False)
+            self._write(out_fd, view[:result])
+            copied += result
+            self._moved(in_fd, result)
+            self._moved(out_fd, result)
+        return copied
+
+    def _buffer(self, size, aligned=False):
+        '''
+        Return a writable memoryview of size bytes. An aligned buffer starts
+        at a multiple of direct_alignment and its size is rounded up to one,
+        as O_DIRECT requires.
+        '''
+        if not aligned:
+            return memoryview(bytearray(size))
+        size = -(-size // self.direct_alignment) * self.direct_alignment
+        memory = ctypes.create_string_buffer(size + self.direct_alignment)
+        offset = -ctypes.addressof(memory) % self.direct_alignment
+        return memoryview((ctypes.c_char * size).from_buffer(memory, offset))
+
+    def _open(self, path, flags, direct=False):
+        '''
+        Open path for a copy and apply the I/O policy and the read or write
+        limits to it. Only a descriptor opened with direct, copied by copy()
+        alone, is opened with O_DIRECT, falling back to the fadvise policy
+        when the file system does not support it.
+        '''
+        writing = flags & (os.O_WRONLY | os.O_RDWR) != 0
+        fd = None
+        if self.io_policy == 'direct' and direct:
+            try:
+                fd = os.open(path, flags | os.O_DIRECT, 0666)
+                self.direct.add(fd)
+            except OSError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self.app._output('Direct I/O is not supported for "{0}", dropping its cached pages instead.'.format(path), 3)
+
+        if fd is None:
+            fd = os.open(path, flags, 0666)
+            if self.io_policy != 'cache' and not self._is_pipe(fd):
+                if not writing:
+                    self._fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+                self.released[fd] = [writing, 0, 0]
+
+        limits = self.write_limits if writing else self.read_limits
+        if limits:
+            self.limited[fd] = limits
+        if self.stats:
+            side = 'target' if writing else 'source'
+            self.counted[fd] = ['written' if writing else 'read'] + (['compressed'] if self.compressed == side else [])
+        return fd
+
+    def _close(self, fd):
+        '''
+        Close a descriptor, dropping what is left of its cached pages.
+        '''
+        try:
+            self._release(fd, final=True)
+        finally:
+            self.direct.discard(fd)
+            self.released.pop(fd, None)
+            self.limited.pop(fd, None)
+            self.counted.pop(fd, None)
+            os.close(fd)
+
+    def _moved(self, fd, count):
+        '''
+        Account for count bytes read from or written to fd: count them,
+        wait for its rate limits and drop its cached pages.
+        '''
+        for stage in self.counted.get(fd, ()):
+            self.stats.add(stage, count)
+        for limiter in self.limited.get(fd, ()):
+            limiter.take(count)
+        self._release(fd)
+
+    def _release(self, fd, final=False):
+        '''
+        Drop the cached pages of a descriptor opened with the fadvise policy
+        behind its current offset, every release_size bytes or when final.
+        Read pages are dropped twice, one window apart, as the last pages
+        of a window may still be held by a pipe the first time. Written
+        pages must be clean to be dropped, their write back is started one
+        window ahead and waited for on the next one, so the copy keeps
+        running at device speed.
+        '''
+        entry = self.released.get(fd)
+        if not entry:
+            return
+        writing, released, flushed = entry
+        position = os.lseek(fd, 0, os.SEEK_CUR)
+        if position < flushed:
+            entry[1] = entry[2] = position
+            return
+        if position - flushed < self.release_size and not final:
+            return
+
+        end = position
+        if writing:
+            wait = SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER
+            self._sync_range(fd, flushed, position - flushed, wait if final else SYNC_FILE_RANGE_WRITE)
+            self._sync_range(fd, released, flushed - released, wait)
+            if not final:
+                end = flushed
+        if end > released:
+            self._fadvise(fd, released, end - released, POSIX_FADV_DONTNEED)
+        entry[1] = position if final else flushed
+        entry[2] = position
+
+    def _fadvise(self, fd, offset, length, advice):
+        '''
+        Give the kernel advice about a range of fd. Advice is only a hint,
+        it is silently skipped where unsupported.
+        '''
+        if self.posix_fadvise:
+            self.posix_fadvise(fd, offset, length, advice)
+
+    def _sync_range(self, fd, offset, length, flags):
+        '''
+        Start or wait for the write back of a range of fd with
+        sync_file_range(). Skipped where unsupported, fsync() is used
+        instead when waiting.
+        '''
+        if length <= 0:
+            return
+        try:
+            if self.sync_file_range:
+                self._syscall(self.sync_file_range, fd, offset, length, flags)
+                return
+        except OSError, e:
+            if e.errno not in self.unsupported_errors:
+                raise
+        if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+            os.fsync(fd)
+
+    def _set_direct(self, fd, enabled):
+        '''
+        Turn O_DIRECT on or off for an open descriptor.
+        '''
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        flags = flags | os.O_DIRECT if enabled else flags & ~os.O_DIRECT
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+    def digest(self, digests, name, in_fd, out_fd):
+        '''
+        Filter stage copying in_fd to out_fd unchanged, saving the sha256
+        hex digest of the data as digests[name] and its length as
+        digests[name + '_length'].
+        '''
+        digest = hashlib.sha256()
+        length = 0
+        view = self._buffer(self.block_size)
+        source = io.FileIO(in_fd, 'r', closefd=False)
+        while True:
+            count = source.readinto(view)
+            if not count:
+                break
+            digest.update(view[:count])
+            self._write(out_fd, view[:count])
+            length += count
+        digests[name] = digest.hexdigest()
+        digests[name + '_length'] = length
+
+    def meter(self, stages, limiters, in_fd, out_fd):
+        '''
+        Filter stage copying in_fd to out_fd no faster than limiters allow,
+        counting the bytes as stages.
+        '''
+        self.limited[in_fd] = list(limiters)
+        if self.stats:
+            self.counted[in_fd] = list(stages)
+        try:
+            return self.copy(in_fd, out_fd)
+        finally:
+            self.limited.pop(in_fd, None)
+            self.counted.pop(in_fd, None)
+
+    def read_range(self, path, offset, length, out_fd):
+        '''
+        Write length bytes of path starting at offset to out_fd.
+        '''
+        in_fd = self._open(path, os.O_RDONLY)
+        try:
+            os.lseek(in_fd, offset, os.SEEK_SET)
+            copied = self.copy(in_fd, out_fd, length)
+        finally:
+            self._close(in_fd)
+        if copied != length:
+            raise IOError(errno.EIO, 'Read {0} of {1} bytes at offset {2}, the source ended early'.format(copied, length, offset))
+        return copied
+
+    def write_at(self, path, offset, in_fd, truncate=False):
+        '''
+        Write in_fd to path starting at offset, flush it to disk and return
+        the number of bytes written. With truncate a regular file is
+        truncated at offset first, dropping whatever an interrupted write
+        left behind.
+        '''
+        regular = not os.path.exists(path) or os.path.isfile(path)
+        out_fd = self._open(path, os.O_WRONLY | (os.O_CREAT if regular else 0))
+        try:
+            if truncate and regular:
+                os.ftruncate(out_fd, offset)
+            os.lseek(out_fd, offset, os.SEEK_SET)
+            copied = self.copy(in_fd, out_fd)
+            os.fsync(out_fd)
+        finally:
+            self._close(out_fd)
+        return copied
+
+    def read_extents(self, path, extent_map, out_fd):
+        '''
+        Write the non-zero regions of path to out_fd and describe them in
+        extent_map. The whole of path is read and scanned for all-zero blocks
+        of sparse_block_size bytes. Backups only read LV snapshots, so holes
+        are not looked up with SEEK_DATA and SEEK_HOLE.
+        '''
+        in_fd = self._open(path, os.O_RDONLY)
+        try:
+            size = os.lseek(in_fd, 0, os.SEEK_END)
+            extents = []
+            self._scan_extents(in_fd, out_fd, 0, size, extents)
+        finally:
+            self._close(in_fd)
+
+        extent_map['size'] = size
+        extent_map['block_size'] = self.sparse_block_size
+        extent_map['extents'] = extents
+        return sum(length for offset, length in extents)
+
+    def read_changes(self, path, extent_map, manifest, base_manifest, sparse, out_fd):
+        '''
+        Write the chunks of path whose hash differs from base_manifest to
+        out_fd and describe them in extent_map, listing the hash of every
+        chunk in manifest. Without a base manifest every chunk has changed.
+        With sparse, changed chunks of all zeroes are not written but listed
+        as "zeroes" in extent_map. The chunk size is read from manifest.
+        '''
+        chunk_size = manifest['chunk_size']
+        base_chunks = base_manifest['chunks'] if base_manifest else []
+        zero_hash = hashlib.sha256('\0' * chunk_size).hexdigest()
+        chunks = []
+        extents = []
+        zeroes = []
+        size = 0
+
+        in_fd = self._open(path, os.O_RDONLY)
+        try:
+            for offset, chunk in self._blocks(in_fd, 0, size=chunk_size):
+                i = len(chunks)
+                zero = self._is_zero(chunk)
+                if zero and len(chunk) == chunk_size:
+                    chunks.append(zero_hash)
+                else:
+                    chunks.append(hashlib.sha256(chunk).hexdigest())
+                size = offset + len(chunk)
+
+                if i < len(base_chunks) and base_chunks[i] == chunks[i]:
+                    continue
+                if sparse and zero:
+                    self._add_extent(zeroes, offset, len(chunk))
+                    continue
+                self._write(out_fd, chunk)
+                self._add_extent(extents, offset, len(chunk))
+        finally:
+            self._close(in_fd)
+
+        manifest['size'] = size
+        manifest['hash'] = 'sha256'
+        manifest['chunks'] = chunks
+        extent_map['size'] = size
+        extent_map['block_size'] = chunk_size
+        extent_map['extents'] = extents
+        extent_map['zeroes'] = zeroes
+        return sum(length for offset, length in extents)
+
+    def write_extents(self, path, extent_map, in_fd, discard=False):
+        '''
+        Write the stream produced by read_extents() from in_fd back to path at
+        the offsets in extent_map and return the number of bytes written.
+        The regions between extents are zeroed on block devices, unless
+        discard is set and the whole device could be discarded to zeroes
+        first, see _discard(). A
+        regular file is truncated to leave them as holes. The extent map of
+        read_changes() describes changes to the image already in path, the
+        regions between its extents are left as they are and only its
+        "zeroes" are zeroed.
+        '''
+        changes = 'zeroes' in extent_map
+        regular = not os.path.exists(path) or os.path.isfile(path)
+        flags = os.O_WRONLY
+        if regular:
+            flags |= os.O_CREAT | (0 if changes else os.O_TRUNC)
+        out_fd = self._open(path, flags)
+        try:
+            zeroed = (regular and not changes) or (discard and self._discard(out_fd, path))
+            if changes and not zeroed:
+                for offset, length in extent_map['zeroes']:
+                    self._zero_range(out_fd, offset, length)
+
+            written = 0
+            position = 0
+            for offset, length in extent_map['extents']:
+                if not (zeroed or changes):
+                    self._zero_range(out_fd, position, offset - position)
+                os.lseek(out_fd, offset, os.SEEK_SET)
+                copied = self.copy(in_fd, out_fd, length)
+                if copied != length:
+                    raise IOError(errno.EIO, 'Stream ended at byte {0} of an extent of {1} bytes at offset {2}'.format(copied, length, offset))
+                written += copied
+                position = offset + length
+
+            if regular:
+                os.ftruncate(out_fd, extent_map['size'])
+            elif not (zeroed or changes):
+                self._zero_range(out_fd, position, extent_map['size'] - position)
+        finally:
+            self._close(out_fd)
+
+        if os.read(in_fd, 1):
+            raise IOError(errno.EIO, 'Stream is longer than its extent map')
+        return written
+
+    def write_nonzero(self, path, in_fd):
+        '''
+        Discard a block device once and write only the blocks of in_fd that
+        are not all zeroes, seeking over the others. A regular file is
+        truncated first and keeps the skipped blocks as holes. Returns the
+        number of bytes written. If the device can not be discarded to
+        zeroes, see _discard(), the all-zero blocks are zeroed with
+        _zero_range() instead of being skipped.
+        '''
+        regular = not os.path.exists(path) or os.path.isfile(path)
+        flags = os.O_WRONLY | (os.O_CREAT | os.O_TRUNC if regular else 0)
+        out_fd = self._open(path, flags)
+        try:
+            zeroed = regular or self._discard(out_fd, path)
+
+            written = 0
+            size = 0
+            zeroes = []
+            for offset, block in self._blocks(in_fd, 0):
+                size = offset + len(block)
+                if self._is_zero(block):
+                    if not zeroed:
+                        self._add_extent(zeroes, offset, len(block))
+                    continue
+                os.lseek(out_fd, offset, os.SEEK_SET)
+                self._write(out_fd, block)
+                written += len(block)
+                self._moved(out_fd, len(block))
+            for offset, length in zeroes:
+                self._zero_range(out_fd, offset, length)
+            if regular:
+                os.ftruncate(out_fd, size)
+        finally:
+            self._close(out_fd)
+        return written
+
+    def _scan_extents(self, in_fd, out_fd, start, end, extents):
+        '''
+        Read in_fd from start to end, write every block that is not all
+        zeroes to out_fd and append the written regions to extents, merging
+        adjacent regions.
+        '''
+        os.lseek(in_fd, start, os.SEEK_SET)
+        for offset, block in self._blocks(in_fd, start, end):
+            if self._is_zero(block):
+                continue
+            self._write(out_fd, block)
+            self._add_extent(extents, offset, len(block))
+
+    def _add_extent(self, extents, offset, length):
+        '''
+        Append an [offset, length] region to extents, merging it with the
+        previous region if they are adjacent.
+        '''
+        if extents and sum(extents[-1]) == offset:
+            extents[-1][1] += length
+        else:
+            extents.append([offset, length])
+
+    def _blocks(self, in_fd, start, end=None, size=None):
+        '''
+        Read in_fd up to end, or to the end of input, and yield (offset,
+        block) pairs of size bytes, sparse_block_size by default, counted
+        from start. The blocks are views of a reused buffer, only valid
+        until the next one.
+        '''
+        granule = size or self.sparse_block_size
+        buffer = bytearray(max(self.block_size // granule, 1) * granule)
+        view = memoryview(buffer)
+        source = io.FileIO(in_fd, 'r', closefd=False)
+
+        position = start
+        while end is None or position < end:
+            # Fill the buffer, pipes return partial reads
+            limit = len(buffer) if end is None else min(len(buffer), end - position)
+            count = 0
+            while count < limit:
+                result = source.readinto(view[count:limit])
+                if not result:
+                    break
+                count += result
+            for i in xrange(0, count, granule):
+                yield position + i, view[i:min(i + granule, count)]
+            position += count
+            self._moved(in_fd, count)
+            if count < limit:
+                break
+
+    def _is_zero(self, block):
+        granule = len(self.zero_block)
+        for i in xrange(0, len(block), granule):
+            part = block[i:i + granule]
+            if part != self.zero_block[:len(part)]:
+                return False
+        return True
+
+    def _write(self, fd, data):
+        '''
+        Write all of data to fd.
+        '''
+        offset = 0
+        while offset < len(data):
+            offset += os.write(fd, data[offset:])
+
+    def _discard(self, fd, path):
+        '''
+        Discard every block of the block device at path, e.g. unmapping the
+        blocks of a thin logical volume, which then read back as zeroes.
+        Returns False without discarding if the device does not support
+        discards, or does not guarantee discarded blocks read back as zeroes,
+        see _discard_zeroes().
+        '''
+        if not self._discard_zeroes(fd, path):
+            self.app._output('Discarded blocks of "{0}" may not read back as zeroes, zeroing them instead.'.format(path), 2)
+            return False
+        size = os.lseek(fd, 0, os.SEEK_END)
+        try:
+            fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', 0, size))
+        except IOError, e:
+            if e.errno not in self.unsupported_errors + (errno.ENOTTY,):
+                raise
+            self.app._output('Discards are not supported, writing every block instead.', 2)
+            return False
+        return True
+
+    def _discard_zeroes(self, fd, path):
+        '''
+        Return True if discarded blocks of a block device read back as
+        zeroes: the device is a thin logical volume, or the kernel reports
+        discard_zeroes_data for it.
+        '''
+        lv_tuple = self.app._find_lv_by_path(path)
+        if lv_tuple and (self.app.lv_info(lv_tuple, 'Attr', False) or '').startswith('V'):
+            return True
+
+        rdev = os.fstat(fd).st_rdev
+        try:
+            with open('/sys/dev/block/{0}:{1}/queue/discard_zeroes_data'.format(os.major(rdev), os.minor(rdev))) as flag:
+                return flag.read().strip() == '1'
+        except IOError:
+            return False
+
+    def _zero_range(self, fd, offset, length):
+        '''
+        Zero length bytes of a block device at offset. The device does this
+        itself with BLKZEROOUT where supported, otherwise zeroes are written.
+        '''
+        if length <= 0:
+            return
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            return
+        except IOError, e:
+            if e.errno not in self.unsupported_errors + (errno.ENOTTY,):
+                raise
+
+        zeroes = memoryview(bytearray(min(self.block_size, length)))
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length > 0:
+            length -= os.write(fd, zeroes[:min(len(zeroes), length)])
+
+    def _syscall(self, function, *args):
+        '''
+        Call a C library function, retrying on EINTR. Errors are raised as
+        OSError.
+        '''
+        while True:
+            result = function(*args)
+            if result >= 0:
+                return result
+            error = ctypes.get_errno()
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+
+    def _is_pipe(self, fd):
+        return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+    def _pipe(self):
+        '''
+        Return a (read, write) pipe, enlarged to pipe_size when possible.
+        '''
+        read_fd, write_fd = os.pipe()
+        try:
+            fcntl.fcntl(write_fd, 1031, self.pipe_size)
+        except IOError:
+            pass
+        return read_fd, write_fd
+
+    def _spawn(self, command, stdin, processes, output=True):
+        '''
+        Start a command reading from stdin and return a descriptor of its
+        output. The stdin descriptor is handed over to the command, it is
+        closed here even if the command fails to start.
+        '''
+        read_fd = write_fd = None
+        if output:
+            read_fd, write_fd = self._pipe()
+        stderr = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(command,
+                                       stdin=stdin if stdin is not None else open(os.devnull),
+                                       stdout=write_fd if output else stderr,
+                                       stderr=stderr,
+                                       close_fds=True)
+        finally:
+            if stdin is not None:
+                os.close(stdin)
+            if write_fd is not None:
+                os.close(write_fd)
+        processes.append((self._describe(command), process, stderr))
+        return read_fd
+
+    def _start(self, func, in_fd, threads, description):
+        '''
+        Run func(in_fd, out_fd), or func(out_fd) if in_fd is None, in a
+        thread and return a descriptor of its output. The thread closes both
+        descriptors when func returns.
+        '''
+        try:
+            read_fd, write_fd = self._pipe()
+        except BaseException:
+            if in_fd is not None:
+                os.close(in_fd)
+            raise
+        errors = []
+
+        def run():
+            try:
+                if in_fd is None:
+                    func(write_fd)
+                else:
+                    func(in_fd, write_fd)
+            except BaseException, e:
+                errors.append(e)
+            finally:
+                if in_fd is not None:
+                    self._close(in_fd)
+                os.close(write_fd)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        threads.append((description, thread, errors))
+        return read_fd
+
+    def _wait(self, processes, threads):
+        '''
+        Wait for every stage to finish and return a list of failures and a
+        list of stages stopped by a broken pipe.
+        '''
+        errors = []
+        broken = []
+        for description, thread, thread_errors in threads:
+            thread.join()
+            for e in thread_errors:
+                if isinstance(e, OSError) and e.errno == errno.EPIPE:
+                    broken.append('{0}: {1}'.format(description, str(e)))
+                else:
+                    errors.append('{0}: {1}'.format(description, str(e)))
+        for description, process, stderr in processes:
+            process.wait()
+            stderr.seek(0)
+            message = self.app._truncate(stderr.read().strip())
+            stderr.close()
+            if process.returncode == -signal.SIGPIPE:
+                broken.append('{0}: broken pipe'.format(description))
+            elif process.returncode != 0:
+                errors.append('{0}: exit status {1}: {2}'.format(description, process.returncode, message))
+        return errors, broken
+
+    def _describe(self, stage):
+        if isinstance(stage, list):
+            return ' '.join(str(token) for token in stage)
+        if isinstance(stage, functools.partial):
+            return ' '.join([self._describe(stage.func)] + [arg for arg in stage.args if isinstance(arg, basestring)])
+        if callable(stage):
+            return getattr(stage, '__name__', 'filter')
+        return stage
+
+# ==============================================================================
+# Parallel bzip2 Decompression
+# ==============================================================================
+BZIP2_BLOCK_MAGIC = 0x314159265359
+BZIP2_END_MAGIC = 0x177245385090
+
+def bzip2_decompress_block(job):
+    '''
+    Decompress a single bzip2 block in a worker process. job is a tuple
+    (level, crc, data, start_bit, end_bit) where the block is the bits
+    [start_bit, end_bit) of data, starting at the block magic. The block is
+    shifted to a byte boundary and wrapped in a stream header and end of
+    stream trailer, making it a standalone single block bzip2 stream.
+    Returns the decompressed data, or None if the bits are not a valid
+    block, e.g. because they were cut at a false block magic.
+    '''
+    level, crc, data, start_bit, end_bit = job
+    bits = end_bit - start_bit
+    number = int(binascii.hexlify(data), 16) >> (len(data) * 8 - end_bit)
+    number &= (1 << bits) - 1
+
+    # The combined CRC of a single block stream is the block CRC
+    number = (((number << 48) | BZIP2_END_MAGIC) << 32) | crc
+    total = bits + 80
+    padding = -total % 8
+    body = binascii.unhexlify('%0*x' % ((total + padding) // 4, number << padding))
+    try:
+        return bz2.decompress('BZh' + level + body)
+    except (IOError, EOFError, ValueError):
+        return None
+
+class Bzip2Splitter:
+    '''
+    Split bzip2 data, read with read(size), into its compressed blocks.
+
+    bzip2 blocks are not byte aligned. They start with a 48 bit block magic
+    at any bit offset and end where the next block magic or the end of
+    stream magic starts. Both are found by searching for the five whole
+    bytes the magic covers at each of the eight bit offsets, then checking
+    the bits around them. Data written by pbzip2 and other parallel
+    compressors holds several streams, each with its own header.
+
+    Compressed data can contain a magic by chance. A false block magic cuts
+    a block in two, neither part decompresses, and the consumer merges them
+    again, see merge(). A false end of stream magic is recognized because
+    it is not followed by the end of the data or by another stream.
+    '''
+    chunk_size = 4 * 1024 ** 2
+
+    def __init__(self, read):
+        self.read = read
+        self.buffer = ''
+        self.base = 0
+        self.eof = False
+        self.scanned = 0
+        self.markers = []
+        self.needles = []
+        for kind, magic in (('block', BZIP2_BLOCK_MAGIC), ('end', BZIP2_END_MAGIC)):
+            for shift in range(8):
+                pattern = binascii.unhexlify('%014x' % (magic << (8 - shift)))
+                self.needles.append((kind, magic, shift, pattern[1:6]))
+
+    def events(self):
+        '''
+        Generate ('block', job) for every block, with job as passed to
+        bzip2_decompress_block(), and ('end', crc) with the stored combined
+        CRC at the end of every stream.
+        '''
+        position = 0
+        while True:
+            # Read stream header
+            self._fill(position + 4)
+            header = self._bytes(position, position + 4)
+            if not header and position:
+                return
+            if len(header) < 4 or not header.startswith('BZh') or header[3] not in '123456789':
+                raise IOError('Data at byte {0} is not a bzip2 stream.'.format(position))
+            level = header[3]
+
+            # The first block, or the end of an empty stream, follows the header
+            marker = self._next_marker((position + 4) * 8)
+            if not marker or marker[0] != (position + 4) * 8:
+                raise IOError('Data at byte {0} is not a bzip2 stream.'.format(position))
+
+            while True:
+                bit, kind = marker
+                if kind == 'end':
+                    self._fill((bit + 80 + 7) // 8)
+                    crc = self._bits(bit + 48, 32)
+                    if crc is None:
+                        raise IOError('The bzip2 stream is truncated.')
+                    position = (bit + 80 + 7) // 8
+                    yield ('end', crc)
+                    break
+
+                # A block ends at the next block magic or at a real end of
+                # stream magic
+                marker = self._next_marker(bit + 80)
+                while marker and marker[1] == 'end' and not self._is_stream_end(marker[0]):
+                    marker = self._next_marker(marker[0] + 1)
+                if not marker:
+                    raise IOError('The bzip2 stream is truncated.')
+
+                crc = self._bits(bit + 48, 32)
+                first = bit // 8
+                last = (marker[0] + 7) // 8
+                data = self._bytes(first, last)
+                yield ('block', (level, crc, data, bit - first * 8, marker[0] - first * 8))
+                self._discard(marker[0] // 8)
+
+    def merge(self, job, next_job):
+        '''
+        Return a job covering two adjacent jobs, used when a false block
+        magic cut a block in two. The combined job is a single block, with
+        the CRC stored after the first magic.
+        '''
+        level, crc, data, start_bit, end_bit = job
+        next_data, next_start_bit, next_end_bit = next_job[2:]
+        offset = end_bit // 8
+        return (level, crc, data[:offset] + next_data, start_bit, offset * 8 + next_end_bit)
+
+    def _is_stream_end(self, bit):
+        '''
+        An end of stream magic is real if the data ends after its CRC and
+        padding, or if a new stream with a first marker follows.
+        '''
+        position = (bit + 80 + 7) // 8
+        self._fill(position + 11)
+        following = self._bytes(position, position + 4)
+        if not following:
+            return True
+        if len(following) < 4 or not following.startswith('BZh') or following[3] not in '123456789':
+            return False
+        marker = self._bits((position + 4) * 8, 48)
+        return marker in (BZIP2_BLOCK_MAGIC, BZIP2_END_MAGIC)
+
+    def _next_marker(self, bit):
+        '''
+        Return (bit, kind) of the first marker at or after bit, or None.
+        '''
+        while True:
+            for marker in self.markers:
+                if marker[0] >= bit:
+                    return marker
+            if self.eof:
+                return None
+            self._fill(len(self.buffer) + self.base + self.chunk_size)
+
+    def _fill(self, end):
+        '''
+        Read until the buffer holds data up to byte end, scanning new data
+        for markers.
+        '''
+        while not self.eof and self.base + len(self.buffer) < end:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+            self.buffer += chunk
+            self._scan()
+
+    def _scan(self):
+        '''
+        Find markers in buffered data not scanned yet. A marker spans up to
+        seven bytes, so the last six bytes wait for more data unless the
+        data has ended.
+        '''
+        low = max(self.scanned - self.base, 0)
+        high = len(self.buffer) - 7
+        found = []
+        for kind, magic, shift, needle in self.needles:
+            index = self.buffer.find(needle, low + 1)
+            while index != -1 and index - 1 <= high:
+                start = index - 1
+                value = int(binascii.hexlify(self.buffer[start:start + 7]), 16)
+                if (value >> (8 - shift)) & 0xffffffffffff == magic:
+                    found.append(((self.base + start) * 8 + shift, kind))
+                index = self.buffer.find(needle, index + 1)
+        if high >= low:
+            self.scanned = self.base + high + 1
+        self.markers = sorted(set(self.markers + found))
+
+    def _discard(self, position):
+        '''
+        Drop buffered data and markers before byte position.
+        '''
+        if position > self.base:
+            self.buffer = self.buffer[position - self.base:]
+            self.base = position
+            self.markers = [marker for marker in self.markers if marker[0] >= position * 8]
+
+    def _bytes(self, first, last):
+        return self.buffer[first - self.base:last - self.base]
+
+    def _bits(self, bit, count):
+        first = bit // 8
+        last = (bit + count + 7) // 8
+        data = self._bytes(first, last)
+        if len(data) < last - first:
+            return None
+        value = int(binascii.hexlify(data), 16)
+        return (value >> (len(data) * 8 - (bit - first * 8) - count)) & ((1 << count) - 1)
+
+# ==============================================================================
+# Chunk Store
+# ==============================================================================
+class ChunkStore:
+    '''
+    Content-addressed store of disk image chunks shared by backups.
+
+    Images are split into fixed size chunks named by the sha256 hash of their
+    data, so a chunk found in several images, or several times in one, is
+    stored once. Chunks are compressed with zlib in-process and hashed and
+    compressed by a pool of threads, both release the GIL. refcounts.json
+    counts the chunk lists that reference each chunk. Chunks already in the
+    store are only reused when their size matches the compressed data, or,
+    with verify, when they decompress to data matching their hash.
+    '''
+    compression_level = 6
+
+    def __init__(self, app, path, workers=1, verify=False):
+        self.app = app
+        self.path = path
+        self.workers = max(workers, 1)
+        self.verify = verify
+
+    def write_chunks(self, manifest, in_fd):
+        '''
+        Split in_fd into chunks of manifest['chunk_size'] bytes, store the
+        chunks that are not in the store yet and list the hash of every chunk
+        in manifest. Returns the number of bytes added to the store.
+        '''
+        chunk_size = manifest['chunk_size']
+        source = io.FileIO(in_fd, 'r', closefd=False)
+        chunks = []
+        written = [0]
+        size = 0
+
+        def collect(results, final=False):
+            while len(results) > (0 if final else 2 * self.workers):
+                digest, count = results.popleft().get()
+                chunks.append(digest)
+                written[0] += count
+
+        self._makedirs(os.path.join(self.path, 'chunks'))
+        pool = multiprocessing.pool.ThreadPool(self.workers)
+        try:
+            results = collections.deque()
+            while True:
+                data = source.read(chunk_size)
+                # Pipes return partial reads
+                while data and len(data) < chunk_size:
+                    more = source.read(chunk_size - len(data))
+                    if not more:
+                        break
+                    data += more
+                if not data:
+                    break
+                size += len(data)
+                results.append(pool.apply_async(self.put, (data,)))
+                collect(results)
+            collect(results, final=True)
+        finally:
+            pool.terminate()
+
+        manifest['size'] = size
+        manifest['hash'] = 'sha256'
+        manifest['chunks'] = chunks
+        return written[0]
+
+    def read_chunks(self, manifest, out_fd):
+        '''
+        Write the chunks listed in manifest to out_fd, in order.
+        '''
+        size = [0]
+
+        def write(results, final=False):
+            while len(results) > (0 if final else 2 * self.workers):
+                data = results.popleft().get()
+                view = memoryview(data)
+                offset = 0
+                while offset < len(data):
+                    offset += os.write(out_fd, view[offset:])
+                size[0] += len(data)
+
+        pool = multiprocessing.pool.ThreadPool(self.workers)
+        try:
+            results = collections.deque()
+            for digest in manifest['chunks']:
+                results.append(pool.apply_async(self.get, (digest,)))
+                write(results)
+            write(results, final=True)
+        finally:
+            pool.terminate()
+
+        if size[0] != manifest['size']:
+            raise IOError(errno.EIO, 'The chunks add up to {0} bytes instead of {1} bytes'.format(size[0], manifest['size']))
+        return size[0]
+
+    def put(self, data):
+        '''
+        Store a chunk unless a valid copy is already stored and return its
+        hash and the number of bytes written. A chunk is written to a
+        temporary file, flushed to disk and renamed, so neither concurrent
+        backups nor a crash leave a partial chunk under its name. A stored
+        chunk cut short by a crash before this was the case is replaced.
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        compressed = None
+        if os.path.exists(path):
+            if self.verify:
+                try:
+                    self.get(digest)
+                    return digest, 0
+                except (IOError, zlib.error):
+                    pass
+            else:
+                compressed = zlib.compress(data, self.compression_level)
+                if os.path.getsize(path) == len(compressed):
+                    return digest, 0
+            self.app._output('Replacing damaged chunk in the chunk store: "{0}"'.format(path), 1)
+
+        self._makedirs(os.path.dirname(path))
+        if compressed is None:
+            compressed = zlib.compress(data, self.compression_level)
+        temp_path = '{0}.{1}-{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'wb') as fh:
+            fh.write(compressed)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(temp_path, path)
+        self._fsync_directory(os.path.dirname(path))
+        return digest, len(compressed)
+
+    def get(self, digest):
+        '''
+        Return the data of a chunk, checking it against its hash.
+        '''
+        path = self._chunk_path(digest)
+        with open(path, 'rb') as fh:
+            data = zlib.decompress(fh.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError(errno.EIO, 'Chunk does not match its hash, the data is corrupt: "{0}"'.format(path))
+        return data
+
+    def add_references(self, digests):
+        '''
+        Add a reference to each chunk in digests. The counts are updated
+        under an exclusive lock, so concurrent backups can share the store.
+        '''
+        path = os.path.join(self.path, 'refcounts.json')
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            refcounts = {}
+            if os.path.exists(path):
+                with open(path) as fh:
+                    refcounts = json.load(fh)
+            for digest in digests:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+            temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'w') as fh:
+                json.dump(refcounts, fh, separators=(',', ':'))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(temp_path, path)
+            self._fsync_directory(self.path)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.path, 'chunks', digest[:2], digest)
+
+    def _fsync_directory(self, path):
+        '''
+        Flush a directory to disk, making a rename in it durable.
+        '''
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
 # ==============================================================================
 # Main Application
 # ==============================================================================
 class Vmpy:
 
+    # VM attributes with a secondary index in data['vm_index'], used by
+    # vm_info_search(), vm_info_is_unique() and the unique value allocators.
+    vm_index_attributes = ('name', 'uuid', 'mac', 'disk')
+
+    # LVM report fields as (lvm field name, short title, is a size in bytes).
+    # Short titles match the column headings printed by `vgs` and `lvs`.
+    vg_report_fields = [
+        ('vg_name', 'VG', False),
+        ('vg_size', 'VSize', True),
+        ('vg_free', 'VFree', True),
+        ('vg_extent_size', 'Ext', True),
+        ('vg_seqno', 'Seq', False)
+    ]
+    lv_report_fields = [
+        ('lv_name', 'LV', False),
+        ('vg_name', 'VG', False),
+        ('lv_path', 'Path', False),
+        ('lv_size', 'LSize', True),
+        ('lv_kernel_major', 'KMaj', False),
+        ('lv_kernel_minor', 'KMin', False),
+        ('lv_attr', 'Attr', False),
+        ('origin', 'Origin', False),
+        ('devices', 'Devices', False)
+    ]
+
+    # Logical volume fields that `lvchange -ay/-an` changes without bumping
+    # the volume group seqno. They are not cached, but read again each run.
+    lv_state_fields = [
+        ('vg_name', 'VG', False),
+        ('lv_name', 'LV', False),
+        ('lv_kernel_major', 'KMaj', False),
+        ('lv_kernel_minor', 'KMin', False),
+        ('lv_attr', 'Attr', False)
+    ]
+
+    # Compression codecs as name: (image file extension, (lowest level,
+    # highest level), programs). Programs able to read and write the format
+    # are listed as (command, thread count option), multi-threaded first. The
+    # first one installed is used, so images are interchangeable between
+    # hosts with different programs installed.
+    compression_codecs = {
+        'bzip2': ('.bzip2', (1, 9), [('pbzip2', '-p{0}'), ('lbzip2', '-n{0}'), ('bzip2', None)]),
+        'gzip': ('.gzip', (1, 9), [('pigz', '-p{0}'), ('gzip', None)]),
+        'xz': ('.xz', (0, 9), [('xz', '-T{0}')]),
+        'zstd': ('.zstd', (1, 19), [('zstd', '-T{0}')]),
+        'lz4': ('.lz4', (1, 12), [('lz4', None)])
+    }
+
+    # Block sizes tried by --block-size auto, and the number of bytes each
+    # one copies during calibration
+    block_size_candidates = ['64K', '256K', '1M', '4M']
+    block_size_probe_size = '16M'
+    default_block_size = '512K'
+
     # ==========================================================================
     # Setup aplication environment
     # ==========================================================================
@@ -191,11 +1993,14 @@ class Vmpy:
         # Set private variables.
         # Note: self.status is set in @sys_exit decorator
         self.data = {}
-        self.data['vg_info'] = {}
-        self.data['lv_info'] = {}
-        self.data['vm_info'] = {}
+        self._reset_info()
+        self.info_transactions = 0
         self.now = str(datetime.now().strftime('%Y%m%d-%H%M'))
 
+        # Let pipeline stages die on SIGPIPE, set once before any worker
+        # thread starts.
+        catch_sigpipe()
+
         # Process variables.
         self.error_file = self.error_file.replace('<datetime>', self.now)
 
@@ -206,10 +2011,48 @@ class Vmpy:
         # Save arguments for detailed error logs.
         self.status['args'] = self.args.__dict__
 
-        # Load environmental variables like defined vms, logical volumes, and
-        # volume groups.
-        self._output('Loading environment info', 2)
-        self.load_info()
+        # Connect to the hypervisor.
+        self.hypervisor = self._load_hypervisor()
+
+        # Load the environment cache from previous runs.
+        self.cache = self._load_cache()
+
+        # Block sizes chosen by --block-size auto, reported in the log
+        self.block_sizes = {}
+        self.block_sizes_lock = threading.Lock()
+        if self.args.block_size == 'auto':
+            self.status['block_sizes'] = self.block_sizes
+
+        # Token buckets of the --*-limit options, shared by all transfers
+        self.rate_limiters = {}
+        self.rate_limiters_lock = threading.Lock()
+
+        # Logical volumes created by this run, which hold no data yet and may
+        # be overwritten by block size calibration, see _probe_path()
+        self.created_lvs = set()
+
+        # Checkpoint of a backup or import saved in chunks, see
+        # _save_checkpoint()
+        self.checkpoint = None
+        self.checkpoint_lock = threading.Lock()
+
+        # Control socket of the persistent ssh connection to --remote, see
+        # _remote_connect()
+        self.remote_control = None
+        self.remote_lock = threading.Lock()
+
+        # Remote backup directories probed this run, see _remote_manifest()
+        self.remote_manifests = {}
+
+        # Running transfers and the thread reporting their progress
+        self.progress = []
+        self.progress_lock = threading.Lock()
+        self.progress_stop = threading.Event()
+        self.progress_thread = None
+
+        # Environmental variables like defined vms, logical volumes, and
+        # volume groups are loaded on demand by the *_info() interface
+        # methods, scoped to what the action requests.
 
         # Now that basic setup is loaded, decide which action to take.
         # We'll wrap actions into try/except/else to guarantee logging of
@@ -291,7 +2134,19 @@ class Vmpy:
         config = parser.add_argument_group('Configuration options')
         config.add_argument('--configure', action="store_const", const=True, default=False, help='Run interactive configuration setup. Note: this is run automatically the first time.')
         config.add_argument('--list-config', action="store_const", const=True, default=False, help='List current configuration values.')
-        config.add_argument('--block-size', action="store", default='512K', help='Set the blocksize for dd operations, i.e. `dd bs=<value> ...`')
+        config.add_argument('--block-size', action="store", default=self.default_block_size, help='Set the buffer size for disk image copies that can not be done by the kernel, and for remote `dd bs=<value> ...` commands. "auto" measures the throughput of a few sizes once per volume group, file system and ssh remote, caching the results. Default is 512K.')
+        config.add_argument('--io-policy', action="store", choices=['cache', 'fadvise', 'direct'], default='cache', help='How disk image copies use the page cache. "fadvise" asks for sequential readahead and drops the cached pages of the disks and images behind the copy, "direct" bypasses the cache with O_DIRECT for whole image copies and uses "fadvise" for sparse, incremental and chunk store copies. Both keep large copies from evicting the working set of a busy host. Default "cache" leaves caching to the kernel.')
+        config.add_argument('--read-limit', action="append", metavar='[<target>=]<rate>', help='Limit the rate disk image data is read from local disks and files, per second, e.g. 50M. A target restricts the limit to a volume group, e.g. vg0=50M, or to a device or directory path. May be given more than once, all limits that apply are enforced. Concurrent disk streams share a limit.')
+        config.add_argument('--write-limit', action="append", metavar='[<target>=]<rate>', help='Limit the rate disk image data is written to local disks and files, per second. Targets work like --read-limit.')
+        config.add_argument('--network-limit', action="append", metavar='[<target>=]<rate>', help='Limit the rate disk image data is sent to or received from a --remote over ssh, per second. A target restricts the limit to a remote, as user@host or host.')
+        config.add_argument('--progress-interval', action="store", type=int, default=60, help='Seconds between progress reports of running disk image transfers, with the bytes and throughput of every stage and the estimated time left. The counters are saved in the JSON run log. 0 disables the reports. Default is 60.')
+        config.add_argument('--jobs', action="store", type=int, default=8, help='Maximum number of concurrent `virsh` calls when loading environment information with the virsh backend. Default is 8.')
+        config.add_argument('--streams-per-pv', action="store", type=int, default=1, help='Maximum number of concurrent disk image streams reading from or writing to the same LVM physical volume. Disks on separate physical volumes are always copied concurrently. Default is 1.')
+        config.add_argument('--ssh-streams', action="store", type=int, default=1, help='Number of concurrent ssh connections a disk image is sent over to or received from a --remote. A backup splits each disk into one byte range per connection, compressed on its own and joined to a single image on the remote, and imports read the chunks of such an image in parallel. The connections of one disk count as a single stream against --streams-per-pv. Helps on high-latency links that limit the throughput of a single connection. Default is 1.')
+        config.add_argument('--hypervisor', action="store", choices=['auto', 'libvirt', 'virsh'], default='auto', help='Hypervisor backend. "libvirt" uses the libvirt Python bindings over one persistent connection, "virsh" calls the `virsh` command. Default "auto" uses libvirt when the bindings are installed.')
+        config.add_argument('--connect', action="store", metavar='<uri>', help='Hypervisor connection URI, e.g. qemu:///system or test:///default. Without this the libvirt default is used.')
+        config.add_argument('--compression-threads', action="store", type=int, default=0, help='Number of threads used by multi-threaded compression programs, e.g. pbzip2, pigz, `xz -T` or `zstd -T`. Default 0 uses one thread per CPU.')
+        config.add_argument('--no-cache', action="store_const", const=True, default=False, help='Do not read or write the environment cache file. By default parsed LVM and VM information is cached between runs and reused while unchanged.')
 
         # Command arguments
         command = parser.add_argument_group('Misc command-line options')
@@ -309,11 +2164,21 @@ class Vmpy:
         backup_required.add_argument('source', help='Target directory. Will attempt to create directory if it does not exist. A timestamp directory will be created inside the target directory and the backup files will be saved inside it.')
 
         backup_optional = backup_subparser.add_argument_group('Backup optional arguments')
+        backup_optional.add_argument('--resume', action="store_const", const=True, default=False, help='Continue an interrupted --checkpoint-size backup of the VM to the same location from the last saved chunk, reading the LV snapshots it kept.')
+        backup_optional.add_argument('--discard-checkpoint', action="store_const", const=True, default=False, help='Give up an interrupted --checkpoint-size backup instead of resuming it: remove the LV snapshots it kept and its checkpoint file, then start a new backup.')
         backup_optional.add_argument('--remote', action="store", metavar='<ssh-connection-information>', help='Backup file to a remote location over SSH.')
 
         backup_config = backup_subparser.add_argument_group('Backup configuration options')
-        backup_config.add_argument('--compression', action="store", choices=['bzip2', 'gzip', 'none'], default='bzip2', help='Backup file to a remote location over SSH.')
-        backup_config.add_argument('-I', '--identity-file', action="store", help='Identity file to use for remote ssh/scp connection.')
+        backup_config.add_argument('--compression', action="store", choices=sorted(self.compression_codecs) + ['none'], default='bzip2', help='Disk image compression codec. Multi-threaded programs are used when installed, e.g. pbzip2 for bzip2 and pigz for gzip. Default is bzip2.')
+        backup_config.add_argument('--compression-level', action="store", type=int, help='Compression level, e.g. 1-9 for bzip2, gzip and xz (0-9), 1-19 for zstd or 1-12 for lz4. Without this the default level of the compression program is used.')
+        backup_config.add_argument('--sparse', action="store_true", help='Only save the non-zero regions of each disk. Every block of the LV snapshot is read and all-zero blocks are skipped. Only logical volume backed disks can be backed up, file-backed disks are not supported. The regions are listed in an extent map saved next to each disk image and the skipped regions are zeroed again on import.')
+        backup_config.add_argument('--incremental', action="store_true", help='Save a hash of every chunk of each disk in a chunk manifest, so later backups can be based on this one.')
+        backup_config.add_argument('--base', action="store", metavar='<backup-directory>', help='Make an incremental backup based on an earlier --incremental backup of the VM in this directory, on the same host as the new backup. Only chunks that changed since then are saved. Import and clone rebuild the disks from the whole chain of backups, which must be kept.')
+        backup_config.add_argument('--chunk-store', action="store", metavar='<store-directory>', help='Save disk images to a deduplicating chunk store shared by backups, storing each unique chunk once. Chunks are compressed with zlib, --compression does not apply. The backup directory lists the chunks of each disk. Local backups only.')
+        backup_config.add_argument('--verify-chunks', action="store_true", help='Decompress and hash every chunk already in the --chunk-store before reusing it, instead of only checking its size. Damaged chunks are replaced.')
+        backup_config.add_argument('--chunk-size', action="store", default='4M', help='Chunk size of the chunk manifest and the chunk store. A --base backup uses the chunk size of its base instead. Default is 4M.')
+        backup_config.add_argument('--checkpoint-size', action="store", metavar='<size>', help='Save each disk image in chunks of this size, e.g. 1G, compressed one by one and appended to the image. Every saved chunk is recorded with its checksums in meta.txt and in the checkpoint file ./vmpy-checkpoint.json. An interrupted backup keeps its LV snapshots, so it can be continued with --resume, and imports of the backup can be resumed as well. Can not be combined with --sparse, --incremental or --chunk-store.')
+        backup_config.add_argument('-I', '--identity-file', action="store", help='Identity file to use for remote ssh connection.')
 
         # Import subparser
         import_subparser = subparsers.add_parser('import', description='', help='vm.py import')
@@ -323,8 +2188,10 @@ class Vmpy:
 
         import_optional = import_subparser.add_argument_group('Import optional arguments')
         import_optional.add_argument('--overwrite', action="store_const", const=True, default=False, help='Overwite any existing VM or VM raw storage logical volume. Default value is False, which raises an exception if either already exists.')
+        import_optional.add_argument('--resume', action="store_const", const=True, default=False, help='Continue an interrupted import of a --checkpoint-size backup from the last written chunk, keeping the logical volumes already created.')
         import_optional.add_argument('--remote', action="store", metavar='<ssh-connection-information>', help='Import VM backup from a remote location over SSH.')
-        import_optional.add_argument('-I', '--identity-file', action="store", help='Identity file to use for remote ssh/scp connection.')
+        import_optional.add_argument('--discard', action="store_const", const=True, default=False, help='Discard the target logical volumes before importing and skip writing all-zero blocks. Keeps thin logical volumes thin. On storage that does not read discarded blocks back as zeroes, all-zero blocks are zeroed instead.')
+        import_optional.add_argument('-I', '--identity-file', action="store", help='Identity file to use for remote ssh connection.')
 
         import_config = import_subparser.add_argument_group('Target VM configuration options')
         import_config.add_argument('--volume-group', action="store", help='Specify a target volume group. Without this the default is the source VMs value.')
@@ -345,7 +2212,8 @@ class Vmpy:
         clone_optional.add_argument('--overwrite', action="store_const", const=True, default=False, help='Overwite any existing VM or VM raw storage logical volume. Default value is False, which raises an exception if either already exists.')
         clone_optional.add_argument('--live', action="store_const", const=True, default=False, help='Clone a running VM instead of cloning from a stored LVM image file and XML config.')
         clone_optional.add_argument('--remote', action="store", metavar='<ssh-connection-information>', help='Clone a VM backup from a remote location over SSH.')
-        clone_optional.add_argument('-I', '--identity-file', action="store", help='Identity file to use for remote ssh/scp connection.')
+        clone_optional.add_argument('--discard', action="store_const", const=True, default=False, help='Discard the target logical volumes before cloning and skip writing all-zero blocks. Keeps thin logical volumes thin. On storage that does not read discarded blocks back as zeroes, all-zero blocks are zeroed instead.')
+        clone_optional.add_argument('-I', '--identity-file', action="store", help='Identity file to use for remote ssh connection.')
 
         clone_config = clone_subparser.add_argument_group('Target VM configuration options')
         clone_config.add_argument('--volume-group', action="store", help='Specify a target volume group. Without this the default is the source VMs value.')
@@ -372,6 +2240,58 @@ class Vmpy:
         if not 'live' in parsed or not parsed.live:
             parsed.source = parsed.source.rstrip('/') + '/'
 
+        # Verify block size
+        if parsed.block_size != 'auto' and self._size_to_bytes(parsed.block_size) < 1:
+            self._raise('The --block-size value must be at least 1 byte: "{0}"'.format(parsed.block_size))
+
+        # Verify rate limits
+        for kind in ['read', 'write', 'network']:
+            for value in getattr(parsed, '{0}_limit'.format(kind)) or []:
+                target, _, rate = value.rpartition('=')
+                if self._size_to_bytes(rate) < 1:
+                    self._raise('The --{0}-limit rate must be at least 1 byte per second: "{1}"'.format(kind, value))
+
+        # Verify incremental backup options
+        if getattr(parsed, 'base', None):
+            parsed.incremental = True
+            if not parsed.remote:
+                parsed.base = os.path.abspath(parsed.base).rstrip('/') + '/'
+            if parsed.base.rstrip('/') == parsed.source.rstrip('/'):
+                self._raise('The --base directory can not be the backup directory itself: "{0}"'.format(parsed.base))
+        if getattr(parsed, 'chunk_store', None):
+            if parsed.remote:
+                self._raise('The --chunk-store option is only supported for local backups.')
+            if parsed.incremental or parsed.sparse:
+                self._raise('The --chunk-store option already saves each chunk once, it can not be combined with --incremental, --base or --sparse.')
+            parsed.chunk_store = os.path.abspath(parsed.chunk_store)
+        if getattr(parsed, 'checkpoint_size', None):
+            if self._size_to_bytes(parsed.checkpoint_size) < 1:
+                self._raise('The --checkpoint-size value must be at least 1 byte: "{0}"'.format(parsed.checkpoint_size))
+            if parsed.sparse or parsed.incremental or parsed.chunk_store:
+                self._raise('The --checkpoint-size option can not be combined with --sparse, --incremental, --base or --chunk-store.')
+        if getattr(parsed, 'resume', False) and getattr(parsed, 'discard_checkpoint', False):
+            self._raise('The --resume and --discard-checkpoint options can not be combined.')
+        if getattr(parsed, 'chunk_size', None) and self._size_to_bytes(parsed.chunk_size) < 1:
+            self._raise('The --chunk-size value must be at least 1 byte: "{0}"'.format(parsed.chunk_size))
+
+        # Verify compression options
+        if parsed.compression_threads < 0:
+            self._raise('The --compression-threads value can not be negative: "{0}"'.format(parsed.compression_threads))
+        if getattr(parsed, 'compression_level', None) is not None:
+            if parsed.compression == 'none':
+                self._raise('The --compression-level option requires a --compression codec.')
+            lowest, highest = self.compression_codecs[parsed.compression][1]
+            if not lowest <= parsed.compression_level <= highest:
+                self._raise('The --compression-level value for {0} must be between {1} and {2}: "{3}"'.format(parsed.compression, lowest, highest, parsed.compression_level))
+
+        # Verify concurrency limit
+        if parsed.jobs < 1:
+            self._raise('The --jobs value must be at least 1: "{0}"'.format(parsed.jobs))
+        if parsed.streams_per_pv < 1:
+            self._raise('The --streams-per-pv value must be at least 1: "{0}"'.format(parsed.streams_per_pv))
+        if parsed.ssh_streams < 1:
+            self._raise('The --ssh-streams value must be at least 1: "{0}"'.format(parsed.ssh_streams))
+
         # Verify identity file
         if hasattr(parsed, 'identity_file') and parsed.identity_file:
             if not os.path.isfile(parsed.identity_file):
@@ -379,6 +2299,25 @@ class Vmpy:
 
         return parsed
 
+    def _load_hypervisor(self):
+        '''
+        Create the hypervisor backend selected by --hypervisor. In "auto"
+        mode the libvirt bindings backend is used when available, falling back
+        to `virsh`.
+        '''
+        choice = self.args.hypervisor
+        if choice == 'libvirt' and not libvirt:
+            self._raise('The libvirt Python bindings are not installed. Use --hypervisor virsh instead.')
+
+        if choice == 'libvirt' or (choice == 'auto' and libvirt):
+            backend = LibvirtBackend(self, self.args.connect)
+        else:
+            backend = VirshBackend(self, self.args.connect)
+
+        self._output('Using "{0}" hypervisor backend.'.format(backend.name), 1 if choice == 'auto' else 2)
+        self.status['hypervisor'] = backend.name
+        return backend
+
     # --------------------------------------------------------------------------
     # Environment setup utility functions
     # --------------------------------------------------------------------------
@@ -423,157 +2362,292 @@ class Vmpy:
     # --------------------------------------------------------------------------
     def load_info(self):
         '''
-        Load (or reload) environmental information about VGs, LVs, and
-        VMs.
+        Load (or reload) environmental information about all VGs, LVs, and
+        VMs on the host. Most actions don't need this, see _require_info().
         '''
+        self._reset_info()
         self._load_vg_info()
         self._load_lv_info()
         self._load_vm_info()
 
-    def _load_vg_info(self):
+    def _reset_info(self):
+        '''
+        Forget all loaded environmental information. It is loaded again, on
+        demand, the next time it is requested.
+        '''
+        self.data['vg_info'] = {}
+        self.data['lv_info'] = {}
+        self.data['lv_index'] = {'path': {}, 'devno': {}}
+        self.data['vm_info'] = {}
+        self.data['vm_index'] = dict([(attribute, {}) for attribute in self.vm_index_attributes])
+
+        # Names loaded per info type, and info types loaded host-wide
+        self.data['loaded'] = {'vg_info': set(), 'lv_info': set(), 'vm_info': set()}
+        self.data['complete'] = set()
+
+        # Names changed by mutations and waiting for _refresh_info()
+        self.data['invalid'] = {'vg_info': set(), 'lv_info': set(), 'vm_info': set()}
+
+    def _invalidate_info(self, info_type, name):
+        '''
+        Mark a single record as changed by a mutation: a VG name, a (VG, LV)
+        tuple or a VM name. It is refreshed by _refresh_info().
+        '''
+        self.data['invalid'][info_type].add(name)
+
+    def _refresh_info(self):
+        '''
+        Refresh the records marked by _invalidate_info(). Only records that
+        have already been loaded are reloaded, each with a targeted call.
+        Records never loaded are loaded fresh on demand anyway.
+        '''
+        invalid = self.data['invalid']
+        self.data['invalid'] = {'vg_info': set(), 'lv_info': set(), 'vm_info': set()}
+        loaded = self.data['loaded']
+        complete = self.data['complete']
+
+        # One `vgs` call refreshes the free space of every volume group
+        if invalid['vg_info'] and 'vg_info' in complete:
+            self._load_vg_info()
+
+        for lv_tuple in sorted(invalid['lv_info']):
+            if 'lv_info' in complete or lv_tuple[0] in loaded['lv_info']:
+                self._load_lv_info(lv_tuple[0], lv_tuple[1])
+
+        for name in sorted(invalid['vm_info']):
+            if 'vm_info' in complete or name in loaded['vm_info']:
+                self._load_vm_info(name)
+
+    @contextlib.contextmanager
+    def info_transaction(self):
+        '''
+        Batch several mutations into a single refresh at the end, e.g.:
+
+            with self.info_transaction():
+                self._vm_undefine(name)
+                self._lv_remove(path)
+
+        Transactions may be nested; the outermost one refreshes.
+        '''
+        self.info_transactions += 1
+        try:
+            yield
+        finally:
+            self.info_transactions -= 1
+            if not self.info_transactions:
+                self._refresh_info()
+
+    def _require_info(self, info_type, name=None):
+        '''
+        Make sure environmental information is loaded before it is read. With
+        a name only that record is loaded: a single VM, or the LVs of a single
+        VG. Without a name the info type is loaded for the whole host.
+        '''
+        if info_type in self.data['complete']:
+            return
+        if name is not None and name in self.data['loaded'][info_type]:
+            return
+
+        loaders = {
+            'vg_info': self._load_vg_info,
+            'lv_info': self._load_lv_info,
+            'vm_info': self._load_vm_info
+        }
+        loaders[info_type](name)
+
+    def _load_vg_info(self, vg=None):
         '''
-        Parse Host OS volume groups
+        Parse Host OS volume groups. A single `vgs` call is cheap, so all
+        volume groups are loaded even when only one is requested.
         '''
         self._output('Loading Host OS LVM Volume Group information.', 2)
 
         # Set base value
         self.data['vg_info'] = {}
+        self.data['complete'].add('vg_info')
 
-        # Return list from `vgs` command
-        separator = '::'
-        command = ['vgs', '--separator={0}'.format(separator), '--units=g']
-        self._output('Parsing volume group information: `{0}`'.format(' '.join(command)), 3)
-        output = self._execute(command, output_level=3)
-
-        # Extract volume group rows from output
-        rows = output.split('\n')
-        rows = filter(None, rows)
-        headers = rows[0].split(separator)
-        headers = [cleaned.strip() for cleaned in headers]
-        vgs = rows[1:]
+        # Return rows from a single machine-readable `vgs` report
+        vgs = self._lvm_report('vgs', self.vg_report_fields)
         if not vgs:
-            self._output('No volume groups found: `{0}`'.format(' '.join(command)), 3)
+            self._output('No volume groups found.', 3)
             return False
 
         # Process each volume group
-        for row in vgs:
-            # Process volume group row and save them to a dictionary using the
-            # header values as keys
-            segments = row.split(separator)
-            segments = [cleaned.strip() for cleaned in segments]
-            values = dict(zip(headers, segments))
-            volume_group = {segments[0]: values}
+        for values in vgs:
+            volume_group = {values['VG']: VgRecord(values)}
 
             # Save data
-            self._output('  Volume group parsed: "{0}"'.format(segments[0]), 3)
+            self._output('  Volume group parsed: "{0}"'.format(values['VG']), 3)
             self._output('  Volume group values: {0}'.format(volume_group), 4)
             self.data['vg_info'].update(volume_group)
 
         return True
 
-    def _load_lv_info(self):
+    def _load_lv_info(self, vg=None, lv=None):
         '''
-        Parse Host OS logical volumes
+        Parse Host OS logical volumes, either of all volume groups, of a
+        single one, or a single logical volume. Besides the (VG, LV) keyed
+        dictionary, an index of device paths and kernel major:minor numbers is
+        built so VM disks can be matched to logical volumes without calling
+        `lvs` again. Volume groups unchanged since the last run are read from
+        the environment cache.
         '''
         self._output('Loading Host OS LVM Logical Volume information.', 2)
 
         # Set base value
-        self.data['lv_info'] = {}
+        if lv is not None:
+            if (vg, lv) in self.data['lv_info']:
+                self._unindex_lv((vg, lv))
+                del self.data['lv_info'][(vg, lv)]
+            vgs = []
+        elif vg is None:
+            self.data['lv_info'] = {}
+            self.data['lv_index'] = {'path': {}, 'devno': {}}
+            self.data['complete'].add('lv_info')
+            self._require_info('vg_info')
+            vgs = sorted(self.data['vg_info'])
+        else:
+            for lv_tuple in [key for key in self.data['lv_info'] if key[0] == vg]:
+                self._unindex_lv(lv_tuple)
+                del self.data['lv_info'][lv_tuple]
+            self.data['loaded']['lv_info'].add(vg)
+            vgs = [vg]
+
+            # `lvs <vg>` fails for unknown volume groups
+            if not self.vg_info(vg, None, False):
+                self._output('No volume group found: "{0}"'.format(vg), 3)
+                return False
 
-        # Return list from `lvs` command
-        separator = '::'
-        command = ['lvs', '--separator={0}'.format(separator), '--units=g']
-        self._output('Parsing logical volume information: `{0}`'.format(' '.join(command)), 3)
-        output = self._execute(command, output_level=3)
+        # Return rows from a single machine-readable `lvs` report. Reporting
+        # a single removed logical volume fails, which is not an error here.
+        if lv is not None:
+            lvs = self._lvm_report('lvs', self.lv_report_fields, ['{0}/{1}'.format(vg, lv)], raise_exception=False)
+        else:
+            lvs = []
+            stale = []
+            fresh = []
+            for name in vgs:
+                cached = self._cached_lv_rows(name)
+                if cached is None:
+                    stale.append(name)
+                else:
+                    fresh.append(name)
+                    lvs.extend(dict(row) for row in cached)
+
+            # Activation state and kernel device numbers of cached rows
+            if fresh:
+                states = dict(((row['VG'], row['LV']), row) for row in self._lvm_report('lvs', self.lv_state_fields, fresh))
+                for row in lvs:
+                    row.update(states.get((row['VG'], row['LV']), {'KMaj': None, 'KMin': None, 'Attr': None}))
+            if stale:
+                report = self._lvm_report('lvs', self.lv_report_fields, stale)
+                lvs.extend(report)
+                for name in stale:
+                    self._cache_lv_rows(name, [row for row in report if row['VG'] == name])
+            if vg is None:
+                self._prune_cache('lvm', vgs)
 
-        # Extract logical volume rows from output
-        rows = output.split('\n')
-        rows = filter(None, rows)
-        headers = rows[0].split(separator)
-        headers = [cleaned.strip() for cleaned in headers]
-        lvs = rows[1:]
         if not lvs:
-            self._output('No logical volumes found: `{0}`'.format(' '.join(command)), 3)
+            self._output('No logical volumes found.', 3)
             return False
 
-        # Process each volume group
-        for row in lvs:
-            # Process volume group row and save them to a dictionary using the
-            # header values as keys
-            segments = row.split(separator)
-            segments = [cleaned.strip() for cleaned in segments]
-            values = dict(zip(headers, segments))
-            logical_volume = {(values['VG'], values['LV']): values}
+        # Process each logical volume
+        for values in lvs:
+            lv_tuple = (values['VG'], values['LV'])
+            logical_volume = {lv_tuple: LvRecord(values)}
 
             # Save data
-            self._output('  Logical volume parsed: "{0}"'.format(segments[0]), 3)
+            self._output('  Logical volume parsed: "{0}"'.format(values['LV']), 3)
             self._output('  Logical volume values: {0}'.format(logical_volume), 4)
             self.data['lv_info'].update(logical_volume)
+            self._index_lv(lv_tuple, values)
 
         return True
 
-    def _load_vm_info(self, name=None, file=None, raw=None):
+    def _load_vm_info(self, name=None):
         '''
-        Parse and load info for all virtual-machines defined in `virsh`
+        Parse and load info for all virtual-machines defined on the
+        hypervisor, or for a single named virtual-machine.
         '''
         self._output('Loading Host OS Virtual Machine information.', 2)
 
-        # Set base value
-        self.data['vm_info'] = {}
+        # Get defined domains from the hypervisor
+        if name is None:
+            self.data['vm_info'] = {}
+            self.data['vm_index'] = dict([(attribute, {}) for attribute in self.vm_index_attributes])
+            self.data['complete'].add('vm_info')
+            domains = self.hypervisor.list_domains()
+        else:
+            if name in self.data['vm_info']:
+                self._unindex_vm(self.data['vm_info'].pop(name))
+            self.data['loaded']['vm_info'].add(name)
+            domain = self.hypervisor.get_domain(name)
+            domains = [domain] if domain else []
 
-        # Get virsh list and parse results
-        command = ['virsh', 'list', '--all']
-        self._output('Parsing defined virtual-machine information: `{0}`'.format(' '.join(command)), 3)
-        output = self._execute(command, output_level=3)
+        if name is None:
+            self._prune_cache('vm', [domain['name'] for domain in domains])
 
-        # Extract virtual machine rows from output
-        rows = output.split('\n')
-        headers = rows[0:2]
-        headers = [cleaned.strip() for cleaned in headers]
-        vms = rows[2:]
-        vms = filter(None, vms)
-        if not vms:
-            self._output('No defined virtual-machines found: `{0}`'.format(' '.join(command)), 3)
+        if not domains:
+            self._output('No defined virtual-machines found.', 3)
             return False
 
-        # Process virtual machine
-        for row in vms:
-            # Parse row data into columns and start vm data dictionary
-            columns = row.split()
-            columns = [cleaned.strip() for cleaned in columns]
-            values = {}
-            values['name'] = columns[1]
-            values['status'] = ' '.join(columns[2:])
-
-            # Load VM XML
-            command = ['virsh', 'dumpxml', '{0}'.format(values['name'])]
-            self._output('Retrieving XML for virtual machine: `{0}`'.format(' '.join(command)), 4)
-            xml = self._execute(command, output_level=3)
+        # Parse XML for additional vm information, reusing cached results for
+        # domains unchanged since the last run
+        xml_infos = self._load_vm_xml_infos([domain['name'] for domain in domains])
 
-            # Send XML to be parsed for additional vm information
-            xml_info = self._parse_vm_xml(xml)
-            values.update(xml_info)
-
-            # Add in LV size information
+        # Process virtual machine
+        for domain in domains:
+            # Start vm data record
+            values = VmRecord()
+            values['name'] = domain['name']
+            values['status'] = domain['status']
+            values.update(xml_infos[domain['name']])
+
+            # Add in LV size information, for the primary and every disk
             lv_info = self._return_lvm_info_by_path(values['disk'])
             values.update(lv_info)
+            values['disks'] = [dict(disk) for disk in values['disks'] or []]
+            for disk in values['disks']:
+                disk.update(self._return_lvm_info_by_path(disk['disk']))
 
             # Add vm name as dictionary key
             virtual_machine = {values['name']: values}
 
             # # Save data
-            debug_output = values.copy()
-            if 'xml' in debug_output:
-                del debug_output['xml']
             self._output('  Virtual machine parsed "{0}"'.format(values['name']), 3)
-            self._output('  Virtual machine values: {0}'.format(debug_output), 4)
+            self._output('  Virtual machine values: {0}'.format(values), 4)
             self.data['vm_info'].update(virtual_machine)
+            self._index_vm(values)
 
         return True
 
     # --------------------------------------------------------------------------
     # Load data['*_info'] utility functions
     # --------------------------------------------------------------------------
+    def _load_vm_xml_infos(self, names):
+        '''
+        A helper function for _load_vm_info that returns a dictionary of
+        parsed XML info values keyed by VM name. Only the XML of domains
+        without a valid cache entry is retrieved from the hypervisor.
+        '''
+        infos = {}
+        stale = []
+        generations = {}
+        for name in names:
+            generations[name] = self.hypervisor.generation(name)
+            cached = self._cached_vm_info(name, generations[name])
+            if cached is None:
+                stale.append(name)
+            else:
+                infos[name] = cached
+
+        xmls = self.hypervisor.dumpxml_all(stale)
+        for name, xml in zip(stale, xmls):
+            infos[name] = self._parse_vm_xml(xml)
+            self._cache_vm_info(name, generations[name], infos[name])
+
+        return infos
+
     def _parse_vm_xml(self, raw):
         '''
         A helper function for _load_vm_info that parses VM XML and
@@ -581,15 +2655,16 @@ class Vmpy:
         '''
 
         # Set keys and create default parsed dictionary
-        keys = ('name', 'uuid', 'disk', 'disk_file', 'mac', 'bridge', 'xml')
+        keys = ('name', 'uuid', 'disk', 'disk_file', 'mac', 'bridge')
         parsed = dict([(key, None) for key in keys])
+        parsed['disks'] = []
+        parsed['macs'] = []
 
         # Get XML
         if not raw:
             return {}
 
-        # Parse XML
-        parsed['xml'] = raw
+        # Parse XML. The raw XML is not kept, see vm_xml().
         xml = ElementTree.fromstring(raw)
 
         # Get name and uuid
@@ -607,30 +2682,32 @@ class Vmpy:
         except AttributeError:
             return parsed
 
-        # Disk
+        # Disks, in XML order. The first disk is the primary disk, its values
+        # are also saved as "disk" and "disk_file".
         try:
             for disk in devices.findall('disk'):
                 if disk.get('device') == 'disk':
                     source = disk.find('source')
-                    parsed['disk'] = source.get('dev')
+                    target = disk.find('target')
+                    values = {}
+                    values['target'] = target.get('dev') if target is not None else None
+                    values['disk'] = source.get('dev') if source is not None else None
+                    values['disk_file'] = source.get('file') if source is not None else None
+                    parsed['disks'].append(values)
         except AttributeError:
             return parsed
 
-        # File disk
-        if not parsed['disk']:
-            try:
-                for disk in devices.findall('disk'):
-                    if disk.get('device') == 'disk':
-                        source = disk.find('source')
-                        parsed['disk_file'] = source.get('file')
-            except AttributeError:
-                pass
+        if parsed['disks']:
+            parsed['disk'] = parsed['disks'][0]['disk']
+            parsed['disk_file'] = parsed['disks'][0]['disk_file']
 
-        # MAC address and Bridge device
+        # MAC address and Bridge device. Every interface's MAC address is
+        # listed, so no address in use is handed out again.
         try:
             for interface in devices.findall('interface'):
                 if interface.find('mac') is not None:
                     parsed['mac'] = interface.find('mac').get('address')
+                    parsed['macs'].append(parsed['mac'].lower())
                 if interface.find('source') is not None:
                     parsed['bridge'] = interface.find('source').get('bridge')
         except AttributeError:
@@ -638,12 +2715,133 @@ class Vmpy:
 
         return parsed
 
+    def _lvm_report(self, command_name, fields, targets=None, raise_exception=True):
+        '''
+        A helper function for _load_vg_info and _load_lv_info. Runs a LVM
+        reporting command (`vgs` or `lvs`) once, without headings and with
+        sizes in bytes, and returns a list of row dictionaries keyed by the
+        short field titles in `fields`. Size fields are converted to integers.
+        Optional targets (e.g. VG names) limit the report. If raise_exception
+        is False a failing command returns an empty list.
+        '''
+        separator = '::'
+        names = [name for name, title, is_size in fields]
+        command = [command_name, '--noheadings', '--nosuffix', '--units=b', '--separator={0}'.format(separator), '-o', ','.join(names)]
+        command += list(targets or [])
+        self._output('Parsing LVM report: `{0}`'.format(' '.join(command)), 3)
+        try:
+            output = self._execute(command, output_level=3)
+        except ApplicationError:
+            if raise_exception:
+                raise
+            return []
+
+        rows = []
+        for row in filter(None, output.split('\n')):
+            segments = [cleaned.strip() for cleaned in row.split(separator)]
+            if len(segments) != len(fields):
+                continue
+            values = {}
+            for (name, title, is_size), segment in zip(fields, segments):
+                if is_size:
+                    segment = self._size_to_bytes(segment) if segment else None
+                values[title] = segment
+            rows.append(values)
+
+        return rows
+
+    def _index_lv(self, lv_tuple, values):
+        '''
+        A helper function for _load_lv_info that adds a logical volume to the
+        device path and major:minor indexes.
+        '''
+        vg, lv = lv_tuple
+        mapper_name = '{0}-{1}'.format(vg.replace('-', '--'), lv.replace('-', '--'))
+        paths = [values.get('Path'), '/dev/{0}/{1}'.format(vg, lv), '/dev/mapper/{0}'.format(mapper_name)]
+        for path in filter(None, paths):
+            self.data['lv_index']['path'][path] = lv_tuple
+
+        if values.get('KMaj') not in (None, '', '-1') and values.get('KMin') not in (None, '', '-1'):
+            devno = '{0}:{1}'.format(values['KMaj'], values['KMin'])
+            self.data['lv_index']['devno'][devno] = lv_tuple
+
+    def _index_vm(self, values):
+        '''
+        A helper function for _load_vm_info that adds a VM to the secondary
+        attribute indexes.
+        '''
+        for attribute in self.vm_index_attributes:
+            index = self.data['vm_index'][attribute]
+            for value in self._vm_index_values(values, attribute):
+                index.setdefault(value, set()).add(values['name'])
+
+    def _unindex_vm(self, values):
+        '''
+        Remove a VM from the secondary attribute indexes.
+        '''
+        for attribute in self.vm_index_attributes:
+            index = self.data['vm_index'][attribute]
+            for value in self._vm_index_values(values, attribute):
+                names = index.get(value, set())
+                names.discard(values['name'])
+                if not names:
+                    index.pop(value, None)
+
+    def _vm_index_values(self, values, attribute):
+        '''
+        Return the values a VM is indexed under. VMs are indexed under the
+        device path of every disk and the MAC address of every network
+        interface, not only the primary one.
+        '''
+        if attribute == 'disk' and values['disks']:
+            return [disk['disk'] for disk in values['disks']]
+        if attribute == 'mac' and values['macs']:
+            return values['macs']
+        return [values[attribute]]
+
+    def _unindex_lv(self, lv_tuple):
+        '''
+        Remove a logical volume from the device path and major:minor indexes.
+        '''
+        for index in self.data['lv_index'].itervalues():
+            for key in [key for key, value in index.iteritems() if value == lv_tuple]:
+                del index[key]
+
+    def _find_lv_by_path(self, path):
+        '''
+        Return the (VG, LV) tuple of a loaded logical volume by device path,
+        first by path and then by the device's major:minor numbers. The
+        major:minor lookup reliably matches symlinked paths
+        (/dev/disk/by-id/*, /dev/dm-*, etc).
+        '''
+        index = self.data['lv_index']
+        lv_tuple = index['path'].get(path)
+        if not lv_tuple:
+            lv_tuple = index['path'].get(os.path.realpath(path))
+        if not lv_tuple:
+            try:
+                rdev = os.stat(path).st_rdev
+                devno = '{0}:{1}'.format(os.major(rdev), os.minor(rdev))
+                lv_tuple = index['devno'].get(devno)
+            except OSError:
+                pass
+        return lv_tuple
+
+    def _lv_pvs(self, lv_tuple):
+        '''
+        Return the physical volumes a logical volume is allocated on, parsed
+        from the `lvs` devices field, e.g. "/dev/sda2(0),/dev/sdb1(1200)".
+        '''
+        devices = self.lv_info(lv_tuple, 'Devices', False) or ''
+        return sorted(set([device.split('(')[0] for device in devices.split(',') if device]))
+
     def _return_lvm_info_by_path(self, path):
         '''
-        Helper function to parse `lvs` information by path.
-        Reliable way to get logical volume and volume group information
+        Helper function to look up logical volume and volume group information
         by disk path. Better than parsing disk path and assuming it follows
-        the /dev/volume_group/logical_volume standard path.
+        the /dev/volume_group/logical_volume standard path. Only the volume
+        group suggested by the path is loaded, unless the disk is not found
+        there.
         '''
 
         # Set default dictionary
@@ -654,25 +2852,153 @@ class Vmpy:
         if not path:
             return values
 
-        # Get `lvs` output
-        separator = '::'
-        command = ['lvs','--separator={0}'.format(separator), '--units=g', '{0}'.format(path)]
-        self._output('Retrieving LVM information for disk path: `{0}`'.format(' '.join(command)), 3)
-        output = self._execute(command, output_level=3)
-
-        # Parse information
-        row = output.split('\n')[1:2]
-        row = str(row[0])
-        columns = row.split(separator)
-        columns = [cleaned.strip() for cleaned in columns]
+        # Find logical volume in index, loading LV info as needed
+        lv_tuple = self._find_lv_by_path(path)
+        segments = path.split('/')
+        if not lv_tuple and len(segments) == 4 and segments[1] == 'dev' and segments[2] != 'mapper':
+            self._require_info('lv_info', segments[2])
+            lv_tuple = self._find_lv_by_path(path)
+        if not lv_tuple:
+            self._require_info('lv_info')
+            lv_tuple = self._find_lv_by_path(path)
+        if not lv_tuple:
+            self._output('Could not find a logical volume for disk path: "{0}"'.format(path), 3)
+            return values
 
         # Assign and return dictionary values
-        values = {}
-        values['logical_volume'] = columns[0]
-        values['volume_group'] = columns[1]
-        values['disk_size'] = self.lv_info((values['volume_group'], values['logical_volume']), 'LSize', False)
+        values['volume_group'], values['logical_volume'] = lv_tuple
+        values['disk_size'] = self.lv_info(lv_tuple, 'LSize', False)
         return values
 
+    # --------------------------------------------------------------------------
+    # Environment cache functions
+    # --------------------------------------------------------------------------
+    def _load_cache(self):
+        '''
+        Load the persistent environment cache written by a previous run.
+        Logical volumes are cached per volume group and are valid while the
+        LVM metadata sequence number is unchanged, except for their
+        activation state and device numbers, see lv_state_fields. Parsed VM XML is valid while
+        the hypervisor generation token is unchanged. The cache is dropped
+        after a reboot. Returns None when caching is disabled.
+        '''
+        if self.args.no_cache:
+            return None
+
+        boot_id = None
+        if os.path.isfile('/proc/sys/kernel/random/boot_id'):
+            boot_id = self._read_file('/proc/sys/kernel/random/boot_id').strip()
+
+        cache = {'version': 5, 'boot_id': boot_id, 'lvm': {}, 'vm': {}, 'block_size': {}}
+        if not os.path.isfile(self.cache_file):
+            return cache
+
+        try:
+            stored = json.loads(self._read_file(self.cache_file))
+        except ValueError:
+            self._output('Ignoring malformed environment cache file: "{0}"'.format(self.cache_file), 2)
+            return cache
+
+        if stored.get('version') == cache['version'] and stored.get('boot_id') == boot_id:
+            self._output('Loaded environment cache file: "{0}"'.format(self.cache_file), 3)
+            cache['lvm'] = stored.get('lvm', {})
+            cache['vm'] = stored.get('vm', {})
+            cache['block_size'] = stored.get('block_size', {})
+        return cache
+
+    def _save_cache(self):
+        '''
+        Write the environment cache file. The file is replaced atomically.
+        A failure to write the cache is reported but not fatal.
+        '''
+        temp_file = '{0}.tmp'.format(self.cache_file)
+        try:
+            self._write_file(temp_file, self._return_json(self.cache))
+            os.rename(temp_file, self.cache_file)
+        except (ApplicationError, OSError), e:
+            self._output('Could not save environment cache file "{0}": {1}'.format(self.cache_file, str(e)))
+
+    def _load_checkpoint(self, action, name):
+        '''
+        Load the checkpoint file to resume an action, verifying it was
+        written by the same action on the same VM and backup location.
+        '''
+        if not os.path.isfile(self.checkpoint_file):
+            self._raise('There is nothing to resume, the checkpoint file does not exist: "{0}"'.format(self.checkpoint_file))
+        checkpoint = json.loads(self._read_file(self.checkpoint_file))
+        expected = {'action': action, 'name': name, 'source': self.args.source, 'remote': self.args.remote}
+        for key, value in expected.items():
+            if checkpoint.get(key) != value:
+                self._raise('The checkpoint file "{0}" is for the {1} of "{2}" at "{3}", it can not be resumed by this {4}.'.format(self.checkpoint_file, checkpoint.get('action'), checkpoint.get('name'), checkpoint.get('source'), action))
+        self._output('Resuming from checkpoint file: "{0}"'.format(self.checkpoint_file), 2)
+        self.checkpoint = checkpoint
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint=None):
+        '''
+        Write the checkpoint of the running backup or import, replacing it
+        with checkpoint if given. The file is replaced atomically. Hold
+        checkpoint_lock while disks are being transferred.
+        '''
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        temp_file = '{0}.tmp'.format(self.checkpoint_file)
+        self._write_file(temp_file, self._return_json(self.checkpoint))
+        os.rename(temp_file, self.checkpoint_file)
+
+    def _remove_checkpoint(self):
+        '''
+        Remove the checkpoint file once its action completed.
+        '''
+        if self.checkpoint is None:
+            return
+        self.checkpoint = None
+        self._unlink_file(self.checkpoint_file)
+
+    def _cached_lv_rows(self, vg):
+        '''
+        Return the cached `lvs` rows of a volume group, or None if there is no
+        entry or the volume group metadata changed since it was cached.
+        '''
+        if self.cache is None:
+            return None
+        entry = self.cache['lvm'].get(vg)
+        if entry and entry['seqno'] == self.vg_info(vg, 'Seq', False):
+            self._output('  Using cached logical volume information for volume group: "{0}"'.format(vg), 3)
+            return entry['lvs']
+        return None
+
+    def _cache_lv_rows(self, vg, rows):
+        if self.cache is not None:
+            state = [title for name, title, is_size in self.lv_state_fields if title not in ('VG', 'LV')]
+            rows = [dict((key, value) for key, value in row.items() if key not in state) for row in rows]
+            self.cache['lvm'][vg] = {'seqno': self.vg_info(vg, 'Seq', False), 'lvs': rows}
+
+    def _cached_vm_info(self, name, generation):
+        '''
+        Return the cached parsed XML info of a VM, or None if there is no
+        entry or the domain configuration changed since it was cached.
+        '''
+        if self.cache is None or generation is None:
+            return None
+        entry = self.cache['vm'].get(name)
+        if entry and entry['generation'] == generation:
+            self._output('  Using cached XML information for virtual machine: "{0}"'.format(name), 3)
+            return entry['info']
+        return None
+
+    def _cache_vm_info(self, name, generation, info):
+        if self.cache is not None and generation is not None:
+            self.cache['vm'][name] = {'generation': generation, 'info': info}
+
+    def _prune_cache(self, section, names):
+        '''
+        Remove cache entries of volume groups or VMs no longer on the host.
+        '''
+        if self.cache is not None:
+            for name in [name for name in self.cache[section] if name not in names]:
+                del self.cache[section][name]
+
     # --------------------------------------------------------------------------
     # Load data['*_info'] interface methods
     # --------------------------------------------------------------------------
@@ -684,6 +3010,7 @@ class Vmpy:
         either the vg or attribute does not exist. This ensures there is no
         confusion between False-y attribute values and non-existent ones.
         '''
+        self._require_info('vg_info', vg)
         try:
             if not attribute:
                 return self.data['vg_info'][vg]
@@ -701,6 +3028,7 @@ class Vmpy:
         either the lv or attribute does not exist. This ensures there is no
         confusion between False-y attribute values and non-existent ones.
         '''
+        self._require_info('lv_info', lv_tuple[0])
         try:
             if not attribute:
                 return self.data['lv_info'][lv_tuple]
@@ -718,6 +3046,7 @@ class Vmpy:
         either the vm or attribute does not exist. This ensures there is no
         confusion between False-y attribute values and non-existent ones.
         '''
+        self._require_info('vm_info', vm)
         try:
             if not attribute:
                 return self.data['vm_info'][vm]
@@ -727,12 +3056,25 @@ class Vmpy:
             if raise_exception:
                 self._raise('The requested (vm, attribute) pair does not exist: "self.vm_info({0}, {1})".'.format(vm, attribute))
 
+    def vm_xml(self, vm):
+        '''
+        Return the current XML of a VM. The XML is not held in vm_info, it is
+        retrieved from the hypervisor when an action needs it.
+        '''
+        if not self.vm_info(vm, None, False):
+            self._raise('Could not retrieve XML, VM does not exist: "{0}"'.format(vm))
+        return self.hypervisor.dumpxml(vm)
+
     def vm_info_search(self, attribute, value, raise_exception=True):
         '''
         Search host machine VMs for a particular attribute value. If there is
         a match, return a list of matching VM names. If attribute does not
-        exist, raise an exception.
+        exist, raise an exception. Indexed attributes are looked up directly.
         '''
+        self._require_info('vm_info')
+        if attribute in self.data['vm_index']:
+            return sorted(self.data['vm_index'][attribute].get(value, []))
+
         try:
             matches = []
             for vm in self.data['vm_info'].itervalues():
@@ -751,6 +3093,10 @@ class Vmpy:
         default an exception will be raised if a vm does not have the
         attribute. Otherwise a boolean will be returned.
         '''
+        self._require_info('vm_info')
+        if attribute in self.data['vm_index']:
+            return value not in self.data['vm_index'][attribute]
+
         for vm in self.data['vm_info'].itervalues():
             try:
                 vm[attribute]
@@ -768,6 +3114,7 @@ class Vmpy:
         '''
         Return the number of VMs defined on the host machine.
         '''
+        self._require_info('vm_info')
         return len(self.data['vm_info'])
 
     # ==========================================================================
@@ -801,13 +3148,15 @@ class Vmpy:
         environment.
         '''
         # Set variables
-        if 'compression' in self.args:
+        chunk_store = getattr(self.args, 'chunk_store', None)
+        checkpoint_size = getattr(self.args, 'checkpoint_size', None)
+        if 'compression' in self.args and not chunk_store:
             compression = self.args.compression
         else:
             compression = 'none'
 
         if compression != 'none':
-            compression_extension = '.' + compression
+            compression_extension = self.compression_codecs[compression][0]
         else:
             compression_extension = ''
 
@@ -821,9 +3170,16 @@ class Vmpy:
         meta['command'] = self.status['command']
         meta['name'] = self.vm_info(vm, 'name')
         meta['xml'] = './{0}.xml'.format(vm)
-        meta['image'] = './{0}.img{1}'.format(vm, compression_extension)
-        meta['image_size'] = self.vm_info(vm, 'disk_size')
+        meta['image'] = './{0}.img{1}'.format(vm, compression_extension) if not chunk_store else None
+        meta['image_size'] = self._bytes_to_size(self.vm_info(vm, 'disk_size'))
         meta['compression'] = compression
+        meta['compression_level'] = getattr(self.args, 'compression_level', None)
+        meta['compression_threads'] = self._compression_threads() if compression != 'none' else None
+        meta['sparse'] = bool(getattr(self.args, 'sparse', False))
+        meta['incremental'] = bool(getattr(self.args, 'incremental', False))
+        meta['base'] = None
+        meta['chunk_store'] = chunk_store
+        meta['checkpoint_size'] = self._bytes_to_size(self._size_to_bytes(checkpoint_size)) if checkpoint_size else None
         meta['logical_volume'] = self.vm_info(vm, 'logical_volume')
         meta['volume_group'] = self.vm_info(vm, 'volume_group')
         meta['bridge'] = self.vm_info(vm, 'bridge')
@@ -831,8 +3187,152 @@ class Vmpy:
         meta['uuid'] = self.vm_info(vm, 'uuid')
         meta['disk'] = self.vm_info(vm, 'disk')
         meta['disk_file'] = self.vm_info(vm, 'disk_file')
+
+        # Save every disk. The first disk is the primary disk described by
+        # the values above, additional disks are saved to their own image.
+        meta['disks'] = []
+        for i, disk in enumerate(self.vm_info(vm, 'disks') or []):
+            if i == 0:
+                image = meta['image']
+                prefix = './{0}'.format(vm)
+            else:
+                image = './{0}-{1}.img{2}'.format(vm, disk['target'], compression_extension) if not chunk_store else None
+                prefix = './{0}-{1}'.format(vm, disk['target'])
+            meta['disks'].append({
+                'target': disk['target'],
+                'disk': disk['disk'],
+                'disk_file': disk['disk_file'],
+                'logical_volume': disk['logical_volume'],
+                'volume_group': disk['volume_group'],
+                'image': image,
+                'image_size': self._bytes_to_size(disk['disk_size']),
+                'extents': prefix + '.extents.json' if meta['sparse'] or meta['incremental'] else None,
+                'manifest': prefix + '.manifest.json' if meta['incremental'] else None,
+                'base_manifest': None,
+                'chunks': prefix + '.chunks.json' if chunk_store else None,
+                'raw_sha256': None,
+                'image_sha256': None,
+                'checkpoints': [] if checkpoint_size else None
+            })
         return meta
 
+    def _meta_disks(self, meta):
+        '''
+        Return the list of disks described by meta data. Backups made before
+        multiple disk support only describe the primary disk.
+        '''
+        if meta.get('disks'):
+            return meta['disks']
+
+        keys = ('target', 'disk', 'disk_file', 'logical_volume', 'volume_group', 'image', 'image_size', 'extents')
+        return [dict([(key, meta.get(key)) for key in keys])]
+
+    def _compression_threads(self):
+        '''
+        Return the number of threads for multi-threaded compression programs.
+        '''
+        if self.args.compression_threads:
+            return self.args.compression_threads
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    def _compression_command(self, compression, decompress=False, level=None):
+        '''
+        Return the command compressing stdin to stdout with a codec from
+        compression_codecs, or decompressing with decompress=True. The first
+        installed program able to handle the codec is used.
+        '''
+        if compression not in self.compression_codecs:
+            self._raise('Unknown compression codec: "{0}". Supported codecs are: {1}'.format(compression, ', '.join(sorted(self.compression_codecs))))
+
+        extension, levels, programs = self.compression_codecs[compression]
+        for program, threads_option in programs:
+            if not self._find_program(program):
+                continue
+            command = [program, '-c', '-q']
+            if decompress:
+                command.append('-d')
+            elif level is not None:
+                command.append('-{0}'.format(level))
+            if threads_option:
+                command.append(threads_option.format(self._compression_threads()))
+            return command
+
+        self._raise('No program found for "{0}" compression, install one of: {1}'.format(compression, ', '.join([program for program, option in programs])))
+
+    def _decompression_filter(self, compression):
+        '''
+        Return the filter decompressing a codec, see _transfer(). Images
+        written by single-threaded bzip2 hold a single stream, which
+        pbzip2 and bzip2 decompress on one core. Unless lbzip2, which splits
+        the stream itself, is installed, they are split into blocks that
+        are decompressed across a process pool instead.
+        '''
+        if compression == 'bzip2' and self._compression_threads() > 1 and not self._find_program('lbzip2'):
+            self._bzip2_pool()
+            return self._bzip2_decompress
+        return self._compression_command(compression, decompress=True)
+
+    def _bzip2_pool(self):
+        '''
+        Return the process pool for bzip2 block decompression, starting it
+        on first use. Processes inherit every open descriptor, so the pool
+        must be started before any transfer opens its pipes.
+        '''
+        if not getattr(self, 'pool', None):
+            self._output('Starting {0} bzip2 decompression processes.'.format(self._compression_threads()), 2)
+            self.pool = multiprocessing.Pool(self._compression_threads())
+        return self.pool
+
+    def _bzip2_decompress(self, in_fd, out_fd):
+        '''
+        Decompress bzip2 data from in_fd to out_fd, decompressing blocks in
+        parallel and writing them in order. The output is identical to
+        `bzip2 -d`: libbzip2 checks the CRC of every block, the combined
+        CRC of each stream is checked here.
+        '''
+        pool = self._bzip2_pool()
+        splitter = Bzip2Splitter(lambda size: os.read(in_fd, size))
+        window = collections.deque()
+        lookahead = 2 * self._compression_threads()
+        crcs = []
+
+        def write(final=False):
+            # Keep jobs after the first one queued, a failed job is merged
+            # with the job after it
+            while len(window) > (0 if final else lookahead):
+                job, result = window.popleft()
+                data = result.get()
+                merges = 0
+                while data is None:
+                    if not window or merges == 8:
+                        raise IOError('Could not decompress bzip2 block, the data is corrupt.')
+                    job = splitter.merge(job, window.popleft()[0])
+                    data = bzip2_decompress_block(job)
+                    merges += 1
+                crcs.append(job[1])
+                view = memoryview(data)
+                offset = 0
+                while offset < len(data):
+                    offset += os.write(out_fd, view[offset:])
+
+        for kind, value in splitter.events():
+            if kind == 'block':
+                window.append((value, pool.apply_async(bzip2_decompress_block, (value,))))
+                write()
+                continue
+
+            # End of stream, check the combined CRC of its blocks
+            write(final=True)
+            combined = 0
+            for crc in crcs:
+                combined = (((combined << 1) | (combined >> 31)) & 0xffffffff) ^ crc
+            if combined != value:
+                raise IOError('The bzip2 stream CRC does not match, the data is corrupt.')
+            crcs = []
+
     def _load_vm_meta(self, raw_data):
         '''
         Load meta values from unparsed JSON.
@@ -849,74 +3349,88 @@ class Vmpy:
         raw_data = self._read_file(path)
         return self._load_vm_meta(raw_data)
 
+    def _load_extent_map(self, raw_data):
+        '''
+        Load the extent map of a sparse disk image from unparsed JSON.
+        '''
+        try:
+            extent_map = json.loads(raw_data)
+            extent_map['size'], extent_map['extents']
+        except (ValueError, TypeError, KeyError), e:
+            self._raise(e, 'Could not parse JSON extent map, JSON appears to be malformed.')
+        return extent_map
+
+    def _load_manifest(self, raw_data):
+        '''
+        Load the chunk manifest of an incremental disk image from unparsed
+        JSON.
+        '''
+        try:
+            manifest = json.loads(raw_data)
+            manifest['chunk_size'], manifest['chunks']
+        except (ValueError, TypeError, KeyError), e:
+            self._raise(e, 'Could not parse JSON chunk manifest, JSON appears to be malformed.')
+        return manifest
+
     # --------------------------------------------------------------------------
-    # Action common functions - virsh commands
+    # Action common functions - hypervisor commands
     # --------------------------------------------------------------------------
     # Note: Virsh VM commands are indempotent. For example, a call to resume an
     # already running VM does not throw an error.
     def _vm_autostart(self, vm):
-        command = ['virsh', 'autostart', vm]
-        self._output('Setting VM to autostart when Host OS reboots: `{0}`.'.format(' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Setting VM to autostart when Host OS reboots: "{0}".'.format(vm), 2)
+        return self.hypervisor.autostart(vm)
 
     def _vm_start(self, vm):
-        command = ['virsh', 'start', vm]
-        self._output('Starting the currently shut off VM "{0}": `{1}`.'.format(vm, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Starting the currently shut off VM "{0}".'.format(vm), 2)
+        return self.hypervisor.start(vm)
 
     def _vm_suspend(self, vm):
-        command = ['virsh', 'suspend', vm]
-        self._output('Suspending the currently running VM "{0}": `{1}`.'.format(vm, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Suspending the currently running VM "{0}".'.format(vm), 2)
+        return self.hypervisor.suspend(vm)
 
     def _vm_resume(self, vm):
-        command = ['virsh', 'resume', vm]
-        self._output('Resuming the currently suspended VM "{0}": `{1}`.'.format(vm, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Resuming the currently suspended VM "{0}".'.format(vm), 2)
+        return self.hypervisor.resume(vm)
 
     def _vm_shutdown(self, vm):
-        command = ['virsh', 'shutdown', vm]
-        self._output('Shutting down the currently running VM "{0}": `{1}`.'.format(vm, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Shutting down the currently running VM "{0}".'.format(vm), 2)
+        return self.hypervisor.shutdown(vm)
 
     def _vm_destroy(self, vm):
-        command = ['virsh', 'destroy', vm]
-        self._output('Destroying the currently running VM "{0}": `{1}`.'.format(vm, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Destroying the currently running VM "{0}".'.format(vm), 2)
+        return self.hypervisor.destroy(vm)
 
-    @reload_environmental_info
+    @refresh_environmental_info
     def _vm_define(self, xml_file_path):
-        command = ['virsh', 'define', xml_file_path]
-        self._output('Defining VM "{0}": `{1}`.'.format(xml_file_path, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        name = self._parse_vm_xml(self._read_file(xml_file_path)).get('name')
+        self._invalidate_info('vm_info', name)
+        self._output('Defining VM "{0}".'.format(xml_file_path), 2)
+        return self.hypervisor.define(xml_file_path)
 
-    @reload_environmental_info
+    @refresh_environmental_info
     def _vm_undefine(self, vm):
+        self._invalidate_info('vm_info', vm)
         self._vm_destroy(vm)
-        command = ['virsh', 'undefine', vm]
-        self._output('Destroyed any VM instance and undefined VM "{0}": `{1}`.'.format(vm, ' '.join(command)), 2)
-        return self._execute(command, boolean=True)
+        self._output('Destroyed any VM instance and undefined VM "{0}".'.format(vm), 2)
+        return self.hypervisor.undefine(vm)
 
     # --------------------------------------------------------------------------
     # Action common functions - LVM commands
     # --------------------------------------------------------------------------
-    def _vg_has_space(self, vg, request_size_in_g):
+    def _vg_has_space(self, vg, request_size):
         '''
         Compare specified volume group's remaining space with a requested size
-        and return a Boolean.
+        and return a Boolean. The requested size may be given in bytes or as a
+        LVM size string, e.g. "25.00g".
         '''
-        # Extract float values from size strings
-        if request_size_in_g[-1].lower() == 'g':
-            size_in_g = request_size_in_g[:-1]
-        request = float(size_in_g)
-        vg_free_string = self.vg_info(vg, 'VFree')
-        vg_free = vg_free_string[:-1]
-        vg_free = float(vg_free)
+        request = self._size_to_bytes(request_size)
+        vg_free = self.vg_info(vg, 'VFree')
 
         # Return boolean value
         return vg_free > request
 
-    @reload_environmental_info
+    @refresh_environmental_info
     def _lv_create(self, lv_size, lv_name, vg_name):
         '''
         Create a new logical volume. Will raise an error if logical volume
@@ -926,6 +3440,8 @@ class Vmpy:
         vg_path = '/dev/{0}'.format(vg_name)
         lv_path = '{0}/{1}'.format(vg_path, lv_name)
         lv_exists = bool(self.lv_info((vg_name, lv_name), None, False))
+        self._invalidate_info('vg_info', vg_name)
+        self._invalidate_info('lv_info', (vg_name, lv_name))
 
         # Check if logical volume already exists
         if lv_exists:
@@ -939,38 +3455,54 @@ class Vmpy:
         # Create logical volume
         command = ['lvcreate', '-L', '{0}'.format(lv_size), '-n', '{0}'.format(lv_name), vg_path]
         self._output('Creating LV: `{0}`'.format(' '.join(command)), 2)
-        return self._execute(command)
+        output = self._execute(command)
+        self.created_lvs.add(lv_path)
+        return output
 
-    @reload_environmental_info
-    def _lv_create_snapshot(self, vm, snapshot_name, snapshot_size='2.00g'):
+    @refresh_environmental_info
+    def _lv_create_snapshot(self, lv_path, snapshot_size='2.00g'):
         '''
-        Create a new logical volume snapshot. Will raise an error if logical
-        volume already exists.
+        Create a new logical volume snapshot named "<logical volume>.snapshot"
+        and return its path. Will raise an error if logical volume already
+        exists.
         '''
         # Set variables
-        vm_vg = self.vm_info(vm, 'volume_group')
-        vm_path = self.vm_info(vm, 'disk')
+        lv_info = self._return_lvm_info_by_path(lv_path)
+        lv_vg = lv_info['volume_group']
+        if not lv_vg:
+            self._raise('Could not create LV snapshot of "{0}", it is not a logical volume.'.format(lv_path))
+        snapshot_name = '{0}.snapshot'.format(lv_info['logical_volume'])
+        snapshot_path = '/dev/{0}/{1}'.format(lv_vg, snapshot_name)
+        self._invalidate_info('vg_info', lv_vg)
+        self._invalidate_info('lv_info', (lv_vg, snapshot_name))
+        self._invalidate_info('lv_info', (lv_vg, lv_info['logical_volume']))
 
         # Verify enough space exists in volume group
-        if not self._vg_has_space(vm_vg, snapshot_size):
-            message = 'Could not create LV snapshot sized "{0}" in VG "{1}", not enough space.'.format(snapshot_size, vm_vg)
+        if not self._vg_has_space(lv_vg, snapshot_size):
+            message = 'Could not create LV snapshot sized "{0}" in VG "{1}", not enough space.'.format(snapshot_size, lv_vg)
             self._raise(message)
 
-        # Verify vm_path exists on local machine
-        if not os.path.exists(vm_path):
-            message = 'Could not create LV snapshot in "{0}", path does not exist.'.format(vm_path)
+        # Verify lv_path exists on local machine
+        if not os.path.exists(lv_path):
+            message = 'Could not create LV snapshot in "{0}", path does not exist.'.format(lv_path)
             self._raise(message)
 
         # Create snapshot
-        command = ['lvcreate', '--snapshot', '-L', '{0}'.format(snapshot_size), '-n', '{0}'.format(snapshot_name), vm_path]
+        command = ['lvcreate', '--snapshot', '-L', '{0}'.format(snapshot_size), '-n', '{0}'.format(snapshot_name), lv_path]
         self._output('Creating LV snapshot: `{0}`'.format(' '.join(command)), 2)
-        return self._execute(command)
+        self._execute(command)
+        return snapshot_path
 
-    @reload_environmental_info
-    def _lv_import(self, source_path, target_path, compression='none'):
+    def _lv_import(self, source_path, target_path, compression='none', extent_map=None, discard=False, size=None, checksums=None):
         '''
-        Copy the contents of the source path to the target LV using DD. Source
-        may be a backup image of a LV or live snapshot.
+        Copy the contents of the source path to the target LV. Source may be
+        a backup image of a LV or live snapshot. A sparse backup image is
+        written to the regions listed in its extent_map. With discard the
+        target LV is discarded first and all-zero blocks are skipped, where
+        discarded blocks read back as zeroes, see CopyEngine.write_nonzero().
+        The disk size, if known, is used for progress reports. Passing a
+        dictionary as checksums computes the checksums of the image in it,
+        see _transfer().
         '''
         # Verify source_path exists on local machine
         if not os.path.exists(source_path):
@@ -982,19 +3514,17 @@ class Vmpy:
             message = 'Could not import LV, target path does not exist: "{0}".'.format(target_path)
             self._raise(message)
 
-        # Create commands
-        command_queue = []
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'if={0}'.format(source_path)])
+        # Set filters
+        filters = []
         if compression != 'none':
-            command_queue.append(['{0}'.format(compression), '-d'])
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'of={0}'.format(target_path)])
+            filters.append(self._decompression_filter(compression))
 
-        # Execute commands
+        # Copy image
         self._output('Importing LV', 2)
-        self._execute_queue(command_queue)
+        self._transfer(source_path, target_path, filters, write_extents=extent_map, discard=discard, size=size, checksums=checksums)
         self._output('Successful LV import', 2)
 
-    @reload_environmental_info
+    @refresh_environmental_info
     def _lv_remove(self, lv_path):
         '''
         Remove a LV on the host machine.
@@ -1004,6 +3534,16 @@ class Vmpy:
             message = 'Could not remove LV "{0}", logical volume does not exist.'.format(lv_path)
             self._raise(message)
 
+        # Mark the logical volume, and a snapshot's origin, as changed
+        lv_info = self._return_lvm_info_by_path(lv_path)
+        if lv_info['volume_group']:
+            lv_tuple = (lv_info['volume_group'], lv_info['logical_volume'])
+            origin = self.lv_info(lv_tuple, 'Origin', False)
+            self._invalidate_info('vg_info', lv_tuple[0])
+            self._invalidate_info('lv_info', lv_tuple)
+            if origin:
+                self._invalidate_info('lv_info', (lv_tuple[0], origin))
+
         # Remove logical volume
         command = ['lvremove', '-f', '{0}'.format(lv_path)]
         self._output('Removing logical volume: `{0}`.'.format(' '.join(command)), 2)
@@ -1016,9 +3556,84 @@ class Vmpy:
         '''
         Compound function to completely remove a VM from disk
         '''
-        path = self.vm_info(name, 'disk')
-        self._output('Removing VM "{0}" and VM disk "{1}"'.format(name, path))
-        return self._vm_undefine(name) and self._lv_remove(path)
+        disks = self.vm_info(name, 'disks') or []
+        paths = [disk['disk'] for disk in disks if disk['logical_volume']]
+        self._output('Removing VM "{0}" and VM disk(s) "{1}"'.format(name, '", "'.join(paths)))
+        with self.info_transaction():
+            if not self._vm_undefine(name):
+                return False
+            return all([self._lv_remove(path) for path in paths])
+
+    def _vm_lv_disks(self, vm):
+        '''
+        Return the disks of a VM, verifying every disk is a logical volume.
+        '''
+        disks = self.vm_info(vm, 'disks') or []
+        if not disks:
+            self._raise('Could not find a disk for VM "{0}".'.format(vm))
+        for disk in disks:
+            if not disk['logical_volume']:
+                self._raise('Only logical volume backed disks are supported. VM "{0}" disk "{1}" is not a logical volume: "{2}"'.format(vm, disk['target'], disk['disk'] or disk['disk_file']))
+        return disks
+
+    def _vm_snapshot_disks(self, vm, snapshot_size='2.00g'):
+        '''
+        Create a LV snapshot of every disk of a VM and return the snapshot
+        paths in disk order. A running VM is suspended while the snapshots
+        are taken, so the disks are captured at the same point in time.
+        '''
+        # Set variables
+        disks = self._vm_lv_disks(vm)
+        initial_vm_status = self.vm_info(vm, 'status')
+        snapshot_paths = []
+
+        # Verify each volume group has space for all of its snapshots
+        requests = {}
+        for disk in disks:
+            vg = disk['volume_group']
+            requests[vg] = requests.get(vg, 0) + self._size_to_bytes(snapshot_size)
+        for vg, request in sorted(requests.items()):
+            if not self._vg_has_space(vg, request):
+                self._raise('Could not create {0} LV snapshot(s) in VG "{1}", not enough space.'.format(request // self._size_to_bytes(snapshot_size), vg))
+
+        # If VM is running suspend it. Cache status for later.
+        if initial_vm_status == 'running':
+            self._vm_suspend(vm)
+
+        # Create a LV snapshot of each disk
+        try:
+            with self.info_transaction():
+                for disk in disks:
+                    snapshot_paths.append(self._lv_create_snapshot(disk['disk'], snapshot_size))
+        except BaseException:
+            self._vm_remove_snapshots(snapshot_paths)
+            raise
+        finally:
+            # If VM was running (refer to cached variable), restart it.
+            if initial_vm_status == 'running':
+                self._vm_resume(vm)
+
+        return snapshot_paths
+
+    def _vm_remove_snapshots(self, snapshot_paths):
+        '''
+        Remove the LV snapshots created by _vm_snapshot_disks().
+        '''
+        with self.info_transaction():
+            for snapshot_path in snapshot_paths:
+                self._lv_remove(snapshot_path)
+
+    def _potential_conflicts(self, target_meta):
+        '''
+        Return the (attribute, value) pairs of a target VM that must not be
+        shared with a VM defined on the host machine.
+        '''
+        potential_conflicts = [('name', target_meta['name'])]
+        for disk in target_meta['disks']:
+            potential_conflicts.append(('disk', disk['disk']))
+        potential_conflicts.append(('uuid', target_meta['uuid']))
+        potential_conflicts.append(('mac', target_meta['mac'].lower()))
+        return potential_conflicts
 
     def _vm_resolve_conflicts(self, potential_conflicts):
         '''
@@ -1056,6 +3671,35 @@ class Vmpy:
                     else:
                         self._vm_resolve_conflicts(potential_conflicts[i:])
 
+    def _import_disks(self, source_disks, target_meta, import_lv, source_pvs=False, compressions=(), create=True):
+        '''
+        Create the target logical volumes, unless create is False, then fill
+        each one by calling import_lv(source_disk, target_disk). Disks are
+        streamed concurrently, bounded per physical volume of the target
+        logical volumes, and of the source logical volumes as well when
+        source_pvs is set.
+        '''
+        pairs = zip(source_disks, target_meta['disks'])
+
+        # Choose the decompressors before any transfer opens its pipes
+        for compression in set(compressions) - set(['none']):
+            self._decompression_filter(compression)
+
+        # Create logical volumes
+        if create:
+            with self.info_transaction():
+                for source_disk, target_disk in pairs:
+                    self._lv_create(target_disk['logical_volume_size'], target_disk['logical_volume'], target_disk['volume_group'])
+
+        # Copy disk images to the new logical volumes
+        pvs = []
+        for source_disk, target_disk in pairs:
+            disk_pvs = self._lv_pvs((target_disk['volume_group'], target_disk['logical_volume']))
+            if source_pvs:
+                disk_pvs = disk_pvs + self._lv_pvs((source_disk['volume_group'], source_disk['logical_volume']))
+            pvs.append(disk_pvs)
+        self._parallel_per_pv(lambda item: import_lv(*item), pairs, pvs)
+
     # --------------------------------------------------------------------------
     # Action common functions - Meta and XML functions
     # --------------------------------------------------------------------------
@@ -1063,11 +3707,16 @@ class Vmpy:
         '''
         Verify target meta data.
         '''
-        # Verify volume group exists and has space for logical volume
-        if not self.vg_info(meta['volume_group'], None, False):
-            self._raise('The target volume group does not exist on the local machine: "{0}"'.format(meta['volume_group']))
-        if not self._vg_has_space(meta['volume_group'], meta['image_size']):
-            self._raise('The target volume group does not have enough space for new logical volume: "{0}"'.format(meta['volume_group']))
+        # Verify volume groups exist and have space for all logical volumes
+        requests = {}
+        for disk in meta['disks']:
+            vg = disk['volume_group']
+            if not self.vg_info(vg, None, False):
+                self._raise('The target volume group does not exist on the local machine: "{0}"'.format(vg))
+            requests[vg] = requests.get(vg, 0) + self._size_to_bytes(disk['logical_volume_size'])
+        for vg, request in sorted(requests.items()):
+            if not self._vg_has_space(vg, request):
+                self._raise('The target volume group does not have enough space for new logical volume(s): "{0}"'.format(vg))
 
         # Verify bridge exists
         bridge_command = ['ifconfig', meta['bridge']]
@@ -1089,7 +3738,7 @@ class Vmpy:
             meta['name'] = self.args.name
 
         if action == 'clone':
-            meta['uuid'] = None
+            meta['uuid'] = self._create_uuid()
 
         if hasattr(self.args, 'volume_group') and self.args.volume_group:
             meta['volume_group'] = self.args.volume_group
@@ -1114,6 +3763,25 @@ class Vmpy:
 
         meta['disk'] = '/dev/' + meta['volume_group'] + '/' + meta['logical_volume']
 
+        # Set target disks. The primary disk takes the values above, each
+        # additional disk gets a logical volume named "<logical volume>-<target>".
+        disks = []
+        for i, source_disk in enumerate(self._meta_disks(meta)):
+            disk = dict(source_disk)
+            if i == 0:
+                disk['logical_volume'] = meta['logical_volume']
+                disk['logical_volume_size'] = meta['logical_volume_size']
+                disk['volume_group'] = meta['volume_group']
+            else:
+                disk['logical_volume'] = '{0}-{1}'.format(meta['logical_volume'], source_disk['target'])
+                disk['logical_volume_size'] = source_disk['image_size']
+                if hasattr(self.args, 'volume_group') and self.args.volume_group:
+                    disk['volume_group'] = self.args.volume_group
+            disk['disk'] = '/dev/' + disk['volume_group'] + '/' + disk['logical_volume']
+            disk['disk_file'] = None
+            disks.append(disk)
+        meta['disks'] = disks
+
         return meta
 
     def _pprint_meta(self, source_meta, target_meta=None):
@@ -1130,17 +3798,31 @@ class Vmpy:
             ('image', 'Disk Image File'),
             ('image_size', 'Disk Image File Size'),
             ('compression', 'Disk Image File Compression'),
+            ('compression_level', 'Disk Image File Compression Level'),
+            ('compression_threads', 'Disk Image File Compression Threads'),
+            ('sparse', 'Disk Image File Sparse'),
+            ('incremental', 'Disk Image File Chunk Manifest'),
+            ('base', 'Incremental Backup Base'),
+            ('chunk_store', 'Chunk Store'),
             ('uuid', 'VM UUID'),
             ('mac', 'VM Networking MAC Address'),
             ('bridge', 'VM Networking Bridge')
         ]
         spacer = '    '
 
+        def disks(meta):
+            # List disks beyond the primary disk shown above
+            lines = ''
+            for disk in self._meta_disks(meta)[1:]:
+                lines = lines + spacer + 'Additional Disk "{0}": {1} ({2}, {3})\n'.format(disk['target'], disk['disk'], disk['image'] or disk.get('chunks'), disk['image_size'])
+            return lines
+
         if source_meta:
             source = '\nSource VM Information:\n'
             for key, title in order:
                 if key in source_meta:
                     source = source + spacer + '{0}: {1}\n'.format(title, source_meta.get(key))
+            source = source + disks(source_meta)
             self._output(source)
 
         if target_meta:
@@ -1148,6 +3830,7 @@ class Vmpy:
             for key, title in order:
                 if key in target_meta:
                     target = target + spacer + '{0}: {1}\n'.format(title, target_meta.get(key))
+            target = target + disks(target_meta)
             self._output(target)
 
     def _load_target_xml(self, source_xml, source_meta, target_meta, action='clone'):
@@ -1169,12 +3852,17 @@ class Vmpy:
             self._raise('Could not create target XML, value "{0}" not found in source XML.'.format(source))
         target_xml = target_xml.replace(source, target)
 
-        # Replace disk
-        source = "<source dev='" + source_meta['disk'] + "'/>"
-        target = "<source dev='" + target_meta['disk'] + "'/>"
-        if target_xml.find(source) == -1:
-            self._raise('Could not create target XML, value "{0}" not found in source XML.'.format(source))
-        target_xml = target_xml.replace(source, target)
+        # Replace disks. Placeholders keep a target path from being replaced
+        # again when it matches the source path of another disk.
+        pairs = zip(self._meta_disks(source_meta), target_meta['disks'])
+        for i, (source_disk, target_disk) in enumerate(pairs):
+            source = "<source dev='" + source_disk['disk'] + "'/>"
+            if target_xml.find(source) == -1:
+                self._raise('Could not create target XML, value "{0}" not found in source XML.'.format(source))
+            target_xml = target_xml.replace(source, '\0disk-{0}\0'.format(i))
+        for i, (source_disk, target_disk) in enumerate(pairs):
+            target = "<source dev='" + target_disk['disk'] + "'/>"
+            target_xml = target_xml.replace('\0disk-{0}\0'.format(i), target)
 
         # Replace MAC
         source = "<mac address='" + source_meta['mac'] + "'/>"
@@ -1190,12 +3878,12 @@ class Vmpy:
             self._raise('Could not create target XML, value "{0}" not found in source XML.'.format(source))
         target_xml = target_xml.replace(source, target)
 
-        # Remove UUID line
+        # Replace UUID
         if action == 'clone':
             source = "<uuid>" + source_meta['uuid'] + "</uuid>"
-            target = ""
+            target = "<uuid>" + target_meta['uuid'] + "</uuid>"
             if target_xml.find(source) == -1:
-                self._raise('Could not create target XML, could not remove UUID line. Value "{0}" not found in source XML.'.format(source))
+                self._raise('Could not create target XML, could not replace UUID line. Value "{0}" not found in source XML.'.format(source))
             target_xml = target_xml.replace(source, target)
 
         # Return target XML
@@ -1207,7 +3895,7 @@ class Vmpy:
     def backup(self):
         '''
         Take a VM and create a backup of its configuration (XML), raw
-        disk-image (LVM logical volume), and some meta-data about the
+        disk-images (LVM logical volumes), and some meta-data about the
         VM (meta). Save these files either locally or remotely.
         '''
         self._output('Starting Backup action.', 2)
@@ -1218,157 +3906,383 @@ class Vmpy:
 
         # Set variables
         vm = self.args.name
-        initial_vm_status = self.vm_info(vm, 'status')
-        snapshot_name = '{0}.snapshot'.format(vm)
-        vm_path = self.vm_info(vm, 'disk')
-        snapshot_path = '{0}.snapshot'.format(vm_path)
 
-        # If VM is running suspend it. Cache status for later.
-        if initial_vm_status == 'running':
-            self._vm_suspend(vm)
+        if self.args.resume:
+            # Continue an interrupted backup with the meta data and the LV
+            # snapshots it was started with
+            checkpoint = self._load_checkpoint('backup', vm)
+            meta = checkpoint['meta']
+            snapshot_paths = checkpoint['snapshots']
+            for snapshot_path in snapshot_paths:
+                if not os.path.exists(snapshot_path):
+                    self._raise('Could not resume the backup, its LV snapshot no longer exists: "{0}"'.format(snapshot_path))
+        else:
+            # An interrupted backup keeps LV snapshots that only its
+            # checkpoint file records, so it is not overwritten silently
+            self._discard_backup_checkpoint()
+            meta = self._create_vm_meta(vm)
 
-        # Create a LV snapshot
-        self._lv_create_snapshot(vm, snapshot_name)
+            # Base an incremental backup on the chunk manifests of an earlier one
+            if self.args.base:
+                self._backup_load_base(meta)
 
-        # If VM was running (refer to cached variable), restart it.
-        if initial_vm_status == 'running':
-            self._vm_resume(vm)
+            # Create a LV snapshot of every disk, suspending a running VM
+            snapshot_paths = self._vm_snapshot_disks(vm)
+
+            # Record a backup saved in chunks, so it can be resumed
+            if meta['checkpoint_size']:
+                self._save_checkpoint({'action': 'backup', 'name': vm, 'source': self.args.source, 'remote': self.args.remote, 'snapshots': snapshot_paths, 'meta': meta})
 
-        # Branch to either local or remote backup to save image
+        # Branch to either local or remote backup to save images
+        keep_snapshots = False
         try:
             if self.args.remote:
-                self._backup_remote()
+                self._backup_remote(meta, snapshot_paths)
                 success_message = 'Success: completed remote backup of VM "{0}" to "{1}".'.format(vm, '{0}:{1}'.format(self.args.remote, self.args.name))
             else:
-                self._backup_local()
+                self._backup_local(meta, snapshot_paths)
                 success_message = 'Success: completed backup of VM "{0}" to "{1}".'.format(vm, '{0}{1}'.format(self.args.source, vm))
         except BaseException, e:
+            # A backup saved in chunks keeps its LV snapshots to be resumed
+            if self.checkpoint:
+                keep_snapshots = True
+                self._output('The backup was interrupted. Run it again with --resume to continue from the last saved chunk. Until then the LV snapshots are kept: "{0}"'.format('", "'.join(snapshot_paths)), 0)
             self._raise(e)
         finally:
-            # If copying snapshot fails we ensure the LV snapshot is removed,
+            # If copying snapshots fails we ensure the LV snapshots are removed,
             # preventing an unstable scenario when running from an unmonitored
             # terminal (such as a backup script on a cron job).
-            self._lv_remove(snapshot_path)
+            if not keep_snapshots:
+                self._vm_remove_snapshots(snapshot_paths)
+        self._remove_checkpoint()
 
         # Success message
         self._output(success_message)
 
+    def _discard_backup_checkpoint(self):
+        '''
+        Refuse to start a new backup while the checkpoint file holds an
+        interrupted backup, unless --discard-checkpoint is given. Then the
+        LV snapshots it kept and the checkpoint file are removed.
+        '''
+        if not os.path.isfile(self.checkpoint_file):
+            return
+        checkpoint = json.loads(self._read_file(self.checkpoint_file))
+        if checkpoint.get('action') != 'backup':
+            return
+
+        snapshot_paths = [path for path in checkpoint.get('snapshots', []) if os.path.exists(path)]
+        if not self.args.discard_checkpoint:
+            self._raise('The backup of "{0}" to "{1}" was interrupted and kept its LV snapshots: "{2}". Continue it with --resume, or remove them with --discard-checkpoint.'.format(checkpoint.get('name'), checkpoint.get('source'), '", "'.join(checkpoint.get('snapshots', []))))
+
+        self._output('Discarding the interrupted backup of "{0}" to "{1}"'.format(checkpoint.get('name'), checkpoint.get('source')))
+        self._vm_remove_snapshots(snapshot_paths)
+        self._unlink_file(self.checkpoint_file)
+
+    def _backup_load_base(self, meta):
+        '''
+        Load the meta data of the --base backup and point every disk at the
+        chunk manifest of the same disk in it. Disks the base backup does not
+        have are saved in full.
+        '''
+        base = self.args.base
+        path = os.path.join(base, 'meta.txt')
+        self._output('Loading the base backup meta data: "{0}"'.format(path), 2)
+        if self.args.remote:
+            base_meta = self._load_vm_meta(self._remote_read_file(path))
+        else:
+            base_meta = self._load_vm_meta_from_file(path)
+
+        if not base_meta.get('incremental'):
+            self._raise('The base backup was not made with --incremental and has no chunk manifests: "{0}"'.format(base))
+
+        base_disks = dict((disk['target'], disk) for disk in self._meta_disks(base_meta))
+        for disk in meta['disks']:
+            base_disk = base_disks.get(disk['target'])
+            if base_disk and base_disk.get('manifest'):
+                disk['base_manifest'] = os.path.join(base, base_disk['manifest'])
+        meta['base'] = base
+
+    def _backup_disks(self, meta, snapshot_paths, backup_lv):
+        '''
+        Save the LV snapshot of every disk to its disk image by calling
+        backup_lv(disk, snapshot_path). Disks are streamed concurrently,
+        bounded per physical volume.
+        '''
+        disks = meta['disks']
+        pvs = [self._lv_pvs((disk['volume_group'], disk['logical_volume'])) for disk in disks]
+        self._output('Backing Up {0} VM disk image(s). This will take time.'.format(len(disks)), show_timestamp=True)
+        self._parallel_per_pv(lambda item: backup_lv(*item), zip(disks, snapshot_paths), pvs)
+
+    def _backup_lv_image(self, disk, snapshot_path, target, filters, read_file, write_file):
+        '''
+        Stream a LV snapshot through filters to the disk image target, then
+        save the extent map of a sparse image and the chunk manifest of an
+        incremental one by calling write_file(name, data). The chunk manifest
+        of the base backup is loaded by calling read_file(path). The sha256
+        checksums of the uncompressed stream and of the image are saved in
+        disk.
+        '''
+        extent_map = {} if disk.get('extents') else None
+        manifest = None
+        base_manifest = None
+        if disk.get('manifest'):
+            if disk.get('base_manifest'):
+                base_manifest = self._load_manifest(read_file(disk['base_manifest']))
+                manifest = {'chunk_size': base_manifest['chunk_size']}
+            else:
+                manifest = {'chunk_size': self._size_to_bytes(self.args.chunk_size)}
+
+        checksums = {}
+        self._transfer(snapshot_path, target, filters, read_extents=extent_map, manifest=manifest, base_manifest=base_manifest, size=self._size_to_bytes(disk['image_size']), checksums=checksums, compressed='target')
+        disk['raw_sha256'] = checksums['raw']
+        disk['image_sha256'] = checksums['image']
+
+        if extent_map is not None:
+            write_file(disk['extents'], self._return_json(extent_map))
+        if manifest is not None:
+            write_file(disk['manifest'], self._return_json(manifest))
+
+    def _backup_lv_chunks(self, disk, snapshot_path, filters, chunk_target, image_length):
+        '''
+        Save a LV snapshot to a disk image in chunks of --checkpoint-size
+        bytes. Each chunk is compressed on its own and appended to the image,
+        which still decompresses as one stream. chunk_target(offset) returns
+        the target and target offset, see _transfer(), writing the image from
+        offset on, image_length() the length of the saved image. A chunk is
+        acknowledged when the image grew by the bytes sent, then recorded in
+        disk['checkpoints'] with its checksums and saved to the checkpoint
+        file. Chunks recorded by an interrupted backup are skipped.
+        '''
+        size = self._size_to_bytes(disk['image_size'])
+        chunk_size = self._size_to_bytes(self.checkpoint['meta']['checkpoint_size'])
+        count = -(-size // chunk_size)
+        chunks = disk['checkpoints']
+        image_offset = sum(chunk['image_length'] for chunk in chunks)
+        if 0 < len(chunks) < count:
+            self._output('Resuming the backup of "{0}" at chunk {1} of {2}'.format(snapshot_path, len(chunks) + 1, count))
+
+        for i in xrange(len(chunks), count):
+            offset = i * chunk_size
+            length = min(chunk_size, size - offset)
+            target, target_offset = chunk_target(image_offset)
+            checksums = {}
+            self._transfer(snapshot_path, target, filters, size=length, checksums=checksums, compressed='target', source_range=(offset, length), offset=target_offset, truncate=True)
+
+            # Acknowledge and record the chunk
+            image_end = image_length()
+            if image_end != image_offset + checksums['image_length']:
+                self._raise('Chunk {0} of "{1}" was not saved completely, the image is {2} bytes long instead of {3}.'.format(i + 1, disk['image'], image_end, image_offset + checksums['image_length']))
+            with self.checkpoint_lock:
+                chunks.append({
+                    'offset': offset,
+                    'length': length,
+                    'image_offset': image_offset,
+                    'image_length': checksums['image_length'],
+                    'raw_sha256': checksums['raw'],
+                    'image_sha256': checksums['image'],
+                })
+                self._save_checkpoint()
+            image_offset = image_end
+            self._output('Saved chunk {0} of {1} of "{2}"'.format(i + 1, count, snapshot_path), 2)
+
     # --------------------------------------------------------------------------
     # Action function - Backup Remote
     # --------------------------------------------------------------------------
-    def _backup_remote(self):
+    def _backup_remote(self, meta, snapshot_paths):
         '''
-        Backup VM meta info, XML and LV snapshot to a remote location via `ssh`
+        Backup VM meta info, XML and LV snapshots to a remote location via `ssh`
         '''
         self._output('Executing remote backup action', 2)
 
-        # Verify remote directory
-        self._backup_remote_directory()
+        # Verify remote directory and its free space
+        self._backup_remote_directory(meta)
 
-        # Backup our internal meta data
-        self._backup_remote_meta_info()
+        # Backup our internal meta data and `virsh dumpxml` output
+        self._backup_remote_meta_info(meta)
 
-        # Backup `virsh dumpxml` output
-        self._backup_remote_xml()
+        # Backup logical volume snapshots to disk image files
+        self._backup_disks(meta, snapshot_paths, self._backup_remote_lv)
 
-        # Backup logical volume snapshot to disk image file using `dd`
-        self._backup_remote_lv()
+        # Save the disk image checksums to the meta data
+        self._backup_remote_file('meta.txt', self._return_json(meta))
 
-    def _backup_remote_directory(self):
+    def _backup_remote_directory(self, meta):
         '''
-        Verify the remote directory exists. If not, attempt to create it.
+        Verify the remote directory and the free space of its file system,
+        see _remote_manifest(). It is created along with the first files
+        sent to it, see _backup_remote_files().
         '''
-        command = self._remote_ssh_command(['mkdir', '-p', '{0}'.format(self.args.source)])
-        self._output('Verifying the remote directory over ssh, creating it if needed: {0}'.format(' '.join(command)), 2)
-        self._execute(command)
-
-    def _backup_remote_meta_info(self):
+        manifest = self._remote_manifest(self.args.source)
+        if not manifest['exists']:
+            self._output('The remote directory does not exist and will be created: "{0}:{1}"'.format(self.args.remote, self.args.source), 2)
+        if manifest['free'] is None:
+            return
+
+        # Uncompressed disk images need the size of the disks, compressed
+        # ones usually far less
+        size = sum(self._size_to_bytes(disk['image_size']) for disk in meta['disks'])
+        self._output('The remote directory has {0} free for {1} of disks'.format(self._format_bytes(manifest['free']), self._format_bytes(size)), 2)
+        if meta['compression'] == 'none' and manifest['free'] < size:
+            self._output('Warning: the remote directory has {0} free, the uncompressed disk images need {1}: "{2}:{3}"'.format(self._format_bytes(manifest['free']), self._format_bytes(size), self.args.remote, self.args.source))
+
+    def _backup_remote_meta_info(self, meta_dict):
         '''
-        Send the VM meta file over `scp`
+        Send the VM meta file and XML file in one `ssh` call
         '''
-        # Save locally then transfer via SCP. Not ideal but popen() has trouble
-        # with directional pipes without resorting to shell=True. Since we have
-        # user input we don't want to use shell=True.
-        local_meta_file = '{0}-{1}.temp.meta.txt'.format(self.args.name, self.now)
-        self._output('Writing temporary meta info file locally at "{0}" before transfering via SCP remotely.'.format(local_meta_file), 2)
-        meta_dict = self._create_vm_meta(self.args.name)
-        meta_json = self._return_json(meta_dict)
-        self._write_file(local_meta_file, meta_json)
-
         # Display action/meta information
         self._output('Backup VM "{0}" to "{1}"'.format(self.args.name, self.args.source))
         self._pprint_meta(meta_dict)
 
-        self._output('Now executing SCP file transfer of local meta info file.', 2)
-        target = '{0}meta.txt'.format(self.args.source)
-        command = self._remote_target_scp_command(local_meta_file, target)
-        self._execute(command)
-
-        self._output('Unlinking the local temporary meta info file at "{0}".'.format(local_meta_file), 2)
-        self._unlink_file(local_meta_file)
+        self._backup_remote_files([
+            ('meta.txt', self._return_json(meta_dict)),
+            ('{0}.xml'.format(self.args.name), self.vm_xml(self.args.name)),
+        ])
 
-    def _backup_remote_xml(self):
+    def _backup_remote_file(self, name, data):
         '''
-        Send the VM XML file over `scp`
+        Send data to a file in the remote backup directory over `ssh`
         '''
-        # Save locally then transfer via SCP. Not ideal but popen() has trouble
-        # with directional pipes without resorting to shell=True. Since we have
-        # user input we don't want to use shell=True.
-        target_xml_file = os.path.realpath('{0}-{1}.temp.xml'.format(self.args.name, self.now))
-        self._output('Writing temporary VM XML file locally at "{0}" before transfering via SCP remotely.'.format(target_xml_file), 2)
-        self._write_file(target_xml_file, self.vm_info(self.args.name, 'xml'))
+        self._backup_remote_files([(name, data)])
 
-        self._output('Now executing SCP file transfer of local VM XML file', 2)
-        target = '{0}{1}.xml'.format(self.args.source, self.args.name)
-        command = self._remote_target_scp_command(target_xml_file, target)
-        self._execute(command)
-
-        self._output('Unlinking the local temporary VM XML file at "{0}".'.format(target_xml_file), 2)
-        self._unlink_file(target_xml_file)
-
-    @execute_safely
-    def _backup_remote_lv(self):
+    def _backup_remote_files(self, files):
         '''
-        Convert the LV snapshot to a disk image in a remote location using `ssh`.
+        Send (name, data) files to the remote backup directory, creating it
+        if needed, as a tar archive piped to `tar` over one `ssh` call.
+        '''
+        archive_data = io.BytesIO()
+        archive = tarfile.open(fileobj=archive_data, mode='w')
+        for name, data in files:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            info = tarfile.TarInfo(os.path.normpath(name))
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0644
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+
+        self._output('Sending {0} file(s) to the remote directory: "{1}"'.format(len(files), ', '.join(name for name, data in files)), 2)
+        directory = pipes.quote(self.args.source)
+        command = self._remote_ssh_command(['mkdir', '-p', directory, '&&', 'tar', '-x', '-f', '-', '-C', directory])
+        self._execute(command, input=archive_data.getvalue())
+
+    def _backup_remote_lv(self, disk, snapshot_path):
+        '''
+        Convert a LV snapshot to a disk image in a remote location using `ssh`.
         If specified, use compression on local side first.
         '''
         # Set variables
-        vm = self.args.name
-        vm_path = self.vm_info(vm, 'disk')
+        filters = []
         if self.args.compression != 'none':
-            zip_extension = '.' + self.args.compression
-            zip_command = [str(self.args.compression), '-c']
-        else:
-            zip_extension = ''
-            zip_command = None
-        of = '{0}{1}.img{2}'.format(self.args.source, vm, zip_extension)
-
-        # Create commands
-        command_queue = []
-
-        # Add dd command
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'if={0}.snapshot'.format(vm_path)])
+            filters.append(self._compression_command(self.args.compression, level=self.args.compression_level))
+        of = os.path.join(self.args.source, disk['image'])
+
+        # Remote ssh command
+        block_size = self._block_size(target=self._remote_ssh_command([]))
+        ssh_command = self._remote_ssh_command(['dd', 'bs={0}'.format(block_size), 'of={0}'.format(pipes.quote(of))])
+
+        # Save the image in chunks. `dd` truncates the image at the offset
+        # it starts writing at, dropping a chunk an interruption cut short.
+        if disk.get('checkpoints') is not None:
+            self._output('Starting remote backup of "{0}" in chunks'.format(snapshot_path), 2)
+            chunk_target = lambda offset: (self._remote_ssh_command(['dd', 'bs={0}'.format(block_size), 'of={0}'.format(pipes.quote(of)), 'seek={0}'.format(offset), 'oflag=seek_bytes', 'conv=fsync']), None)
+            image_length = lambda: int(self._execute(self._remote_ssh_command(['stat', '-c', '%s', pipes.quote(of)])).strip())
+            self._backup_lv_chunks(disk, snapshot_path, filters, chunk_target, image_length)
+            self._output('Successfully completed remote backup of "{0}"'.format(snapshot_path), 2)
+            return
+
+        # Split the image over concurrent ssh connections. Extent maps and
+        # chunk manifests are built from one stream.
+        if self.args.ssh_streams > 1:
+            if disk.get('extents') or disk.get('manifest'):
+                self._output('Sparse and incremental disk images are sent over one ssh connection: "{0}"'.format(snapshot_path), 2)
+            else:
+                self._output('Starting remote backup of "{0}" over {1} ssh connections'.format(snapshot_path, self.args.ssh_streams), 2)
+                self._backup_remote_streams(disk, snapshot_path, filters, of, block_size)
+                self._output('Successfully completed remote backup of "{0}"'.format(snapshot_path), 2)
+                return
 
-        # Add zip command
-        if zip_command:
-            command_queue.append(zip_command)
+        # Copy image
+        self._output('Starting remote backup of "{0}"'.format(snapshot_path), 2)
+        self._backup_lv_image(disk, snapshot_path, ssh_command, filters, self._remote_read_file, self._backup_remote_file)
+        self._output('Successfully completed remote backup of "{0}"'.format(snapshot_path), 2)
 
-        # Add remote ssh command
-        ssh_command = self._remote_ssh_command(['dd', 'bs={0}'.format(self.args.block_size), 'of={0}'.format(of)])
-        command_queue.append(ssh_command)
+    def _backup_remote_streams(self, disk, snapshot_path, filters, of, block_size):
+        '''
+        Save a LV snapshot to the remote disk image at path of, over
+        --ssh-streams concurrent ssh connections, each sending a byte range of
+        the snapshot. The ranges run at once on the --streams-per-pv slot the
+        disk holds, see _backup_disks(). Without compression the
+        range is written in place, otherwise it is compressed on its own and
+        saved to a part file next to the image. The parts are then joined to
+        the image, which decompresses as one stream. The ranges are recorded
+        in disk['checkpoints'] like the chunks of _backup_lv_chunks(), so
+        imports read them in parallel as well.
+        '''
+        size = self._size_to_bytes(disk['image_size'])
+        ranges = self._stream_ranges(size, block_size)
 
-        # Execute commands
-        self._output('Backing Up VM disk image. This will take time.', show_timestamp=True)
-        self._output('Starting dd remote backup', 2)
-        self._execute_queue(command_queue)
-        self._output('Successfully completed dd remote backup', 2)
+        # Without compression every range is written in place
+        if not filters:
+            self._execute(self._remote_ssh_command(['truncate', '-s', str(size), pipes.quote(of)]))
+            targets = [['dd', 'bs={0}'.format(block_size), 'of={0}'.format(pipes.quote(of)), 'seek={0}'.format(offset), 'oflag=seek_bytes', 'conv=notrunc'] for offset, length in ranges]
+        else:
+            parts = ['{0}.part{1}'.format(of, i) for i in xrange(len(ranges))]
+            targets = [['dd', 'bs={0}'.format(block_size), 'of={0}'.format(pipes.quote(part))] for part in parts]
+
+        def send(i):
+            offset, length = ranges[i]
+            checksums = {}
+            target = self._remote_ssh_command(targets[i], multiplex=False)
+            self._transfer(snapshot_path, target, filters, size=length, checksums=checksums, compressed='target', source_range=(offset, length))
+            return checksums
+
+        if not filters:
+            results = self._parallel_map(send, range(len(ranges)), len(ranges))
+        else:
+            try:
+                results = self._parallel_map(send, range(len(ranges)), len(ranges))
+
+                # Join the parts to the image in one remote call
+                self._output('Joining {0} parts of remote disk image: "{1}"'.format(len(parts), of), 3)
+                self._execute(self._remote_ssh_command(['cat'] + [pipes.quote(part) for part in parts] + ['>', pipes.quote(of)]))
+            finally:
+                self._execute(self._remote_ssh_command(['rm', '-f'] + [pipes.quote(part) for part in parts]), boolean=True)
+
+        # Record the chunks and acknowledge the joined image
+        chunks = []
+        image_offset = 0
+        for (offset, length), checksums in zip(ranges, results):
+            chunks.append({
+                'offset': offset,
+                'length': length,
+                'image_offset': image_offset,
+                'image_length': checksums['image_length'],
+                'raw_sha256': checksums['raw'],
+                'image_sha256': checksums['image'],
+            })
+            image_offset += checksums['image_length']
+        image_end = int(self._execute(self._remote_ssh_command(['stat', '-c', '%s', pipes.quote(of)])).strip())
+        if image_end != image_offset:
+            self._raise('The remote disk image "{0}" was not saved completely, it is {1} bytes long instead of {2}.'.format(of, image_end, image_offset))
+        disk['checkpoints'] = chunks
+
+    def _stream_ranges(self, size, alignment):
+        '''
+        Split size bytes into one (offset, length) range per --ssh-streams
+        connection. Ranges start at multiples of alignment bytes.
+        '''
+        length = -(-size // self.args.ssh_streams)
+        length = max(alignment, -(-length // alignment) * alignment)
+        return [(offset, min(length, size - offset)) for offset in xrange(0, size, length)] or [(0, 0)]
 
     # --------------------------------------------------------------------------
     # Action function - Backup Local
     # --------------------------------------------------------------------------
-    def _backup_local(self):
+    def _backup_local(self, meta, snapshot_paths):
         '''
-        Backup VM meta info, XML and LV snapshot to local directory
+        Backup VM meta info, XML and LV snapshots to local directory
         '''
         self._output('Executing local backup action', 2)
 
@@ -1376,13 +4290,16 @@ class Vmpy:
         self._verify_local_vm_storage()
 
         # Backup our internal meta data
-        self._backup_local_meta_info()
+        self._backup_local_meta_info(meta)
 
         # Backup `virsh dumpxml` output
         self._backup_local_xml()
 
-        # Backup logical volume snapshot to disk image file using `dd`
-        self._backup_local_lv()
+        # Backup logical volume snapshots to disk image files
+        self._backup_disks(meta, snapshot_paths, self._backup_local_lv)
+
+        # Save the disk image checksums to the meta data
+        self._write_file('{0}/meta.txt'.format(self.args.source), self._return_json(meta))
 
     def _verify_local_vm_storage(self):
         '''
@@ -1404,13 +4321,12 @@ class Vmpy:
 
         self._output('Verified storage directory in "{0}"'.format(path), 2)
 
-    def _backup_local_meta_info(self):
+    def _backup_local_meta_info(self, meta_dict):
         '''
         Backup VM metadata info file
         '''
         # Backup meta to file
         meta_file = '{0}/meta.txt'.format(self.args.source)
-        meta_dict = self._create_vm_meta(self.args.name)
         meta_json = self._return_json(meta_dict)
         self._write_file(meta_file, meta_json)
 
@@ -1423,37 +4339,51 @@ class Vmpy:
         Backup VM XML to file
         '''
         xml_file = '{0}/{1}.xml'.format(self.args.source, self.args.name)
-        self._write_file(xml_file, self.vm_info(self.args.name, 'xml'))
+        self._write_file(xml_file, self.vm_xml(self.args.name))
 
-    @execute_safely
-    def _backup_local_lv(self):
+    def _backup_local_lv(self, disk, snapshot_path):
         '''
-        Backup VM logical volume snapshot to a disk image, using compression
+        Backup a VM logical volume snapshot to a disk image, using compression
         if specified.
         '''
+        if disk.get('chunks'):
+            return self._backup_chunk_store_lv(disk, snapshot_path)
+
         # Set variables
-        vm = self.args.name
-        vm_path = self.vm_info(vm, 'disk')
+        filters = []
         if self.args.compression != 'none':
-            zip_extension = '.' + self.args.compression
-            zip_command = [str(self.args.compression), '-c']
-        else:
-            zip_extension = ''
-            zip_command = None
-        of = '{0}{1}.img{2}'.format(self.args.source, vm, zip_extension)
-
-        # Create commands
-        command_queue = []
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'if={0}.snapshot'.format(vm_path)])
-        if zip_command:
-            command_queue.append(zip_command)
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'of={0}'.format(of)])
-
-        # Execute commands
-        self._output('Backing Up VM disk image. This will take time.', show_timestamp=True)
-        self._output('Starting dd local backup', 2)
-        self._execute_queue(command_queue)
-        self._output('Successfully completed dd local backup', 2)
+            filters.append(self._compression_command(self.args.compression, level=self.args.compression_level))
+        of = os.path.join(self.args.source, disk['image'])
+
+        # Save the image in chunks
+        if disk.get('checkpoints') is not None:
+            self._output('Starting local backup of "{0}" in chunks'.format(snapshot_path), 2)
+            self._backup_lv_chunks(disk, snapshot_path, filters, lambda offset: (of, offset), lambda: os.path.getsize(of))
+            self._output('Successfully completed local backup of "{0}"'.format(snapshot_path), 2)
+            return
+
+        # Copy image
+        self._output('Starting local backup of "{0}"'.format(snapshot_path), 2)
+        write_file = lambda name, data: self._write_file(os.path.join(self.args.source, name), data)
+        self._backup_lv_image(disk, snapshot_path, of, filters, self._read_file, write_file)
+        self._output('Successfully completed local backup of "{0}"'.format(snapshot_path), 2)
+
+    def _backup_chunk_store_lv(self, disk, snapshot_path):
+        '''
+        Backup a VM logical volume snapshot to the chunk store, saving the
+        list of its chunks in the backup directory.
+        '''
+        store = ChunkStore(self, self.args.chunk_store, self._compression_threads(), verify=self.args.verify_chunks)
+        manifest = {'chunk_size': self._size_to_bytes(self.args.chunk_size)}
+
+        # Store chunks, then list them and reference them
+        self._output('Starting chunk store backup of "{0}" to "{1}"'.format(snapshot_path, store.path), 2)
+        checksums = {}
+        self._transfer(snapshot_path, functools.partial(store.write_chunks, manifest), size=self._size_to_bytes(disk['image_size']), checksums=checksums)
+        disk['raw_sha256'] = checksums['raw']
+        self._write_file(os.path.join(self.args.source, disk['chunks']), self._return_json(manifest))
+        store.add_references(manifest['chunks'])
+        self._output('Successfully completed chunk store backup of "{0}"'.format(snapshot_path), 2)
 
     # --------------------------------------------------------------------------
     # Action function - Import
@@ -1511,17 +4441,14 @@ class Vmpy:
         remote_dir = self.args.source
         remote_path = '{0}:{1}'.format(remote_address, remote_dir)
 
-        # Confirm meta.txt file exists
-        self._output('Confirming meta.txt file exists in remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['test', '-f', '{0}/meta.txt'.format(remote_dir)])
-        if not self._execute(command, boolean=True):
+        # Confirm meta.txt file exists, reading the meta data, XML and image
+        # file sizes in one go
+        manifest = self._remote_manifest(remote_dir)
+        if 'meta.txt' not in manifest['data']:
             self._raise('The required meta.txt file does not exist in remote directory: "{0}"'.format(remote_path))
 
-        # Return and parse remote meta.txt
-        self._output('Retrieving meta.txt file data from remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['cat', '{0}/meta.txt'.format(remote_dir)])
-        source_meta_data = self._execute(command)
-        source_meta = self._load_vm_meta(source_meta_data)
+        # Parse remote meta.txt
+        source_meta = self._load_vm_meta(manifest['data']['meta.txt'])
         target_meta = self._load_target_meta(source_meta.copy(), action='import')
         self._verify_target_meta(target_meta)
 
@@ -1529,62 +4456,101 @@ class Vmpy:
         self._output('Importing a VM from remote backup "{0}" to a new VM named "{1}"'.format(remote_path, target_meta['name']))
         self._pprint_meta(source_meta, target_meta)
 
-        # Confirm XML file exists
-        self._output('Confirming XML file exists in remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['test', '-f', '{0}/{1}'.format(remote_dir, source_meta['xml'])])
-        if not self._execute(command, boolean=True):
-            self._raise('The required XML file does not exist in remote directory: "{0}/{1}"'.format(remote_path, source_meta['xml']))
-
-        # Confirm image file exists
-        self._output('Confirming VM image file exists in remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['test', '-f', '{0}/{1}'.format(remote_dir, source_meta['image'])])
-        if not self._execute(command, boolean=True):
-            self._raise('The required VM image file does not exist in remote directory: "{0}/{1}"'.format(remote_path, source_meta['image']))
+        # Confirm XML and image files exist, including those of the backups
+        # an incremental backup is based on
+        chain = self._load_backup_chain(remote_dir, source_meta, self._remote_read_file)
+        for directory, meta in chain:
+            self._import_remote_verify_files(directory, meta)
 
         # Transfer remote XML to local file
         self._output('Loading remote XML and creating a temporary modified copy: "{0}/{1}"'.format(remote_path, source_meta['xml']), 2)
-        command = self._remote_ssh_command(['cat', '{0}/{1}'.format(remote_dir, source_meta['xml'])])
-        source_xml = self._execute(command)
+        source_xml = self._remote_read_file(os.path.join(remote_dir, source_meta['xml']))
         target_xml = self._load_target_xml(source_xml, source_meta, target_meta, action='import')
 
         target_xml_file = os.path.realpath('{0}-{1}.temp.xml'.format(target_meta['name'], self.now))
         self._write_file(target_xml_file, target_xml)
 
-        # Resolve conflicts with existing VMs on the host machine
-        potential_conflicts = [
-            ('name', target_meta['name']),
-            ('disk', target_meta['disk']),
-            ('uuid', target_meta['uuid']),
-            ('mac', target_meta['mac'])
-        ]
-        self._vm_resolve_conflicts(potential_conflicts)
-
-        # Create logical volume
-        self._lv_create(target_meta['logical_volume_size'], target_meta['logical_volume'], target_meta['volume_group'])
-
-        # Transfer LV image with dd over ssh
-        command_queue = []
-        ssh_command = self._remote_ssh_command(['dd', 'bs={0}'.format(self.args.block_size), 'if={0}/{1}'.format(remote_dir, source_meta['image'])])
-        command_queue.append(ssh_command)
-
-        if source_meta['compression'] != 'none':
-            zip_command = [str(source_meta['compression']), '-d']
-            command_queue.append(zip_command)
+        # Resolve conflicts with existing VMs on the host machine. A resumed
+        # import keeps the logical volumes it created.
+        resume = self._import_checkpoint(source_meta, target_meta)
+        if not resume:
+            self._vm_resolve_conflicts(self._potential_conflicts(target_meta))
 
-        target_lv = '/dev/{0}/{1}'.format(target_meta['volume_group'], target_meta['logical_volume'])
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'of={0}'.format(target_lv)])
-
-        # Execute commands
-        self._output('Importing VM disk image. This will take time.', show_timestamp=True)
-        self._output('Starting remote VM image import.', 2)
-        self._execute_queue(command_queue)
-        self._output('Successfully completed remote VM image import.', 2)
+        # Create logical volumes and transfer LV images over ssh
+        self._output('Importing VM disk image(s). This will take time.', show_timestamp=True)
+        import_lv = lambda source_disk, target_disk: self._import_chain_lv(chain, source_disk, target_disk, self._import_remote_lv)
+        self._import_disks(self._meta_disks(source_meta), target_meta, import_lv, compressions=[meta['compression'] for directory, meta in chain], create=not resume)
+        self._remove_checkpoint()
 
         # Set return data dictionary and return data
         return_data['target_xml_file'] = target_xml_file
         return_data['target_name'] = target_meta['name']
         return return_data
 
+    def _import_remote_verify_files(self, remote_dir, source_meta):
+        '''
+        Confirm the XML file and every disk image file exist in the remote
+        backup directory, see _remote_manifest(). Images saved in chunks
+        must hold every chunk.
+        '''
+        remote_path = '{0}:{1}'.format(self.args.remote, remote_dir)
+        files = self._remote_manifest(remote_dir)['files']
+
+        # The chunks of a chunk store backup are read from the local store
+        if source_meta.get('chunk_store'):
+            self._raise('A backup in a chunk store can only be imported locally: "{0}"'.format(remote_path))
+
+        # Confirm XML file exists
+        self._output('Confirming XML file exists in remote directory: "{0}"'.format(remote_path), 2)
+        if os.path.normpath(source_meta['xml']) not in files:
+            self._raise('The required XML file does not exist in remote directory: "{0}/{1}"'.format(remote_path, source_meta['xml']))
+
+        # Confirm image files exist
+        self._output('Confirming VM image file(s) exist in remote directory: "{0}"'.format(remote_path), 2)
+        for disk in self._meta_disks(source_meta):
+            for path in filter(None, [disk['image'], disk.get('extents')]):
+                if os.path.normpath(path) not in files:
+                    self._raise('The required VM image file does not exist in remote directory: "{0}/{1}"'.format(remote_path, path))
+            if disk.get('checkpoints'):
+                size = sum(chunk['image_length'] for chunk in disk['checkpoints'])
+                if files[os.path.normpath(disk['image'])] < size:
+                    self._raise('The VM image file is {0} bytes long, its chunks need {1}: "{2}/{3}"'.format(files[os.path.normpath(disk['image'])], size, remote_path, disk['image']))
+
+    def _import_remote_lv(self, remote_dir, source_meta, source_disk, target_disk, discard=False):
+        '''
+        Transfer a remote disk image to a target LV over ssh.
+        '''
+        compression = source_meta['compression']
+
+        # Remote ssh command
+        block_size = self._block_size(source=self._remote_ssh_command([]))
+        dd_command = ['dd', 'bs={0}'.format(block_size), 'if={0}'.format(pipes.quote('{0}/{1}'.format(remote_dir, source_disk['image'])))]
+        ssh_command = self._remote_ssh_command(dd_command)
+
+        # Read an image saved in chunks chunk by chunk, over connections of
+        # their own when reading chunks in parallel
+        if source_disk.get('checkpoints'):
+            ssh_command = self._remote_ssh_command(dd_command, multiplex=self.args.ssh_streams == 1)
+            chunk_source = lambda chunk: (ssh_command + ['skip={0}'.format(chunk['image_offset']), 'count={0}'.format(chunk['image_length']), 'iflag=skip_bytes,count_bytes'], None)
+            return self._import_lv_chunks(source_meta, source_disk, target_disk, chunk_source, discard, workers=self.args.ssh_streams)
+
+        # Set filters
+        filters = []
+        if compression != 'none':
+            filters.append(self._decompression_filter(compression))
+
+        # Load the extent map of a sparse image
+        extent_map = None
+        if source_disk.get('extents'):
+            extent_map = self._load_extent_map(self._remote_read_file(os.path.join(remote_dir, source_disk['extents'])))
+
+        # Copy image
+        self._output('Starting remote VM image import of "{0}".'.format(source_disk['image']), 2)
+        checksums = {} if source_disk.get('raw_sha256') else None
+        self._transfer(ssh_command, target_disk['disk'], filters, write_extents=extent_map, discard=discard, size=self._size_to_bytes(source_disk['image_size']), checksums=checksums)
+        self._verify_checksums(source_disk, checksums)
+        self._output('Successfully completed remote VM image import of "{0}".'.format(source_disk['image']), 2)
+
     # --------------------------------------------------------------------------
     # Action function - Import Local
     # --------------------------------------------------------------------------
@@ -1623,28 +4589,152 @@ class Vmpy:
         target_xml_file = os.path.realpath('{0}-{1}.temp.xml'.format(target_meta['name'], self.now))
         self._write_file(target_xml_file, target_xml)
 
-        # Resolve conflicts with existing VMs on the host machine
-        potential_conflicts = [
-            ('name', target_meta['name']),
-            ('disk', target_meta['disk']),
-            ('uuid', target_meta['uuid']),
-            ('mac', target_meta['mac'])
-        ]
-        self._vm_resolve_conflicts(potential_conflicts)
-
-        # Create logical volume
-        self._lv_create(target_meta['logical_volume_size'], target_meta['logical_volume'], target_meta['volume_group'])
+        # Resolve conflicts with existing VMs on the host machine. A resumed
+        # import keeps the logical volumes it created.
+        resume = self._import_checkpoint(source_meta, target_meta)
+        if not resume:
+            self._vm_resolve_conflicts(self._potential_conflicts(target_meta))
 
-        # Copy backup image to new logical volume
-        self._output('Importing VM disk image. This will take time.', show_timestamp=True)
-        source_image_file = os.path.realpath(source_directory + target_meta['image'])
-        self._lv_import(source_image_file, target_meta['disk'], compression=source_meta['compression'])
+        # Create logical volumes and copy backup images to them
+        self._output('Importing VM disk image(s). This will take time.', show_timestamp=True)
+        chain = self._load_backup_chain(source_directory, source_meta, self._read_file)
+        import_lv = lambda source_disk, target_disk: self._import_chain_lv(chain, source_disk, target_disk, self._import_local_lv)
+        self._import_disks(self._meta_disks(source_meta), target_meta, import_lv, compressions=[meta['compression'] for directory, meta in chain], create=not resume)
+        self._remove_checkpoint()
 
         # Set return data dictionary and return data
         return_data['target_xml_file'] = target_xml_file
         return_data['target_name'] = target_meta['name']
         return return_data
 
+    def _import_local_lv(self, source_directory, source_meta, source_disk, target_disk, discard=False):
+        '''
+        Copy a local disk image to a target LV, loading the extent map of a
+        sparse image. The disk of a chunk store backup is read from the
+        store.
+        '''
+        if source_disk.get('chunks'):
+            return self._import_chunk_store_lv(source_directory, source_meta, source_disk, target_disk, discard)
+
+        # Read an image saved in chunks chunk by chunk
+        if source_disk.get('checkpoints'):
+            image = os.path.realpath(source_directory + source_disk['image'])
+            chunk_source = lambda chunk: (image, (chunk['image_offset'], chunk['image_length']))
+            return self._import_lv_chunks(source_meta, source_disk, target_disk, chunk_source, discard)
+
+        compression = source_meta['compression']
+        extent_map = None
+        if source_disk.get('extents'):
+            extent_map = self._load_extent_map(self._read_file(os.path.realpath(source_directory + source_disk['extents'])))
+        checksums = {} if source_disk.get('raw_sha256') else None
+        self._lv_import(os.path.realpath(source_directory + source_disk['image']), target_disk['disk'], compression=compression, extent_map=extent_map, discard=discard, size=self._size_to_bytes(source_disk['image_size']), checksums=checksums)
+        self._verify_checksums(source_disk, checksums)
+
+    def _import_chunk_store_lv(self, source_directory, source_meta, source_disk, target_disk, discard=False):
+        '''
+        Copy a disk from the chunk store to a target LV.
+        '''
+        store = ChunkStore(self, source_meta['chunk_store'], self._compression_threads())
+        if not os.path.isdir(store.path):
+            self._raise('Could not find the chunk store of the backup: "{0}"'.format(store.path))
+        manifest = self._load_manifest(self._read_file(os.path.realpath(source_directory + source_disk['chunks'])))
+
+        self._output('Importing LV from chunk store "{0}"'.format(store.path), 2)
+        checksums = {} if source_disk.get('raw_sha256') else None
+        self._transfer(functools.partial(store.read_chunks, manifest), target_disk['disk'], discard=discard, size=self._size_to_bytes(source_disk['image_size']), checksums=checksums)
+        self._verify_checksums(source_disk, checksums)
+        self._output('Successful LV import', 2)
+
+    def _import_lv_chunks(self, source_meta, source_disk, target_disk, chunk_source, discard=False, workers=1):
+        '''
+        Copy a disk image saved in chunks, see _backup_lv_chunks(), to a
+        target LV, verifying the checksums of each chunk. Up to workers
+        chunks are copied concurrently, sharing the --streams-per-pv slot of
+        the disk, see _import_disks(). chunk_source(chunk) returns the
+        source and source range, see _transfer(), reading the image of a
+        chunk. Written chunks are saved to the checkpoint file of an import
+        and skipped when it is resumed.
+        '''
+        filters = []
+        if source_meta['compression'] != 'none':
+            filters.append(self._decompression_filter(source_meta['compression']))
+        if discard:
+            self._output('Discards are not supported for disk images saved in chunks, every block is written.')
+
+        chunks = source_disk['checkpoints']
+        done = self.checkpoint['disks'].setdefault(target_disk['disk'], []) if self.checkpoint else []
+        pending = [i for i in xrange(len(chunks)) if i not in done]
+        if done and pending:
+            self._output('Resuming the import of "{0}" with {1} of {2} chunks left'.format(target_disk['disk'], len(pending), len(chunks)))
+
+        def copy(i):
+            chunk = chunks[i]
+            source, source_range = chunk_source(chunk)
+            checksums = {}
+            self._transfer(source, target_disk['disk'], filters, size=chunk['length'], checksums=checksums, source_range=source_range, offset=chunk['offset'])
+            self._verify_checksums(dict(chunk, target='{0} chunk {1}'.format(source_disk['target'], i + 1)), checksums)
+            if self.checkpoint:
+                with self.checkpoint_lock:
+                    done.append(i)
+                    self._save_checkpoint()
+
+        try:
+            self._parallel_map(copy, pending, workers)
+        except BaseException:
+            if self.checkpoint:
+                self._output('The import was interrupted. Run it again with --resume to continue with the chunks of "{0}" not written yet.'.format(target_disk['disk']), 0)
+            raise
+
+    def _import_checkpoint(self, source_meta, target_meta):
+        '''
+        Start the checkpoint file of an import of a backup saved in chunks,
+        or load it with --resume. Returns True when resuming, the target
+        logical volumes then exist already.
+        '''
+        if self.args.resume:
+            self._load_checkpoint('import', target_meta['name'])
+            for disk in target_meta['disks']:
+                if not os.path.exists(disk['disk']):
+                    self._raise('Could not resume the import, its logical volume no longer exists: "{0}"'.format(disk['disk']))
+            return True
+
+        if any(disk.get('checkpoints') for disk in self._meta_disks(source_meta)):
+            self._save_checkpoint({'action': 'import', 'name': target_meta['name'], 'source': self.args.source, 'remote': self.args.remote, 'disks': {}})
+        return False
+
+    def _load_backup_chain(self, directory, meta, read_file):
+        '''
+        Return the (directory, meta) pairs of an incremental backup and of
+        every backup it is based on, starting with the first full backup.
+        Meta data is loaded by calling read_file(path).
+        '''
+        chain = [(directory, meta)]
+        while chain[0][1].get('base'):
+            base = chain[0][1]['base'].rstrip('/') + '/'
+            if base in [directory for directory, meta in chain]:
+                self._raise('The incremental backup chain loops back to: "{0}"'.format(base))
+            self._output('Loading the meta data of the base backup: "{0}meta.txt"'.format(base), 2)
+            chain.insert(0, (base, self._load_vm_meta(read_file(base + 'meta.txt'))))
+        return chain
+
+    def _import_chain_lv(self, chain, source_disk, target_disk, import_image):
+        '''
+        Rebuild a disk from a chain of backups, see _load_backup_chain(), by
+        calling import_image(directory, meta, disk, target_disk, discard)
+        for the image of the disk in every backup, oldest first.
+        Only the first image discards the target LV.
+        '''
+        images = []
+        for directory, meta in chain:
+            for disk in self._meta_disks(meta):
+                if disk['target'] == source_disk['target']:
+                    images.append((directory, meta, disk))
+
+        for i, (directory, meta, disk) in enumerate(images):
+            if len(images) > 1:
+                self._output('Applying backup {0} of {1} to "{2}": "{3}"'.format(i + 1, len(images), target_disk['disk'], directory), 2)
+            import_image(directory, meta, disk, target_disk, discard=self.args.discard and i == 0)
+
     # --------------------------------------------------------------------------
     # Action function - Clone
     # --------------------------------------------------------------------------
@@ -1710,51 +4800,28 @@ class Vmpy:
 
         # Load source XML and create target XML
         self._output('Loading source XML and creating target XML', 2)
-        source_xml = self.vm_info(source_meta['name'], 'xml')
+        source_xml = self.vm_xml(source_meta['name'])
         target_xml = self._load_target_xml(source_xml, source_meta, target_meta, action='clone')
 
-        # Set snapshot variables
-        if source_meta['disk_file']:
-            source_path = source_meta['disk_file']
-        else:
-            source_path = source_meta['disk']
-        initial_source_vm_status = self.vm_info(source_meta['name'], 'status')
-        snapshot_name = '{0}.snapshot'.format(source_meta['name'])
-        snapshot_path = '{0}.snapshot'.format(source_path)
-
-        # If VM is running suspend it. Cache status for later.
-        if initial_source_vm_status == 'running':
-            self._vm_suspend(source_meta['name'])
-
-        # Create a LV snapshot
-        self._lv_create_snapshot(source_meta['name'], snapshot_name)
-
-        # If VM was running (refer to cached variable), restart it.
-        if initial_source_vm_status == 'running':
-            self._vm_resume(source_meta['name'])
-
-        # Resolve conflicts with existing VMs on the host machine
-        potential_conflicts = [
-            ('name', target_meta['name']),
-            ('disk', target_meta['disk']),
-            ('uuid', target_meta['uuid']),
-            ('mac', target_meta['mac'])
-        ]
-        self._vm_resolve_conflicts(potential_conflicts)
+        # Create a LV snapshot of every disk, suspending a running VM
+        source_disks = self._meta_disks(source_meta)
+        snapshot_paths = self._vm_snapshot_disks(source_meta['name'])
+        snapshots = dict(zip([disk['disk'] for disk in source_disks], snapshot_paths))
 
         try:
-            # Create target logical volume
-            self._lv_create(target_meta['logical_volume_size'], target_meta['name'], target_meta['volume_group'])
-            # Copy source LV snapshot to target LV
-            # Wrapped in a try/except decorator, don't handle exception here.
-            self._output('Cloning VM disk image. This will take time.', show_timestamp=True)
-            self._lv_import(snapshot_path, target_meta['disk'])
+            # Resolve conflicts with existing VMs on the host machine
+            self._vm_resolve_conflicts(self._potential_conflicts(target_meta))
+
+            # Create target logical volumes and copy source LV snapshots to them
+            self._output('Cloning VM disk image(s). This will take time.', show_timestamp=True)
+            import_lv = lambda source_disk, target_disk: self._lv_import(snapshots[source_disk['disk']], target_disk['disk'], discard=self.args.discard, size=self._size_to_bytes(source_disk['image_size']))
+            self._import_disks(source_disks, target_meta, import_lv, source_pvs=True)
         finally:
-            # Remove LV snapshot
-            # If either LV action fails we ensure the LV snapshot is removed,
+            # Remove LV snapshots
+            # If either LV action fails we ensure the LV snapshots are removed,
             # preventing an unstable scenario when running from an unmonitored
             # terminal (such as a backup script on a cron job).
-            self._lv_remove(snapshot_path)
+            self._vm_remove_snapshots(snapshot_paths)
 
         # Save target_xml to a temporary file
         target_xml_file = os.path.realpath('./target_xml_{0}.tmp'.format(self.now))
@@ -1785,17 +4852,14 @@ class Vmpy:
         remote_dir = self.args.source
         remote_path = '{0}:{1}'.format(remote_address, remote_dir)
 
-        # Confirm meta.txt file exists
-        self._output('Confirming meta.txt file exists in remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['test', '-f', '{0}/meta.txt'.format(remote_dir)])
-        if not self._execute(command, boolean=True):
+        # Confirm meta.txt file exists, reading the meta data, XML and image
+        # file sizes in one go
+        manifest = self._remote_manifest(remote_dir)
+        if 'meta.txt' not in manifest['data']:
             self._raise('The required meta.txt file does not exist in remote directory: "{0}"'.format(remote_path))
 
-        # Return and parse remote meta.txt
-        self._output('Retrieving meta.txt file data from remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['cat', '{0}/meta.txt'.format(remote_dir)])
-        source_meta_data = self._execute(command)
-        source_meta = self._load_vm_meta(source_meta_data)
+        # Parse remote meta.txt
+        source_meta = self._load_vm_meta(manifest['data']['meta.txt'])
         target_meta = self._load_target_meta(source_meta.copy(), action='clone')
         self._verify_target_meta(target_meta)
 
@@ -1803,56 +4867,27 @@ class Vmpy:
         self._output('Cloning a VM from a remote backup in "{0}" to a new VM named "{1}"'.format(remote_path, self.args.name))
         self._pprint_meta(source_meta, target_meta)
 
-        # Confirm XML file exists
-        self._output('Confirming XML file exists in remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['test', '-f', '{0}/{1}'.format(remote_dir, source_meta['xml'])])
-        if not self._execute(command, boolean=True):
-            self._raise('The required XML file does not exist in remote directory: "{0}/{1}"'.format(remote_path, source_meta['xml']))
-
-        # Confirm image file exists
-        self._output('Confirming VM image file exists in remote directory: "{0}"'.format(remote_path), 2)
-        command = self._remote_ssh_command(['test', '-f', '{0}/{1}'.format(remote_dir, source_meta['image'])])
-        if not self._execute(command, boolean=True):
-            self._raise('The required VM image file does not exist in remote directory: "{0}/{1}"'.format(remote_path, source_meta['image']))
+        # Confirm XML and image files exist, including those of the backups
+        # an incremental backup is based on
+        chain = self._load_backup_chain(remote_dir, source_meta, self._remote_read_file)
+        for directory, meta in chain:
+            self._import_remote_verify_files(directory, meta)
 
         # Transfer remote XML to local file
         self._output('Loading remote XML and creating a temporary modified copy: "{0}/{1}"'.format(remote_path, source_meta['xml']), 2)
-        command = self._remote_ssh_command(['cat', '{0}/{1}'.format(remote_dir, source_meta['xml'])])
-        source_xml = self._execute(command)
+        source_xml = self._remote_read_file(os.path.join(remote_dir, source_meta['xml']))
         target_xml = self._load_target_xml(source_xml, source_meta, target_meta, action='clone')
 
         target_xml_file = os.path.realpath('{0}-{1}.temp.xml'.format(target_meta['name'], self.now))
         self._write_file(target_xml_file, target_xml)
 
         # Resolve conflicts with existing VMs on the host machine
-        potential_conflicts = [
-            ('name', target_meta['name']),
-            ('disk', target_meta['disk']),
-            ('uuid', target_meta['uuid']),
-            ('mac', target_meta['mac'])
-        ]
-        self._vm_resolve_conflicts(potential_conflicts)
-
-        # Create logical volume
-        self._lv_create(target_meta['logical_volume_size'], target_meta['logical_volume'], target_meta['volume_group'])
-
-        # Transfer LV image with dd over ssh
-        command_queue = []
-        ssh_command = self._remote_ssh_command(['dd', 'bs={0}'.format(self.args.block_size), 'if={0}/{1}'.format(remote_dir, source_meta['image'])])
-        command_queue.append(ssh_command)
-
-        if source_meta['compression'] != 'none':
-            zip_command = [str(source_meta['compression']), '-d']
-            command_queue.append(zip_command)
-
-        target_lv = '/dev/{0}/{1}'.format(target_meta['volume_group'], target_meta['logical_volume'])
-        command_queue.append(['dd', 'bs={0}'.format(self.args.block_size), 'of={0}'.format(target_lv)])
+        self._vm_resolve_conflicts(self._potential_conflicts(target_meta))
 
-        # Execute commands
-        self._output('Cloning VM disk image. This will take time.', show_timestamp=True)
-        self._output('Starting remote VM image import.', 2)
-        self._execute_queue(command_queue)
-        self._output('Successfully completed remote VM image import.', 2)
+        # Create logical volumes and transfer LV images over ssh
+        self._output('Cloning VM disk image(s). This will take time.', show_timestamp=True)
+        import_lv = lambda source_disk, target_disk: self._import_chain_lv(chain, source_disk, target_disk, self._import_remote_lv)
+        self._import_disks(self._meta_disks(source_meta), target_meta, import_lv, compressions=[meta['compression'] for directory, meta in chain])
 
         # Set return data dictionary and return data
         return_data['source_directory'] = remote_path
@@ -1897,21 +4932,13 @@ class Vmpy:
         target_xml = self._load_target_xml(source_xml, source_meta, target_meta, action='clone')
 
         # Resolve conflicts with existing VMs on the host machine
-        potential_conflicts = [
-            ('name', target_meta['name']),
-            ('disk', target_meta['disk']),
-            ('uuid', target_meta['uuid']),
-            ('mac', target_meta['mac'])
-        ]
-        self._vm_resolve_conflicts(potential_conflicts)
-
-        # Create logical volume
-        self._lv_create(target_meta['logical_volume_size'], target_meta['name'], target_meta['volume_group'])
+        self._vm_resolve_conflicts(self._potential_conflicts(target_meta))
 
-        # Copy backup image to new logical volume
-        self._output('Cloning VM disk image. This will take time.', show_timestamp=True)
-        source_image_file = os.path.realpath(source_directory + source_meta['image'])
-        self._lv_import(source_image_file, target_meta['disk'], compression=target_meta['compression'])
+        # Create logical volumes and copy backup images to them
+        self._output('Cloning VM disk image(s). This will take time.', show_timestamp=True)
+        chain = self._load_backup_chain(source_directory, source_meta, self._read_file)
+        import_lv = lambda source_disk, target_disk: self._import_chain_lv(chain, source_disk, target_disk, self._import_local_lv)
+        self._import_disks(self._meta_disks(source_meta), target_meta, import_lv, compressions=[meta['compression'] for directory, meta in chain])
 
         # Save target_xml to a temporary file
         target_xml_file = os.path.realpath(source_directory + 'target_xml_{0}.tmp'.format(self.now))
@@ -1976,65 +5003,232 @@ class Vmpy:
         except IOError, e:
             self._raise(e, 'Could not unlink (remove) file: "{0}"'.format(path))
 
-    def _create_mac_address(self, unique=False):
+    def _size_to_bytes(self, size):
+        '''
+        Convert a size to an integer number of bytes. Accepts integers and
+        size strings with an optional LVM/dd style unit suffix, e.g. "512K",
+        "25.00g" or "26843545600b". Units are powers of 1024, matching the
+        `lvcreate -L` and `dd bs=` conventions.
+        '''
+        units = {'b': 1, 's': 512, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4, 'p': 1024 ** 5, 'e': 1024 ** 6}
+        if isinstance(size, (int, long)):
+            return size
+
+        value = str(size).strip()
+        multiplier = 1
+        if value and value[-1].lower() in units:
+            multiplier = units[value[-1].lower()]
+            value = value[:-1]
+        try:
+            return int(round(float(value) * multiplier))
+        except ValueError:
+            self._raise('Could not parse size value: "{0}"'.format(size))
+
+    def _bytes_to_size(self, size):
+        '''
+        Convert an integer number of bytes to a byte-exact LVM size string,
+        e.g. "26843545600b", suitable for `lvcreate -L` and meta.txt.
+        '''
+        if size is None:
+            return None
+        return '{0}b'.format(size)
+
+    def _allocate_unique(self, attribute, space_size, create, attempts=64):
+        '''
+        Return a value for a VM attribute that no defined VM uses. Values are
+        created by create(number) from a number in range(space_size). Used
+        values are held in the attribute's index set, so each random probe
+        costs constant time and a free value is found in constant expected
+        time while the space is less than half full. If random probing fails,
+        the space is scanned from a random start so a free value is always
+        found when one exists.
+        '''
+        self._require_info('vm_info')
+        used = self.data['vm_index'][attribute]
+
+        for i in range(attempts):
+            value = create(random.randrange(space_size))
+            if value not in used:
+                return value
+
+        start = random.randrange(space_size)
+        i = 0
+        while i < space_size:
+            value = create((start + i) % space_size)
+            if value not in used:
+                return value
+            i += 1
+
+        self._raise('Could not allocate a unique "{0}" value, all {1} values are in use.'.format(attribute, space_size))
+
+    def _create_mac_address(self):
         '''
-        Return bridge MAC address in the 52:54:00:XX:XX:XX range. The unique
-        argument tests if the MAC address is already defined in another VM.
-        If so it will regenerate and test again based on the number of VMs
-        defined on the host machine.
+        Return bridge MAC address in the 52:54:00:XX:XX:XX range that is not
+        defined in another VM. The fourth octet is kept below 0x80, leaving
+        2^23 possible addresses.
         '''
-        attempts = (self.vm_count() * 50) + 1
-        for i in range(attempts, 0, -1):
-            address_list = [0x52, 0x54, 0x00, random.randint(0x00, 0x7f), random.randint(0x00, 0xff), random.randint(0x00, 0xff)]
-            address = ':'.join(['%02x' % x for x in address_list])
-            if self.vm_info_is_unique('mac', address, raise_exception=False):
-                return address
-            if i == 1:
-                self._raise('Could not generated a unique MAC address. Tried {0} attempts.'.format(attempts))
+        def create(number):
+            address_list = [0x52, 0x54, 0x00, (number >> 16) & 0x7f, (number >> 8) & 0xff, number & 0xff]
+            return ':'.join(['%02x' % x for x in address_list])
+        return self._allocate_unique('mac', 2 ** 23, create)
 
-    def _remote_ssh_command(self, remote_command):
+    def _create_uuid(self):
+        '''
+        Return a random UUID that is not defined in another VM.
+        '''
+        def create(number):
+            return str(uuid.UUID(int=number, version=4))
+        return self._allocate_unique('uuid', 2 ** 128, create)
+
+    def _find_program(self, name):
+        '''
+        Return the path of an executable found in PATH, or None.
+        '''
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+        return None
+
+    def _remote_ssh_command(self, remote_command, multiplex=True):
         '''
         Return a self._execute() ready command. Keeps identity file logic in
-        one location.
+        one location. The command runs over the persistent ssh connection,
+        see _remote_connect(), unless multiplex is False, which opens a
+        connection of its own for concurrent data streams.
         '''
-        ssh_command = ['ssh', '{0}'.format(self.args.remote)]
-        if self.args.identity_file:
-            ssh_command[1:1] = ['-i', '{0}'.format(self.args.identity_file)]
+        ssh_command = ['ssh'] + self._remote_options(multiplex) + ['{0}'.format(self.args.remote)]
         command = ssh_command + remote_command
         return command
 
-    def _remote_source_scp_command(self, source, target):
+    def _remote_options(self, multiplex=True):
         '''
-        Return a self._execute() ready command. Keeps identity file logic in
-        one location.
+        Return the ssh options of commands run on --remote: the
+        identity file and the control socket of the persistent connection,
+        or none to bypass it when multiplex is False.
         '''
-        source = '{0}:{1}'.format(self.args.remote, source)
-        command = ['scp', source, target]
+        options = []
         if self.args.identity_file:
-            command[1:1] = ['-i', '{0}'.format(self.args.identity_file)]
-        return command
+            options += ['-i', '{0}'.format(self.args.identity_file)]
+        control_path = self._remote_connect() if multiplex else 'none'
+        options += ['-o', 'ControlPath={0}'.format(control_path)]
+        return options
 
-    def _remote_target_scp_command(self, source, target):
+    def _remote_connect(self):
         '''
-        Return a self._execute() ready command. Keeps identity file logic in
-        one location.
+        Open one persistent ssh connection to --remote per run, the first
+        time it is needed, and return its control socket. Commands sent
+        through the socket share the connection instead of authenticating
+        again, and fall back to a connection of their own should it be gone.
+        The connection is closed by _remote_disconnect() on exit, or by ssh
+        itself a minute after its last use should vmpy be killed first.
         '''
-        target = '{0}:{1}'.format(self.args.remote, target)
-        command = ['scp', source, target]
-        if self.args.identity_file:
-            command[1:1] = ['-i', '{0}'.format(self.args.identity_file)]
-        return command
+        with self.remote_lock:
+            if self.remote_control is None:
+                directory = tempfile.mkdtemp(prefix='vmpy-ssh-')
+                control_path = os.path.join(directory, 'control')
+                command = ['ssh', '-M', '-N', '-f', '-o', 'ControlPersist=60', '-o', 'ControlPath={0}'.format(control_path)]
+                if self.args.identity_file:
+                    command += ['-i', '{0}'.format(self.args.identity_file)]
+                command.append('{0}'.format(self.args.remote))
+
+                # The backgrounded master keeps its output open, so it is
+                # written to a file instead of a pipe
+                self._output('Opening persistent ssh connection to "{0}"'.format(self.args.remote), 2)
+                log = tempfile.TemporaryFile()
+                if not self._execute(command, stdout=log, stderr=log, boolean=True):
+                    log.seek(0)
+                    os.rmdir(directory)
+                    self._raise('Could not open an ssh connection to "{0}": {1}'.format(self.args.remote, log.read().strip()))
+                self.remote_control = control_path
+            return self.remote_control
+
+    def _remote_disconnect(self):
+        '''
+        Close the persistent ssh connection opened by _remote_connect().
+        '''
+        control_path = self.remote_control
+        self.remote_control = None
+        self._output('Closing persistent ssh connection to "{0}"'.format(self.args.remote), 2)
+        self._execute(['ssh', '-O', 'exit', '-o', 'ControlPath={0}'.format(control_path), '{0}'.format(self.args.remote)], boolean=True)
+        if os.path.exists(control_path):
+            os.unlink(control_path)
+        os.rmdir(os.path.dirname(control_path))
+
+    def _remote_manifest(self, directory):
+        '''
+        Return the manifest of a remote backup directory, read in a single
+        ssh call and kept for the run: whether the directory exists, the
+        free space of its file system in bytes, the size of every file in it
+        and the contents of its meta.txt, XML and extent map files.
+        '''
+        directory = os.path.normpath(directory)
+        if directory in self.remote_manifests:
+            return self.remote_manifests[directory]
+
+        # The free space of a directory that does not exist yet is that of
+        # its closest existing parent. Contents are prefixed with their size.
+        script = textwrap.dedent('''
+            directory={0}
+            parent=$directory
+            while [ ! -d "$parent" ]; do parent=$(dirname "$parent"); done
+            df -Pk "$parent" | awk 'NR == 2 {{ print "free", $4 }}'
+            cd "$directory" 2>/dev/null || exit 0
+            echo directory
+            for name in *; do
+                [ -f "$name" ] && printf 'file %s %s\\n' $(wc -c < "$name") "$name"
+            done
+            for name in meta.txt *.xml *.extents.json; do
+                [ -f "$name" ] && printf 'data %s %s\\n' $(wc -c < "$name") "$name" && cat "$name"
+            done
+            exit 0
+        ''').format(pipes.quote(directory))
+        self._output('Reading the manifest of remote directory: "{0}:{1}"'.format(self.args.remote, directory), 2)
+        output = self._execute(self._remote_ssh_command(['sh', '-c', pipes.quote(script)]))
+
+        # Parse the manifest
+        manifest = {'exists': False, 'free': None, 'files': {}, 'data': {}}
+        position = 0
+        while position < len(output):
+            end = output.index('\n', position)
+            fields = output[position:end].split(' ', 2)
+            position = end + 1
+            if fields[0] == 'directory':
+                manifest['exists'] = True
+            elif fields[0] == 'free':
+                manifest['free'] = int(fields[1]) * 1024
+            elif fields[0] == 'file':
+                manifest['files'][fields[2]] = int(fields[1])
+            elif fields[0] == 'data':
+                length = int(fields[1])
+                manifest['data'][fields[2]] = output[position:position + length]
+                position += length
+
+        self.remote_manifests[directory] = manifest
+        return manifest
+
+    def _remote_read_file(self, path):
+        '''
+        Return the contents of a remote file, from the manifest of its
+        directory if it holds them, see _remote_manifest(), or with `cat`.
+        '''
+        path = os.path.normpath(path)
+        manifest = self._remote_manifest(os.path.dirname(path))
+        name = os.path.basename(path)
+        if name in manifest['data']:
+            return manifest['data'][name]
+        return self._execute(self._remote_ssh_command(['cat', pipes.quote(path)]))
 
     # --------------------------------------------------------------------------
     # Application utility functions
     # --------------------------------------------------------------------------
     @execute_safely
-    def _execute(self, command, stdin=None, stdout=None, stderr=None, boolean=False, output_level=2):
+    def _execute(self, command, stdin=None, stdout=None, stderr=None, boolean=False, output_level=2, input=None):
         '''
         Execute a command on the system. Return stdout on success, raise
         an exception on failure, and log result in either case. If boolean is True,
         return the boolean value based on system exit code (zero:True, non-zero:False)
-        and do not log any results.
+        and do not log any results. Data passed as input is written to stdin.
         '''
         # Verify passed arguments
         if not type(command) is list or len(command) == 0:
@@ -2044,6 +5238,8 @@ class Vmpy:
         named_args = { 'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE }
         if stdin:
             named_args['stdin'] = stdin
+        if input is not None:
+            named_args['stdin'] = subprocess.PIPE
         if stdout:
             named_args['stdout'] = stdout
         if stderr:
@@ -2056,15 +5252,15 @@ class Vmpy:
         # Initiate process and listen for completion. Determine success from
         # return code
         process = subprocess.Popen(command, **named_args)
-        stdout, stderr = process.communicate()
+        stdout, stderr = process.communicate(input)
         is_success = (process.returncode == 0)
 
         # Log history if boolean is False
         history = not boolean
         if history and is_success:
-            self._history('success', 'Command: {0} | Stdout: {1}'.format(command_string, stdout))
+            self._history('success', 'Command: {0} | Stdout: {1}'.format(command_string, self._truncate(stdout)))
         elif history and not is_success:
-            self._history('error', 'Command: {0} | Stdout: {1}'.format(command_string, stdout))
+            self._history('error', 'Command: {0} | Stdout: {1}'.format(command_string, self._truncate(stdout)))
 
         # Return a boolean if requested
         if boolean:
@@ -2076,53 +5272,464 @@ class Vmpy:
         else:
             self._raise('Stdout: {0} | Stderr: {1}'.format(stdout, stderr))
 
-    @execute_safely
-    def _execute_queue(self, commands, boolean=False, output_level=2):
+    def _transfer(self, source, target, filters=(), read_extents=None, write_extents=None, discard=False, manifest=None, base_manifest=None, size=None, checksums=None, compressed='source', source_range=None, offset=None, truncate=False):
         '''
-        Execute multiple piped commands on the system. The argument commands
-        should be a list containing a sublist for each command. The order of the
-        list determines the order of the command: commands[0] | commands[1] |
-        [...] | commands[n-1] | commands[n].
-        Return stdout on success, raise an exception on failure, and log result
-        in either case. If boolean is True, return the boolean value based on
-        system exit code (zero:True, non-zero:False) and do not log any results.
+        Stream a disk image from source to target through filters with the
+        copy engine, see CopyEngine.transfer(). Returns the number of bytes
+        written to a target path. Passing a dictionary as read_extents only
+        reads the non-zero regions of a source path and describes them in
+        it, passing that extent map as write_extents writes them back to a
+        target path. With discard a target device is discarded first and
+        all-zero blocks are not written. Passing a manifest with a chunk size
+        as well only reads the chunks that changed since base_manifest and
+        lists the chunk hashes in it. The --read-limit, --write-limit and
+        --network-limit rates that apply to source and target are enforced
+        on the way. The bytes moved by every stage are counted for progress
+        reports, which estimate the time left from the disk size. Passing a
+        dictionary as checksums saves the sha256 digests of the uncompressed
+        "raw" stream and of the compressed "image" stream in it, computed as
+        the data passes. compressed names the side of the filters carrying
+        the compressed image, the source when importing and the target when
+        backing up. An (offset, length) source_range only reads that range
+        of a source path, an offset writes a target path from that offset
+        on, truncating a regular file there first with truncate, see
+        CopyEngine.write_at().
         '''
-        # Verify passed arguments
-        if not type(commands) is list or len(commands) == 0:
-            self._raise('Execute queue method received invalid commands argument. Should receive a list containing a sublist for each command. Instead received: "{0}"'.format(commands))
+        if not filters:
+            compressed = None
+
+        stats = TransferStats('{0} > {1}'.format(self._describe_endpoint(source), self._describe_endpoint(target)), size)
+        engine = CopyEngine(self, self._block_size(source, target), self.args.io_policy,
+                            read_limits=self._rate_limiters('read', source),
+                            write_limits=self._rate_limiters('write', target),
+                            stats=stats,
+                            compressed=compressed)
+        filters = list(filters)
+        if checksums is not None:
+            raw = functools.partial(engine.digest, checksums, 'raw')
+            image = functools.partial(engine.digest, checksums, 'image')
+            if not filters:
+                filters = [raw]
+            elif compressed == 'target':
+                filters = [raw] + filters + [image]
+            else:
+                filters = [image] + filters + [raw]
+        if isinstance(source, list) and source[:1] == ['ssh']:
+            stages = ['received'] + (['compressed'] if compressed == 'source' else [])
+            filters.insert(0, functools.partial(engine.meter, stages, self._rate_limiters('network', source)))
+        if isinstance(target, list) and target[:1] == ['ssh']:
+            stages = ['sent'] + (['compressed'] if compressed == 'target' else [])
+            filters.append(functools.partial(engine.meter, stages, self._rate_limiters('network', target)))
+        if manifest is not None:
+            source = functools.partial(engine.read_changes, source, read_extents, manifest, base_manifest, getattr(self.args, 'sparse', False))
+        elif read_extents is not None:
+            source = functools.partial(engine.read_extents, source, read_extents)
+        elif source_range is not None:
+            source = functools.partial(engine.read_range, source, *source_range)
+        if write_extents is not None:
+            target = functools.partial(engine.write_extents, target, write_extents, discard=discard)
+        elif discard:
+            target = functools.partial(engine.write_nonzero, target)
+        elif offset is not None:
+            target = functools.partial(engine.write_at, target, offset, truncate=truncate)
+
+        self._start_progress(stats)
+        try:
+            copied = engine.transfer(source, target, filters)
+        finally:
+            self._finish_progress(stats)
 
-        # Create process pipes
-        previous_command = None
-        for command in commands:
-            named_args = {'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE}
-            if previous_command:
-                named_args['stdin'] = previous_command.stdout
-            previous_command = subprocess.Popen(command, **named_args)
+        # Without compression the image is the raw stream
+        if checksums is not None and not compressed:
+            checksums['image'] = checksums['raw']
+            checksums['image_length'] = checksums['raw_length']
+        return copied
 
-        # Print command to output
-        command_string = ' | '.join([' '.join(command) for command in commands])
-        self._output('Executing command: `{0}`'.format(command_string), output_level)
+    def _verify_checksums(self, disk, checksums):
+        '''
+        Compare the checksums computed while importing a disk image, see
+        _transfer(), with the ones saved in its meta data. Raises an error
+        if they differ.
+        '''
+        if checksums is None:
+            return
+        for name in ['raw', 'image']:
+            expected = disk.get('{0}_sha256'.format(name))
+            if expected and checksums.get(name) != expected:
+                self._raise('The {0} sha256 checksum of disk "{1}" does not match the backup meta data, the backup is corrupt. Expected {2}, got {3}.'.format(name, disk['target'], expected, checksums.get(name)))
+        self._output('Verified the sha256 checksums of disk "{0}"'.format(disk['target']), 2)
+
+    def _describe_endpoint(self, endpoint):
+        '''
+        Return a short description of a transfer source or target: a path,
+        the ssh remote or the name of a command or function.
+        '''
+        if isinstance(endpoint, list):
+            return self.args.remote if endpoint[:1] == ['ssh'] else endpoint[0]
+        if isinstance(endpoint, functools.partial):
+            return endpoint.func.__name__
+        return endpoint
+
+    def _start_progress(self, stats):
+        '''
+        Add a transfer to the progress reports and the run log, starting
+        the reporting thread with the first one. Reports are printed every
+        --progress-interval seconds while transfers are running.
+        '''
+        with self.progress_lock:
+            self.progress.append(stats)
+            self.status.setdefault('transfers', []).append(stats.record)
+            if self.progress_thread or not self.args.progress_interval:
+                return
+            self.progress_thread = threading.Thread(target=self._report_progress)
+            self.progress_thread.daemon = True
+            self.progress_thread.start()
+
+    def _finish_progress(self, stats):
+        '''
+        Remove a finished transfer from the progress reports and log its
+        byte counters and throughput.
+        '''
+        stats.finish()
+        with self.progress_lock:
+            self.progress.remove(stats)
+        record = stats.record
+        throughput = ', '.join('{0} {1}/s'.format(stage, self._format_bytes(record['throughput'][stage])) for stage in TransferStats.stages if stage in record['throughput'])
+        self._output('Transferred `{0}` in {1}s: {2}'.format(record['description'], record['seconds'], throughput or 'no data'), 2)
+
+    def _report_progress(self):
+        '''
+        Print the progress of every running transfer until the run ends:
+        the bytes of every stage with its throughput, the share of the disk
+        done and the estimated time left.
+        '''
+        while not self.progress_stop.wait(self.args.progress_interval):
+            with self.progress_lock:
+                running = list(self.progress)
+            for stats in running:
+                self._output(self._progress_message(stats), 1, show_timestamp=True)
 
-        # Set post process variables
-        stdout, stderr = previous_command.communicate()
-        is_success = (previous_command.returncode == 0)
+    def _progress_message(self, stats):
+        '''
+        Sample a TransferStats and describe it for a progress report. The
+        share done is the larger of the bytes read and written, both count
+        disk bytes on one side of the transfer.
+        '''
+        seconds, counters = stats.sample()
+        seconds = max(seconds, 0.001)
+        stages = ', '.join('{0} {1} ({2}/s)'.format(stage, self._format_bytes(counters[stage]), self._format_bytes(counters[stage] / seconds)) for stage in TransferStats.stages if counters[stage])
+        message = 'Progress `{0}`: {1}'.format(stats.record['description'], stages or 'waiting for data')
+
+        size = stats.record['size']
+        done = max(counters['read'], counters['written'])
+        if size and done:
+            remaining = max(size - done, 0) * seconds / done
+            message += ' | {0:.0f}% of {1}, ETA {2}'.format(min(100.0 * done / size, 100), self._format_bytes(size), timedelta(seconds=int(remaining)))
+        return message
+
+    def _format_bytes(self, size):
+        '''
+        Format a number of bytes for output, e.g. "1.5 GiB".
+        '''
+        for unit in ['B', 'KiB', 'MiB', 'GiB']:
+            if abs(size) < 1024:
+                return '{0:.1f} {1}'.format(size, unit)
+            size = size / 1024.0
+        return '{0:.1f} TiB'.format(size)
 
-        # Log history if boolean is False
-        history = not boolean
-        if history and is_success:
-            self._history('success', 'Command: {0} | Stdout: {1}'.format(command_string, stdout))
-        elif history and not is_success:
-            self._history('error', 'Command: {0} | Stdout: {1}'.format(command_string, stdout))
+    def _rate_limiters(self, kind, endpoint):
+        '''
+        Return the RateLimiters of the --<kind>-limit values that apply to a
+        transfer endpoint. Read and write limits apply to paths, network
+        limits to ssh commands. A value without a target applies to every
+        endpoint, a <target>=<rate> value only to the paths under a
+        directory or device path, to the logical volumes of a volume group,
+        or to an ssh remote given as user@host or host. Limiters are shared
+        by all transfers of the run, so concurrent streams split a limit.
+        '''
+        if kind == 'network':
+            if not (isinstance(endpoint, list) and endpoint[:1] == ['ssh']):
+                return []
+        elif not isinstance(endpoint, basestring):
+            return []
+
+        limiters = []
+        for value in getattr(self.args, '{0}_limit'.format(kind), None) or []:
+            target, _, rate = value.rpartition('=')
+            if target and not self._rate_limit_applies(kind, target, endpoint):
+                continue
+            with self.rate_limiters_lock:
+                key = (kind, value)
+                if key not in self.rate_limiters:
+                    self._output('Limiting {0} rate to {1}/s{2}.'.format(kind, rate, ' for "{0}"'.format(target) if target else ''), 2)
+                    self.rate_limiters[key] = RateLimiter(self._size_to_bytes(rate))
+                limiters.append(self.rate_limiters[key])
+        return limiters
+
+    def _rate_limit_applies(self, kind, target, endpoint):
+        '''
+        Return True if the target of a --<kind>-limit value names endpoint,
+        see _rate_limiters().
+        '''
+        if kind == 'network':
+            remote = self.args.remote or ''
+            return target in (remote, remote.split('@')[-1])
+
+        path = os.path.abspath(endpoint)
+        parts = path.split('/')
+        if len(parts) == 4 and parts[1] == 'dev' and parts[2] == target:
+            return True
+        target = os.path.abspath(target)
+        return path == target or path.startswith(target.rstrip('/') + '/')
+
+    def _block_size(self, source=None, target=None):
+        '''
+        Return the block size in bytes for a transfer from source to target,
+        paths or commands as in _transfer(). With --block-size auto both
+        sides are calibrated once, see _calibrate_block_size(), and the
+        larger of the chosen sizes is used.
+        '''
+        if self.args.block_size != 'auto':
+            return self._size_to_bytes(self.args.block_size)
 
-        # Return a boolean if requested
-        if boolean:
-            return is_success
+        sizes = []
+        for endpoint, mode in ((source, 'read'), (target, 'write')):
+            key = self._block_size_key(endpoint, mode)
+            if not key:
+                continue
+            with self.block_sizes_lock:
+                if key not in self.block_sizes:
+                    self.block_sizes[key] = self._calibrated_block_size(key, endpoint, mode)
+                entry = self.block_sizes[key]
+            if entry:
+                sizes.append(self._size_to_bytes(entry['block_size']))
 
-        # Otherwise return stdout on success and raise an error on failure.
-        if is_success:
-            return stdout
+        return max(sizes or [self._size_to_bytes(self.default_block_size)])
+
+    def _block_size_key(self, endpoint, mode):
+        '''
+        Return the key block size calibrations of an endpoint are cached
+        under: its volume group, block device, file system or ssh remote
+        and the mode. Returns None for endpoints that can not be measured,
+        including ssh sources.
+        '''
+        if isinstance(endpoint, list):
+            # Only writes to the remote depend on the local block size, a
+            # remote source is read by `dd` at its own pace
+            if endpoint[:1] == ['ssh'] and mode == 'write':
+                return 'ssh:{0}:{1}'.format(self.args.remote, mode)
+            return None
+        if not isinstance(endpoint, basestring):
+            return None
+
+        # A target file is probed in the directory it will be created in
+        path = endpoint
+        if not os.path.exists(path):
+            if mode == 'read':
+                return None
+            path = os.path.dirname(os.path.abspath(path))
+
+        st = os.stat(path)
+        parts = path.split('/')
+        if stat.S_ISBLK(st.st_mode):
+            if len(parts) == 4 and parts[1] == 'dev' and self.vg_info(parts[2], None, False):
+                device = 'vg:{0}'.format(parts[2])
+            else:
+                device = 'dev:{0}:{1}'.format(os.major(st.st_rdev), os.minor(st.st_rdev))
+        elif stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode):
+            device = 'fs:{0}:{1}'.format(os.major(st.st_dev), os.minor(st.st_dev))
         else:
-            self._raise('Stdout: {0} | Stderr: {1}'.format(stdout, stderr))
+            return None
+        return '{0}:{1}'.format(device, mode)
+
+    def _calibrated_block_size(self, key, endpoint, mode):
+        '''
+        Return the cached block size calibration of key, calibrating and
+        caching it first if needed. Returns None if the endpoint could not
+        be measured.
+        '''
+        cached = self.cache['block_size'].get(key) if self.cache is not None else None
+        if cached:
+            self._output('Using cached block size for "{0}": {1} at {2} MiB/s'.format(key, cached['block_size'], cached['throughput']), 2)
+            return dict(cached, cached=True)
+
+        entry = self._calibrate_block_size(endpoint, mode)
+        if not entry:
+            self._output('Could not calibrate the block size for "{0}", using {1}.'.format(key, self.default_block_size), 2)
+            return None
+
+        self._output('Calibrated block size for "{0}": {1} at {2} MiB/s'.format(key, entry['block_size'], entry['throughput']), 2)
+        self._history('success', 'Block size calibration: "{0}" | {1}'.format(key, entry))
+        if self.cache is not None:
+            self.cache['block_size'][key] = entry
+        return entry
+
+    def _calibrate_block_size(self, endpoint, mode):
+        '''
+        Copy block_size_probe_size bytes with each of the
+        block_size_candidates and return a dictionary with the smallest size
+        within 5% of the highest throughput, that throughput and the
+        throughput of every candidate in MiB/s. Returns None if the endpoint
+        is too small to measure.
+        '''
+        probe_size = self._size_to_bytes(self.block_size_probe_size)
+        results = {}
+        for i, candidate in enumerate(self.block_size_candidates):
+            block_size = self._size_to_bytes(candidate)
+            try:
+                if isinstance(endpoint, list):
+                    seconds = self._probe_ssh(mode, probe_size, block_size)
+                else:
+                    seconds = self._probe_path(endpoint, mode, i * probe_size, probe_size, block_size)
+            except (OSError, IOError), e:
+                self._output('Block size probe of "{0}" failed: {1}'.format(endpoint, str(e)), 2)
+                return None
+            if seconds is None:
+                return None
+            results[candidate] = round(probe_size / max(seconds, 1e-6) / 1024 ** 2, 1)
+
+        best = max(results.values())
+        chosen = [candidate for candidate in self.block_size_candidates if results[candidate] >= best * 0.95][0]
+        return {'block_size': chosen, 'throughput': results[chosen], 'results': results}
+
+    def _probe_path(self, path, mode, offset, probe_size, block_size):
+        '''
+        Return the seconds it takes to read probe_size bytes of path at
+        offset in blocks of block_size, or None if path is too small. Writes
+        never touch existing data: a file target is probed by writing and
+        removing a temporary file in its directory, a device only when it is
+        a logical volume created by this run. Other devices return None.
+        '''
+        data = os.urandom(block_size)
+        if not os.path.exists(path) or (mode == 'write' and os.path.isfile(path)):
+            path = os.path.dirname(os.path.abspath(path))
+        if os.path.isdir(path):
+            fd, temp_path = tempfile.mkstemp(prefix='.vmpy-probe-', dir=path)
+            try:
+                start = time.time()
+                for position in xrange(0, probe_size, block_size):
+                    os.write(fd, data[:probe_size - position])
+                os.fdatasync(fd)
+                return time.time() - start
+            finally:
+                os.close(fd)
+                os.unlink(temp_path)
+
+        if mode == 'write' and path not in self.created_lvs:
+            self._output('Not probing writes to "{0}", it may hold data.'.format(path), 3)
+            return None
+
+        fd = os.open(path, os.O_WRONLY if mode == 'write' else os.O_RDONLY)
+        try:
+            if os.lseek(fd, 0, os.SEEK_END) < offset + probe_size:
+                return None
+            os.lseek(fd, offset, os.SEEK_SET)
+            start = time.time()
+            for position in xrange(0, probe_size, block_size):
+                if mode == 'write':
+                    os.write(fd, data[:probe_size - position])
+                else:
+                    os.read(fd, min(block_size, probe_size - position))
+            if mode == 'write':
+                os.fdatasync(fd)
+            return time.time() - start
+        finally:
+            os.close(fd)
+
+    def _probe_ssh(self, mode, probe_size, block_size):
+        '''
+        Return the seconds it takes to stream probe_size bytes to the
+        --remote host over ssh in blocks of block_size. Reads from the remote
+        are not probed, see _block_size_key().
+        '''
+        devnull = open(os.devnull, 'w')
+        try:
+            start = time.time()
+            command = self._remote_ssh_command(['dd', 'of=/dev/null', 'bs={0}'.format(block_size)])
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull, close_fds=True)
+            data = os.urandom(block_size)
+            for position in xrange(0, probe_size, block_size):
+                process.stdin.write(data[:probe_size - position])
+            process.stdin.close()
+            if process.wait() != 0:
+                raise IOError('`{0}` exited with status {1}'.format(' '.join(command), process.returncode))
+            return time.time() - start
+        finally:
+            devnull.close()
+
+    def _parallel_map(self, func, items, workers=1):
+        '''
+        Call func on each item using a bounded pool of worker threads and
+        return the results in the same order as items. If any call raises an
+        exception, the first one (in item order) is raised again after all
+        workers have finished.
+        '''
+        items = list(items)
+        results = [None] * len(items)
+        errors = [None] * len(items)
+        workers = max(1, min(int(workers), len(items)))
+
+        # Fill work queue
+        queue = Queue.Queue()
+        for i, item in enumerate(items):
+            queue.put((i, item))
+
+        def worker():
+            while True:
+                try:
+                    i, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(item)
+                except BaseException:
+                    errors[i] = sys.exc_info()
+
+        # Run workers
+        if workers == 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker) for i in range(workers)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Raise first error, if any, with its original traceback
+        for error in errors:
+            if error:
+                raise error[0], error[1], error[2]
+
+        return results
+
+    def _parallel_per_pv(self, func, items, pvs):
+        '''
+        Call func on every item concurrently, like _parallel_map(), while
+        running at most --streams-per-pv calls against any one physical
+        volume. pvs holds the list of physical volumes each item reads from
+        or writes to. Items on separate physical volumes run side by side,
+        items sharing one take turns instead of competing for its bandwidth.
+        '''
+        items = list(items)
+        semaphores = {}
+        for item_pvs in pvs:
+            for pv in item_pvs:
+                if pv not in semaphores:
+                    semaphores[pv] = threading.BoundedSemaphore(self.args.streams_per_pv)
+
+        def call(i):
+            # Acquire in sorted order so two items never wait on each other
+            held = [semaphores[pv] for pv in sorted(set(pvs[i]))]
+            for semaphore in held:
+                semaphore.acquire()
+            try:
+                return func(items[i])
+            finally:
+                for semaphore in reversed(held):
+                    semaphore.release()
+
+        return self._parallel_map(call, range(len(items)), len(items))
 
     def _output(self, message, message_level=1, show_timestamp=False):
         '''
@@ -2146,6 +5753,15 @@ class Vmpy:
         if message_level == 0 or message_level <= output_level:
             print(timestamp + ' ' + message)
 
+    def _truncate(self, text, limit=1024):
+        '''
+        Shorten long command output before it is kept in the command
+        history, e.g. the full XML returned by `virsh dumpxml`.
+        '''
+        if text is None or len(text) <= limit:
+            return text
+        return '{0}... [{1} more bytes]'.format(text[:limit], len(text) - limit)
+
     def _history(self, key, value):
         '''
         Log command history for status and error logs.